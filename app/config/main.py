@@ -1,11 +1,104 @@
 data_set_location = "./data/data.zarr"
+data_set_chunks = {'lat': 100, 'lon': 100}  # Chunking of datasets held in memory, stores are read with their own
 port = 5000
 
+## chunk cache
+# Byte budget of the cache of decompressed chunks, 0 to read every chunk from the store
+
+chunk_cache_max_bytes = 256 * 1024 ** 2
+
+## response cache
+# Budget of the cache of serialized read responses, 0 bytes to serialize every response
+
+response_cache_max_entries = 4096
+response_cache_max_bytes = 64 * 1024 ** 2
+
+## overviews
+# Overview levels are built down to overview_min_size cells on the longest side, and
+# windows are served at up to window_max_size cells on each side
+
+overview_min_size = 256
+window_max_size = 1024
+
+## metrics
+# Set slow_request_profile_seconds to sample the stacks of every request and log the
+# hottest ones of requests slower than it, optionally also writing them to a directory
+
+slow_request_profile_seconds = None
+slow_request_profile_interval = 0.005
+slow_request_profile_directory = None  # e.g. "./data/profiles"
+
+## request logging
+# Requests are logged by a background thread. Bodies of POST, PUT and PATCH requests are
+# logged for request_log_body_sample_rate of the requests, cut at request_log_body_max_bytes.
+# When request_log_queue_size entries are waiting, new ones are dropped.
+
+request_log_queue_size = 10000
+request_log_body_max_bytes = 4096
+request_log_body_sample_rate = 1.0
+
+## statistics
+# Every chunk keeps a histogram of its values to estimate percentiles and exceedance
+# fractions. Bins grow geometrically from histogram_min to histogram_max by
+# histogram_ratio, which bounds the relative error of percentiles. Exceedance fractions
+# are exact at the exceedance_thresholds (in µg/m³).
+
+histogram_min = 0.5
+histogram_max = 1000.0
+histogram_ratio = 1.05
+exceedance_thresholds = [5, 10, 15, 25, 35, 50, 75]
+
+## yearly data
+# Stores converted with several years keep the grid of every year. Years other than the
+# served one are opened on demand, and the year_views_max most recently used are kept
+# with their statistics.
+
+year_views_max = 4
+
+## batch requests
+
+batch_max_points = 100000
+
+## persistence
+# Set wal_directory to log every write and flush it back to the zarr store. Only one
+# process may own the log, so gunicorn then runs a single worker, see workers below.
+
+wal_directory = None  # e.g. "./data/wal"
+wal_fsync = True
+flush_interval_seconds = 30
+flush_max_dirty_cells = 100000
+
+## shared memory
+# Set shared_memory_path to hold the grid once in memory-mapped files shared by every
+# worker, so that writes handled by one worker are seen by the others.
+
+shared_memory_path = None  # e.g. "/dev/shm/air_quality_service"
+
+## background jobs
+# 'local' runs jobs in a process pool of each worker and keeps their state in a SQLite
+# database shared by all workers, 'celery' runs them with the in-memory Celery broker.
+
+job_backend = 'local'
+job_store_path = "./data/jobs.sqlite3"
+job_workers = None  # Defaults to the number of cores
+job_result_ttl_seconds = 3600
+job_timeout_seconds = 600
+
+## startup
+# With preload_dataset, the gunicorn master opens the store and builds the coordinates,
+# indexes and statistics of the dataset once, before forking the workers, which share them
+# copy-on-write instead of each loading its own copy. Ignored with wal_directory, which
+# needs the worker owning the write-ahead log to load the dataset itself.
+
+preload_dataset = True
+
 ## gunicorn config
 
 bind = f'0.0.0.0:{port}'
-workers = 4
+workers = 1 if wal_directory else 4  # The worker owning the write-ahead log must be the only one
 loglevel = 'info'
 accesslog = None # Gunicorn does not need to log as we already implemented custom logging
 errorlog = '-'   # Log to stderr
-timeout = 600
\ No newline at end of file
+timeout = 600
+# Load the dataset, or copy the grid into shared memory, once in the master before forking
+preload_app = shared_memory_path is not None or (preload_dataset and wal_directory is None)
\ No newline at end of file
@@ -1,26 +1,67 @@
 from flask import Flask
 from app.utils.data_loader import load_dataset
 from app.routes.main import init_routes
-from app.config.main import data_set_location, port
+from app.utils.persistence import start_persistence
+from app.utils.shared_grid import load_shared_dataset
+from app.utils.job_executor import LocalJobExecutor, CeleryJobBackend
+from app.utils.metrics import get_startup_timings, startup_phase
+from app.utils.prefork import freeze_for_fork
+from app.config.main import (
+    data_set_location, port, wal_directory, wal_fsync, flush_interval_seconds, flush_max_dirty_cells,
+    shared_memory_path, job_backend, job_store_path, job_workers, job_result_ttl_seconds, job_timeout_seconds,
+    preload_app
+)
 import logging
 from threading import Lock
-from app.config.celery_config import make_celery
 
 app = Flask(__name__)
-app.config.update(
-    CELERY_BROKER_URL='memory://',  # In-memory broker
-    CELERY_RESULT_BACKEND='cache+memory://'  # In-memory result backend
-)
-celery = make_celery(app)
 
 # Configure logging, and set propagate to False to avoid duplication
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 app.logger.propagate = False
 
-data_lock = Lock()
-ds = load_dataset(data_set_location)
 
-init_routes(app, ds, data_lock, celery)
+def make_celery_app():
+    # Celery is only imported once a job is submitted, see CeleryJobBackend
+    from app.config.celery_config import make_celery
+    app.config.update(
+        CELERY_BROKER_URL='memory://',  # In-memory broker
+        CELERY_RESULT_BACKEND='cache+memory://'  # In-memory result backend
+    )
+    return make_celery(app)
+
+
+with startup_phase('job_backend'):
+    if job_backend == 'celery':
+        jobs = CeleryJobBackend(make_celery_app)
+    else:
+        jobs = LocalJobExecutor(
+            job_store_path, max_workers=job_workers, result_ttl=job_result_ttl_seconds, timeout=job_timeout_seconds
+        )
+
+if shared_memory_path:
+    if wal_directory:
+        raise ValueError("wal_directory is not supported together with shared_memory_path")
+    ds, data_lock = load_shared_dataset(data_set_location, shared_memory_path)
+else:
+    data_lock = Lock()
+    ds = load_dataset(data_set_location, wal_directory=wal_directory)
+
+if wal_directory:
+    if preload_app:
+        raise ValueError("wal_directory is not supported together with preload_app")
+    start_persistence(
+        ds, data_set_location, wal_directory, data_lock,
+        flush_interval=flush_interval_seconds, flush_max_dirty_cells=flush_max_dirty_cells, fsync=wal_fsync
+    )
+
+with startup_phase('routes'):
+    init_routes(app, ds, data_lock, jobs)
+
+logging.info(f"Started in {sum(get_startup_timings().values()):.3f}s")
+if preload_app:
+    # Loaded in the gunicorn master, the workers forked next share all of the above
+    freeze_for_fork()
 
 if __name__ == '__main__':
     # Disable Werkzeug's default logging to avoid duplicate logs
@@ -1,90 +1,367 @@
-from flask import request
-from app.utils.api_utils import generate_response, extract_and_validate_json
+from flask import Response, g, request
+from app.utils.api_utils import (
+    generate_response, extract_and_validate_json, extract_coordinate_arrays, extract_bbox, extract_number_list,
+    extract_batch_records, extract_year_range, encode_cursor, decode_cursor
+)
 from app.utils.data_set_utils import ( 
-    calculate_pm25_statistics, get_data_entry, get_lat_lon_indices, get_pm25_at_lat_lon, 
-    paginate_data, update_pm25_value, is_valid_id
+    calculate_pm25_statistics, calculate_region_statistics, get_data_entry, get_lat_lon_indices, get_pm25_at_lat_lon, 
+    get_pm25_at_indices, get_page_slices, paginate_data, paginate_valid_data, search_exceedances, update_pm25_value, update_pm25_values,
+    is_valid_id
+)
+from app.config.main import (
+    batch_max_points, response_cache_max_entries, response_cache_max_bytes, window_max_size, slow_request_profile_seconds, slow_request_profile_interval,
+    slow_request_profile_directory
 )
+from app.utils.coordinate_index import get_coordinate_index
+from app.utils.export_utils import EXPORT_FORMATS
+from app.utils.overviews import get_window_slices, read_window
+from app.utils.shared_grid import get_shared_grid
+from app.utils.chunk_cache import get_chunk_cache
+from app.utils.dataset_version import get_dataset_version, pin_snapshot
+from app.utils.result_cache import VersionedResultCache
+from app.utils.response_cache import build_response_cache
+from app.utils.time_series import get_yearly_data
+from app.utils.chunk_statistics import get_chunk_statistics, summarize_snapshot
+from app.utils.metrics import (
+    REGISTRY, REQUEST_DURATION, InstrumentedLock, SlowRequestProfiler, register_dask_metrics, set_current_endpoint
+)
+from app.utils.request_logging import RequestLogEntry, get_request_log
+from collections import OrderedDict
+from threading import Lock
 import logging
+import math
 import numpy as np
-import json
+import time
+
+def init_routes(app, ds, data_lock, jobs):
+    """
+    Register the API routes.
+    
+    Args:
+        app: The Flask app.
+        ds: The dataset.
+        data_lock: Lock serializing writes to the dataset.
+        jobs: Job execution backend running statistics in the background, see job_executor.
+    """
+    coord_index = get_coordinate_index(ds)
+    chunk_cache = get_chunk_cache(ds)
+    shared_grid = get_shared_grid(ds)
+    dataset_version = get_dataset_version(ds)
+    chunk_statistics = get_chunk_statistics(ds)
+    yearly_data = get_yearly_data(ds)
 
-def init_routes(app, ds, data_lock, celery):
+    # Read responses are tagged with the version of the chunks they were read from
+    response_cache = None
+    if response_cache_max_bytes:
+        response_cache = build_response_cache(ds, response_cache_max_entries, response_cache_max_bytes)
+
+    # Statistics results are cached under the dataset version they were computed at
+    stats_cache = VersionedResultCache()
+    stats_tasks_lock = Lock()
+    stats_task_versions = OrderedDict()  # task_id -> dataset version, latest last
+
+    # Lock waits and dask computations are recorded for the metrics endpoint
+    data_lock = InstrumentedLock(data_lock)
+    register_dask_metrics()
+    REGISTRY.set_collector('snapshots', lambda: [
+        (f"snapshot_{name}", 'gauge', f"Snapshots: {name.replace('_', ' ')}.", value)
+        for name, value in dataset_version.stats().items() if name != 'version'
+    ])
+    if chunk_cache is not None:
+        REGISTRY.set_collector('chunk_cache', lambda: [
+            (f"chunk_cache_{name}_total", 'counter', f"Chunk cache {name}.", value)
+            for name, value in chunk_cache.stats().items() if name in ('hits', 'misses', 'evictions', 'bypasses')
+        ])
+    if response_cache is not None:
+        REGISTRY.set_collector('response_cache', lambda: [
+            (f"response_cache_{name}_total", 'counter', f"Response cache {name}.", value)
+            for name, value in response_cache.stats().items() if name in ('hits', 'misses', 'evictions', 'invalidations')
+        ])
+    request_log = get_request_log()
+    profiler = None
+    if slow_request_profile_seconds is not None:
+        profiler = SlowRequestProfiler(
+            slow_request_profile_seconds, slow_request_profile_interval, slow_request_profile_directory
+        )
 
     @app.before_request
-    def log_request_info():
+    def start_request_metrics():
         """
-        Logs request information (including body) in a single line before processing the request.
+        Starts timing the request, and sampling its stacks when profiling is enabled.
         """
-        try:
-            log_message = f"{request.remote_addr} - {request.method} {request.url}"
+        g.request_start = time.perf_counter()
+        set_current_endpoint(request.url_rule.rule if request.url_rule else 'unmatched')
+        if profiler is not None:
+            profiler.start_request()
 
-            if request.method in ['POST', 'PUT', 'PATCH']:
-                data = request.get_json(silent=True)
-                if data:
-                    log_message += f" - Body: {json.dumps(data, separators=(',', ':'))}"
-                else:
-                    log_message += " - No JSON body in the request."
+    @app.after_request
+    def record_request_metrics(response):
+        """
+        Records the duration of the request by endpoint, method and status.
+        """
+        REQUEST_DURATION.observe(
+            time.perf_counter() - g.request_start,
+            endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+            method=request.method,
+            status=response.status_code
+        )
+        return response
 
-            logging.info(log_message)
-        except Exception as e:
-            logging.error(f"Error logging request data: {e}", exc_info=True)
+    @app.teardown_request
+    def finish_request_metrics(exception):
+        """
+        Dumps the hottest stacks of slow requests when profiling is enabled.
+        """
+        if profiler is not None and 'request_start' in g:
+            profiler.finish_request(f"{request.method} {request.full_path}", time.perf_counter() - g.request_start)
+        set_current_endpoint(None)
+
+    if shared_grid is not None:
+        @app.before_request
+        def sync_shared_grid():
+            """
+            Refreshes the structures derived from chunks written by other workers.
+            """
+            shared_grid.sync(ds)
 
-    @celery.task(bind=True)
-    def calculate_stats_task(self):
+    @app.after_request
+    def log_request_info(response):
         """
-        Background task to calculate statistics using Celery.
+        Logs request information (including body), status and duration in a single line.
+        
+        The entry is only enqueued here, it is formatted and written by the request log thread.
         """
         try:
-            return calculate_pm25_statistics(ds)
+            body, body_size, body_logged = request_log.sample_body(request)
+            request_log.log(RequestLogEntry(
+                request.remote_addr, request.method, request.url, response.status_code,
+                time.perf_counter() - g.request_start, body, body_size, body_logged
+            ))
         except Exception as e:
-            self.update_state(state='FAILURE', meta={'exc': str(e)})
-            raise
+            logging.error(f"Error logging request data: {e}", exc_info=True)
+        return response
+
+    def versioned_read(lat_slice, lon_slice, read):
+        """
+        Serves a read of a block of the grid with an ETag, answering 304 when the client
+        already holds it, and through the response cache.
+        
+        The ETag is the version of the chunks holding the block, so responses stay valid
+        until one of them is written.
+        
+        Args:
+            lat_slice: Slice of latitude indices read.
+            lon_slice: Slice of longitude indices read.
+            read: Callable returning the data of the response, read inside the snapshot.
+        """
+        with pin_snapshot(ds) as snapshot:
+            version = dataset_version.region_version(lat_slice, lon_slice)
+            if version > snapshot.version:
+                # Written since the snapshot was pinned, the response is not tagged
+                return generate_response(data=read())
+
+            etag = dataset_version.etag(version)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            key = request.full_path
+            body = response_cache.get(key, etag) if response_cache is not None else None
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+            else:
+                response, status_code = generate_response(data=read())
+                if response_cache is not None:
+                    response_cache.put(key, etag, lat_slice, lon_slice, response.get_data())
+        response.set_etag(etag)
+        return response
+
+    def requested_years():
+        """
+        Parses the year, or range of years, of the request.
+        
+        Returns:
+            Tuple: (years, error) - where 'years' is the list of the years of the dataset
+            requested (or None if no year was given), and 'error' is a string message (or
+            None if valid).
+        """
+        years, error = extract_year_range(request.args)
+        if error or years is None:
+            return None, error
+        if yearly_data is None:
+            return None, 'The dataset has no yearly data'
+        selected = yearly_data.select_years(*years)
+        if not selected:
+            return None, f"No data for years {years[0]} to {years[1]}, available: {yearly_data.years}"
+        return selected, None
 
     @app.route('/data/stats-async', methods=['GET'])
     def get_stats_async():
         """
-        Trigger the Celery task for calculating statistics asynchronously.
+        Start a background job calculating statistics.
+        
+        Requests made while the data is unchanged share the same job.
         """
-        task = calculate_stats_task.apply_async()
-        return generate_response(data={'task_id': task.id}, status_code=202)
+        with stats_tasks_lock:
+            version = dataset_version.version
+            task_id = next(reversed(stats_task_versions), None)
+            reusable = task_id is not None and stats_task_versions[task_id] == version and (
+                stats_cache.peek(('stats', None), version)[0]
+                or jobs.status(task_id)['state'] not in ('FAILURE', 'REVOKED')
+            )
+            if not reusable:
+                # The job works on a copy of the partials taken at a consistent version
+                with pin_snapshot(ds) as snapshot:
+                    version = snapshot.version
+                    partials = chunk_statistics.snapshot()
+                task_id = jobs.submit(summarize_snapshot, *partials)
+                stats_task_versions[task_id] = version
+                while len(stats_task_versions) > 1024:
+                    stats_task_versions.popitem(last=False)
+
+        return generate_response(data={'task_id': task_id}, status_code=202)
 
     @app.route('/data/stats/<task_id>', methods=['GET'])
     def get_stats_result(task_id):
         """
-        Check the status of the Celery task and return the result when ready.
+        Check the status of the statistics job and return the result when ready.
         """
-        task = calculate_stats_task.AsyncResult(task_id)
-        if task.state == 'PENDING':
-            response = {'state': task.state, 'status': 'Statistics calculation is pending...'}
-        elif task.state == 'SUCCESS':
-            response = {'state': task.state, 'result': task.result}
+        with stats_tasks_lock:
+            version = stats_task_versions.get(task_id)
+        if version is not None:
+            found, result = stats_cache.peek(('stats', None), version)
+            if found:
+                return generate_response(data={'state': 'SUCCESS', 'result': result})
+
+        status = jobs.status(task_id)
+        state = status['state']
+        if state in ('PENDING', 'STARTED'):
+            response = {'state': state, 'status': 'Statistics calculation is pending...'}
+        elif state == 'SUCCESS':
+            response = {'state': state, 'result': status['result']}
+            if version is not None:
+                stats_cache.get_or_compute(('stats', None), version, lambda: status['result'])
+        elif state == 'REVOKED':
+            response = {'state': state, 'status': 'Statistics calculation was cancelled.'}
         else:
-            response = {'state': task.state, 'status': 'Statistics calculation failed.'}
+            response = {'state': state, 'status': 'Statistics calculation failed.'}
+        if 'runtime_seconds' in status:
+            response['runtime_seconds'] = status['runtime_seconds']
 
         return generate_response(data=response)
 
+    @app.route('/data/stats/<task_id>', methods=['DELETE'])
+    def cancel_stats_task(task_id):
+        """
+        Cancel a statistics job that has not finished yet.
+        """
+        try:
+            if not jobs.cancel(task_id):
+                return generate_response(error="Job not found or already finished", status_code=404)
+            return generate_response(data={'task_id': task_id, 'state': 'REVOKED'})
+        except Exception as e:
+            logging.error(f"Error cancelling job {task_id}: {e}", exc_info=True)
+            return generate_response(error=str(e), status_code=500)
+
     @app.route('/data/stats', methods=['GET'])
     def get_stats():
         """
-        Perform synchronous statistics calculation using Dask.
+        Perform synchronous statistics calculation, optionally restricted to a bounding box,
+        with optional approximate percentiles and exceedance fractions, for the served grid
+        or for a year or range of years.
         """
         try:
-            result = calculate_pm25_statistics(ds)
-            return generate_response(data=result)
+            bbox, error = extract_bbox(request.args)
+            if not error:
+                percentiles, error = extract_number_list(request.args, 'percentiles', 0, 100)
+            if not error:
+                thresholds, error = extract_number_list(request.args, 'thresholds')
+            if not error:
+                years, error = requested_years()
+
+            if error:
+                return generate_response(error=error, status_code=400)
+
+            if years is not None:
+                results = []
+                for year in years:
+                    view = yearly_data.year_view(ds, year)
+                    with pin_snapshot(view):
+                        if bbox:
+                            result = calculate_region_statistics(view, bbox, percentiles, thresholds)
+                        else:
+                            result = calculate_pm25_statistics(view, percentiles, thresholds)
+                    results.append({'year': year, **result})
+                if 'year' in request.args:
+                    return generate_response(data=results[0])
+                return generate_response(data={'years': results})
+
+            options = (tuple(percentiles or ()), tuple(thresholds or ()))
+            lat_slice, lon_slice = coord_index.bbox_slices(bbox) if bbox else (slice(None), slice(None))
+
+            def read():
+                # Results are computed as of the pinned version, which they are cached under
+                version = dataset_version.current_snapshot().version
+                if bbox:
+                    key = ('stats', tuple(sorted(bbox.items())), options)
+                    return stats_cache.get_or_compute(
+                        key, version, lambda: calculate_region_statistics(ds, bbox, percentiles, thresholds)
+                    )
+                if percentiles or thresholds:
+                    key = ('stats', None, options)
+                    return stats_cache.get_or_compute(key, version, lambda: calculate_pm25_statistics(ds, percentiles, thresholds))
+                return stats_cache.get_or_compute(('stats', None), version, lambda: calculate_pm25_statistics(ds))
+
+            return versioned_read(lat_slice, lon_slice, read)
+        except ValueError as e:
+            return generate_response(error=str(e), status_code=400)
         except Exception as e:
             logging.error(f"Error calculating statistics: {e}", exc_info=True)
             return generate_response(error=str(e), status_code=500)
 
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        """
+        Exposes the metrics of this process in the Prometheus text format.
+        """
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/data/cache-stats', methods=['GET'])
+    def get_cache_stats():
+        """
+        Returns the counters of the chunk cache.
+        """
+        cache = get_chunk_cache(ds)
+        if cache is None:
+            return generate_response(error='Chunk cache is disabled', status_code=404)
+        return generate_response(data=cache.stats())
+
     @app.route('/data', methods=['GET'])
     def get_all_data():
         """
-        Retrieves all data entries with pagination support.
+        Retrieves all data entries with pagination support, or only the entries holding a
+        value with cursor pagination.
         """
         try:
             page = request.args.get('page', default=1, type=int)
             per_page = request.args.get('per_page', default=100, type=int)
-            data = paginate_data(ds, page, per_page)
-            return generate_response(data=data)
+
+            if request.args.get('valid_only', default='false').lower() in ('1', 'true', 'yes'):
+                if not 0 < per_page <= batch_max_points:
+                    return generate_response(error=f"per_page must be between 1 and {batch_max_points}", status_code=400)
+                after, error = decode_cursor(request.args.get('cursor'))
+                if error:
+                    return generate_response(error=error, status_code=400)
+                with pin_snapshot(ds):
+                    entries, last_id = paginate_valid_data(ds, per_page, after)
+                return generate_response(data={
+                    'data': entries,
+                    'next_cursor': encode_cursor(last_id) if last_id is not None else None
+                })
+
+            lat_slice, lon_slice = get_page_slices(ds, page, per_page)
+            return versioned_read(lat_slice, lon_slice, lambda: paginate_data(ds, page, per_page))
         except Exception as e:
             logging.error(f"Error retrieving all data: {e}")
             return generate_response(error=str(e), status_code=500)
@@ -95,11 +372,12 @@ def init_routes(app, ds, data_lock, celery):
         Retrieves data entry by ID.
         """
         try:
-            entry = get_data_entry(id, ds)
-            if entry is not None:
-                return generate_response(data=entry)
-            else:
+            if not is_valid_id(id, ds):
                 return generate_response(error='Data not found', status_code=404)
+            lat_idx, lon_idx = get_lat_lon_indices(id, ds)
+            return versioned_read(
+                slice(lat_idx, lat_idx + 1), slice(lon_idx, lon_idx + 1), lambda: get_data_entry(id, ds)
+            )
         except Exception as e:
             logging.error(f"Error retrieving data by ID: {e}")
             return generate_response(error=str(e), status_code=500)
@@ -107,7 +385,8 @@ def init_routes(app, ds, data_lock, celery):
     @app.route('/data/filter', methods=['GET'])
     def filter_data():
         """
-        Filters data based on latitude and longitude.
+        Filters data based on latitude and longitude, for the served grid or for a year or
+        range of years.
         """
         try:
             lat = request.args.get('lat', type=float)
@@ -115,23 +394,158 @@ def init_routes(app, ds, data_lock, celery):
 
             if lat is None or lon is None:
                 return generate_response(error='Latitude and Longitude are required', status_code=400)
+            if not (math.isfinite(lat) and math.isfinite(lon)):
+                return generate_response(error='Latitude and Longitude must be finite', status_code=400)
 
-            lat_idx = np.abs(ds['lat'].values - lat).argmin()
-            lon_idx = np.abs(ds['lon'].values - lon).argmin()
+            years, error = requested_years()
+            if error:
+                return generate_response(error=error, status_code=400)
 
-            pm25_value = get_pm25_at_lat_lon(ds, lat_idx, lon_idx)
+            lat_idx, lon_idx = coord_index.nearest(lat, lon)
+            location = {'lat': float(coord_index.lat.values[lat_idx]), 'lon': float(coord_index.lon.values[lon_idx])}
 
-            result = {
-                'lat': float(ds['lat'].isel(lat=lat_idx).values.item()),
-                'lon': float(ds['lon'].isel(lon=lon_idx).values.item()),
-                'pm25': pm25_value
-            }
+            if years is not None and 'year' in request.args:
+                view = yearly_data.year_view(ds, years[0])
+                with pin_snapshot(view):
+                    pm25_value = get_pm25_at_lat_lon(view, lat_idx, lon_idx)
+                return generate_response(data={**location, 'year': years[0], 'pm25': pm25_value})
+            if years is not None:
+                with pin_snapshot(ds):
+                    values = yearly_data.read_series(ds, lat_idx, lon_idx, years).tolist()
+                return generate_response(data={
+                    **location, 'years': years, 'pm25': [value if value == value else None for value in values]
+                })
 
-            return generate_response(data=result)
+            def read():
+                return {**location, 'pm25': get_pm25_at_lat_lon(ds, lat_idx, lon_idx)}
+
+            return versioned_read(slice(lat_idx, lat_idx + 1), slice(lon_idx, lon_idx + 1), read)
         except Exception as e:
             logging.error(f"Error filtering data: {e}")
             return generate_response(error=str(e), status_code=500)
 
+    @app.route('/data/filter/batch', methods=['POST'])
+    def filter_data_batch():
+        """
+        Retrieves PM2.5 data for the nearest grid point of many latitude/longitude pairs.
+        """
+        try:
+            coordinates, error = extract_coordinate_arrays(request, max_points=batch_max_points)
+
+            if error:
+                return generate_response(error=error, status_code=400)
+
+            lat_idx, lon_idx = coord_index.nearest_many(*coordinates)
+            with pin_snapshot(ds):
+                pm25_values = get_pm25_at_indices(ds, lat_idx, lon_idx).tolist()
+            lat_values = coord_index.lat.values[lat_idx].tolist()
+            lon_values = coord_index.lon.values[lon_idx].tolist()
+
+            result = [
+                {'lat': lat, 'lon': lon, 'pm25': pm25 if pm25 == pm25 else None}
+                for lat, lon, pm25 in zip(lat_values, lon_values, pm25_values)
+            ]
+
+            return generate_response(data=result)
+        except Exception as e:
+            logging.error(f"Error filtering data in batch: {e}")
+            return generate_response(error=str(e), status_code=500)
+
+    @app.route('/data/search', methods=['GET'])
+    def search_data():
+        """
+        Finds data entries whose PM2.5 value exceeds a threshold, optionally inside a bounding box.
+        """
+        try:
+            threshold = request.args.get('threshold', type=float)
+            limit = request.args.get('limit', default=100, type=int)
+
+            if threshold is None:
+                return generate_response(error='Threshold is required', status_code=400)
+            if not 0 < limit <= batch_max_points:
+                return generate_response(error=f"limit must be between 1 and {batch_max_points}", status_code=400)
+
+            bbox, error = extract_bbox(request.args)
+            if not error:
+                after, error = decode_cursor(request.args.get('cursor'))
+            if error:
+                return generate_response(error=error, status_code=400)
+
+            if bbox:
+                lat_slice, lon_slice = coord_index.bbox_slices(bbox)
+            else:
+                lat_slice, lon_slice = slice(None), slice(None)
+
+            def read():
+                entries, last_id = search_exceedances(ds, threshold, lat_slice, lon_slice, limit, after)
+                return {
+                    'data': entries,
+                    'next_cursor': encode_cursor(last_id) if last_id is not None else None
+                }
+
+            return versioned_read(lat_slice, lon_slice, read)
+        except ValueError as e:
+            return generate_response(error=str(e), status_code=400)
+        except Exception as e:
+            logging.error(f"Error searching data: {e}")
+            return generate_response(error=str(e), status_code=500)
+
+    @app.route('/data/window', methods=['GET'])
+    def get_window():
+        """
+        Serves the PM2.5 values of a bounding box downsampled to a given output size, from the coarsest sufficient overview level.
+        """
+        try:
+            width = request.args.get('width', default=256, type=int)
+            height = request.args.get('height', default=256, type=int)
+            agg = request.args.get('agg', default='mean')
+
+            if not (0 < width <= window_max_size and 0 < height <= window_max_size):
+                return generate_response(error=f"width and height must be between 1 and {window_max_size}", status_code=400)
+            if agg not in ('mean', 'max'):
+                return generate_response(error="agg must be 'mean' or 'max'", status_code=400)
+
+            bbox, error = extract_bbox(request.args)
+            if error:
+                return generate_response(error=error, status_code=400)
+
+            lat_slice, lon_slice = get_window_slices(ds, bbox, width, height)
+            return versioned_read(lat_slice, lon_slice, lambda: read_window(ds, bbox, width, height, agg))
+        except ValueError as e:
+            return generate_response(error=str(e), status_code=400)
+        except Exception as e:
+            logging.error(f"Error reading window: {e}")
+            return generate_response(error=str(e), status_code=500)
+
+    @app.route('/data/export', methods=['GET'])
+    def export_data():
+        """
+        Streams the data entries, optionally inside a bounding box, as NDJSON or Arrow IPC.
+        """
+        try:
+            export_format = request.args.get('format', default='ndjson')
+            skip_nan = request.args.get('skip_nan', default='false').lower() in ('1', 'true', 'yes')
+
+            if export_format not in EXPORT_FORMATS:
+                return generate_response(error=f"format must be one of: {', '.join(EXPORT_FORMATS)}", status_code=400)
+
+            bbox, error = extract_bbox(request.args)
+            if error:
+                return generate_response(error=error, status_code=400)
+
+            if bbox:
+                lat_slice, lon_slice = coord_index.bbox_slices(bbox)
+            else:
+                lat_slice, lon_slice = slice(None), slice(None)
+
+            exporter, mimetype = EXPORT_FORMATS[export_format]
+            return Response(exporter(ds, lat_slice, lon_slice, skip_nan), mimetype=mimetype)
+        except ValueError as e:
+            return generate_response(error=str(e), status_code=400)
+        except Exception as e:
+            logging.error(f"Error exporting data: {e}")
+            return generate_response(error=str(e), status_code=500)
+
     @app.route('/data', methods=['POST'])
     def add_data():
         """
@@ -144,8 +558,11 @@ def init_routes(app, ds, data_lock, celery):
                 if error:
                     return generate_response(error=error, status_code=400)
 
-                lat_idx = np.abs(ds['lat'].values - data['lat']).argmin()
-                lon_idx = np.abs(ds['lon'].values - data['lon']).argmin()
+                served_year = ds['GWRPM25'].attrs.get('year')
+                if data.get('year') is not None and served_year is not None and data['year'] != served_year:
+                    return generate_response(error=f"Only the grid of {served_year} can be written", status_code=400)
+
+                lat_idx, lon_idx = coord_index.nearest(data['lat'], data['lon'])
                 update_pm25_value(ds, lat_idx, lon_idx, data['pm25'])
 
                 updated_entry = get_data_entry(lat_idx * ds.sizes['lon'] + lon_idx, ds)
@@ -155,6 +572,50 @@ def init_routes(app, ds, data_lock, celery):
                 logging.error(f"Error adding data: {e}")
                 return generate_response(error=str(e), status_code=500)
 
+    @app.route('/data/batch', methods=['POST'])
+    def update_data_batch():
+        """
+        Updates the PM2.5 values of many data entries, identified by ID or by latitude and longitude.
+        """
+        batch, error = extract_batch_records(request, max_records=batch_max_points)
+
+        if error:
+            return generate_response(error=error, status_code=400)
+
+        errors = batch['errors']
+        total_points = ds.sizes['lat'] * ds.sizes['lon']
+        has_id = ~np.isnan(batch['id'])
+        invalid_id = np.equal(errors, None) & has_id & ((batch['id'] < 0) | (batch['id'] >= total_points))
+        errors[invalid_id] = 'Invalid ID'
+        accepted = np.equal(errors, None)
+
+        with data_lock:
+            try:
+                ids = np.zeros(errors.size, dtype=np.int64)
+                ids[accepted & has_id] = batch['id'][accepted & has_id]
+                by_location = accepted & ~has_id
+                if by_location.any():
+                    lat_idx, lon_idx = coord_index.nearest_many(batch['lat'][by_location], batch['lon'][by_location])
+                    ids[by_location] = lat_idx * ds.sizes['lon'] + lon_idx
+
+                lat_idx, lon_idx = np.divmod(ids[accepted], ds.sizes['lon'])
+                if lat_idx.size:
+                    update_pm25_values(ds, lat_idx, lon_idx, batch['pm25'][accepted])
+            except Exception as e:
+                logging.error(f"Error updating data in batch: {e}")
+                return generate_response(error=str(e), status_code=500)
+
+        results = [
+            {'index': index, 'status': 'updated', 'id': id} if error is None
+            else {'index': index, 'status': 'rejected', 'error': error}
+            for index, (id, error) in enumerate(zip(ids.tolist(), errors.tolist()))
+        ]
+        return generate_response(data={
+            'updated': int(accepted.sum()),
+            'rejected': int((~accepted).sum()),
+            'results': results
+        })
+
     @app.route('/data/<int:id>', methods=['PUT'])
     def update_data(id):
         """
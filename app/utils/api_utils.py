@@ -1,4 +1,7 @@
 from flask import jsonify
+import numpy as np
+import base64
+import binascii
 
 def extract_and_validate_json(request, required_fields, numeric_fields=None):
     """
@@ -31,6 +34,270 @@ def extract_and_validate_json(request, required_fields, numeric_fields=None):
     return data, None
 
 
+def extract_numeric_array(data, field):
+    """
+    Converts a JSON list into a NumPy float array, rejecting non-numeric items.
+    
+    Args:
+        data: The extracted JSON data.
+        field: Name of the field holding the list.
+    
+    Returns:
+        Tuple: (array, error) - where 'array' is the float array (or None if invalid),
+        and 'error' is a string message (or None if valid).
+    """
+    values = data.get(field)
+    if values is None:
+        return None, f"Missing fields: {field}"
+    if not isinstance(values, list):
+        return None, f"{field} must be a list of numbers"
+
+    try:
+        array = np.array(values)
+    except (ValueError, TypeError):
+        # Ragged nested lists
+        return None, f"{field} must be a list of numbers"
+    if array.ndim != 1 or (array.size and array.dtype.kind not in 'iuf'):
+        return None, f"{field} must be a list of numbers"
+    return array.astype(np.float64), None
+
+
+def extract_coordinate_arrays(request, max_points=None):
+    """
+    Extracts arrays of latitudes and longitudes from the request.
+    
+    The body is either JSON with 'lat' and 'lon' lists, or, with the
+    'application/octet-stream' content type, packed little-endian float64
+    (lat, lon) pairs.
+    
+    Args:
+        request: The incoming request object.
+        max_points: Optional maximum number of points accepted.
+    
+    Returns:
+        Tuple: (coordinates, error) - where 'coordinates' is a (lats, lons) tuple of
+        NumPy arrays (or None if invalid), and 'error' is a string message (or None if valid).
+    """
+    if request.mimetype == 'application/octet-stream':
+        body = request.get_data()
+        if not body:
+            return None, 'No data provided'
+        if len(body) % 16:
+            return None, 'Binary body must contain float64 (lat, lon) pairs'
+        pairs = np.frombuffer(body, dtype='<f8').reshape(-1, 2)
+        lats, lons = pairs[:, 0], pairs[:, 1]
+    else:
+        data = request.get_json(silent=True)
+        if not data or not isinstance(data, dict):
+            return None, 'No data provided'
+        lats, error = extract_numeric_array(data, 'lat')
+        if error:
+            return None, error
+        lons, error = extract_numeric_array(data, 'lon')
+        if error:
+            return None, error
+        if lats.size != lons.size:
+            return None, 'lat and lon must have the same length'
+
+    if max_points is not None and lats.size > max_points:
+        return None, f"A maximum of {max_points} points is allowed per request"
+    if not (np.isfinite(lats).all() and np.isfinite(lons).all()):
+        return None, 'lat and lon must be finite'
+    return (lats, lons), None
+
+
+def extract_year_range(args):
+    """
+    Extracts an optional year, or range of years, from query parameters.
+    
+    Args:
+        args: The query parameters of the request, 'year' or 'year_start' and 'year_end'.
+    
+    Returns:
+        Tuple: (years, error) - where 'years' is a (first, last) tuple of years, inclusive
+        (or None if no year was given), and 'error' is a string message (or None if valid).
+    """
+    fields = ['year', 'year_start', 'year_end']
+    year, first, last = (args.get(field, type=int) for field in fields)
+    invalid = [field for field, value in zip(fields, (year, first, last)) if field in args and value is None]
+    if invalid:
+        return None, f"{', '.join(invalid)} must be an integer"
+    if year is not None:
+        if first is not None or last is not None:
+            return None, 'Give either year or year_start and year_end'
+        return (year, year), None
+    if first is None and last is None:
+        return None, None
+    if first is None or last is None:
+        return None, 'year_start and year_end must be given together'
+    if first > last:
+        return None, 'year_start must not be after year_end'
+    return (first, last), None
+
+
+def extract_bbox(args):
+    """
+    Extracts an optional bounding box from query parameters.
+    
+    Args:
+        args: The query parameters of the request.
+    
+    Returns:
+        Tuple: (bbox, error) - where 'bbox' is a dictionary with lat_min, lat_max, lon_min
+        and lon_max (or None if no bound was given), and 'error' is a string message
+        (or None if valid).
+    """
+    fields = ['lat_min', 'lat_max', 'lon_min', 'lon_max']
+    bbox = {field: args.get(field, type=float) for field in fields}
+    if all(value is None for value in bbox.values()):
+        if any(field in args for field in fields):
+            return None, f"{', '.join(field for field in fields if field in args)} must be a number"
+        return None, None
+
+    missing_fields = [field for field, value in bbox.items() if value is None]
+    if missing_fields:
+        return None, f"Missing or invalid fields: {', '.join(missing_fields)}"
+    if not np.all(np.isfinite(list(bbox.values()))):
+        return None, 'Bounds must be finite'
+    if bbox['lat_min'] > bbox['lat_max'] or bbox['lon_min'] > bbox['lon_max']:
+        return None, 'Minimum bounds must not exceed maximum bounds'
+    return bbox, None
+
+
+def extract_number_list(args, name, minimum=None, maximum=None):
+    """
+    Extracts an optional comma-separated list of numbers from query parameters, e.g. percentiles=50,95.
+    
+    Args:
+        args: The query parameters of the request.
+        name: Name of the parameter.
+        minimum: Optional smallest value accepted.
+        maximum: Optional largest value accepted.
+    
+    Returns:
+        Tuple: (values, error) - where 'values' is a list of floats (or None if the
+        parameter was not given), and 'error' is a string message (or None if valid).
+    """
+    value = args.get(name)
+    if value is None:
+        return None, None
+    try:
+        values = [float(item) for item in value.split(',')]
+    except ValueError:
+        return None, f"{name} must be a comma-separated list of numbers"
+    if any(item != item for item in values):
+        return None, f"{name} must be a comma-separated list of numbers"
+    if (minimum is not None and min(values) < minimum) or (maximum is not None and max(values) > maximum):
+        return None, f"{name} must be between {minimum:g} and {maximum:g}"
+    return values, None
+
+
+def extract_batch_records(request, max_records=None):
+    """
+    Extracts a batch of PM2.5 updates from the request and validates them as whole columns.
+    
+    The body is either a list of records (or {"records": [...]}) where each record has
+    'pm25' and either 'id' or 'lat' and 'lon', or the same fields given as lists.
+    
+    Args:
+        request: The incoming request object.
+        max_records: Optional maximum number of records accepted.
+    
+    Returns:
+        Tuple: (batch, error) - where 'batch' is a dictionary of float arrays ('id', 'lat',
+        'lon', 'pm25', NaN where missing) plus an 'errors' array holding the validation
+        error of each record (None if valid), and 'error' is a string message for a body
+        that cannot be processed at all (or None).
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and 'records' in data:
+        data = data['records']
+    if not data:
+        return None, 'No data provided'
+
+    fields = ['id', 'lat', 'lon', 'pm25']
+    if isinstance(data, dict):
+        lengths = {len(data[field]) for field in fields if isinstance(data.get(field), list)}
+        if len(lengths) != 1:
+            return None, 'Fields must be lists of the same length'
+        size = lengths.pop()
+        columns = {field: data[field] if isinstance(data.get(field), list) else [None] * size for field in fields}
+    elif isinstance(data, list):
+        size = len(data)
+        records = [record if isinstance(record, dict) else {} for record in data]
+        columns = {field: [record.get(field) for record in records] for field in fields}
+    else:
+        return None, 'Records must be a list'
+
+    if max_records is not None and size > max_records:
+        return None, f"A maximum of {max_records} records is allowed per request"
+
+    batch = {}
+    present = {}
+    for field, column in columns.items():
+        # Filled element-wise, as np.array would build a 2D array from lists of equal length
+        values = np.empty(size, dtype=object)
+        values[:] = column
+        present[field] = np.not_equal(values, None)
+        numeric = np.array([isinstance(value, (int, float)) and not isinstance(value, bool) for value in column], dtype=bool)
+        batch[field] = np.where(numeric, values, np.nan).astype(np.float64)
+        present[field + '_numeric'] = numeric
+
+    has_id = present['id']
+    has_location = present['lat'] & present['lon']
+    batch['errors'] = np.select(
+        [
+            ~present['pm25'],
+            ~present['pm25_numeric'],
+            ~has_id & ~has_location,
+            has_id & ~present['id_numeric'],
+            has_id & (np.mod(batch['id'], 1) != 0),
+            ~has_id & ~(present['lat_numeric'] & present['lon_numeric']),
+            ~has_id & ~(np.isfinite(batch['lat']) & np.isfinite(batch['lon']))
+        ],
+        [
+            'Missing fields: pm25',
+            'pm25 must be a number',
+            'Missing fields: id or lat and lon',
+            'id must be an integer',
+            'id must be an integer',
+            'lat and lon must be numbers',
+            'lat and lon must be finite'
+        ],
+        default=None
+    )
+    return batch, None
+
+
+def encode_cursor(position):
+    """
+    Encodes a position in a result set as an opaque pagination cursor.
+    """
+    return base64.urlsafe_b64encode(str(int(position)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes an opaque pagination cursor.
+    
+    Args:
+        cursor: The cursor received from the client, or None.
+    
+    Returns:
+        Tuple: (position, error) - where 'position' is the decoded position (or None if
+        no cursor was given), and 'error' is a string message (or None if valid).
+    """
+    if not cursor:
+        return None, None
+    try:
+        position = int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, ValueError, UnicodeError):
+        return None, 'Invalid cursor'
+    if position < 0:
+        return None, 'Invalid cursor'
+    return position, None
+
+
 def generate_response(data=None, error=None, status_code=200):
     """
     Generate a JSON response.
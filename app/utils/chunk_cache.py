@@ -0,0 +1,167 @@
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from app.utils.dataset_registry import get_derived, set_derived
+from app.utils.grid_utils import get_chunk_shape
+
+
+class ChunkCache:
+    """
+    Bounded LRU cache of decompressed PM2.5 chunks.
+    
+    Sits between the readers of the grid and the zarr store: reads are assembled from
+    cached chunks, and only missing chunks go through Dask and the codec. Writes are
+    applied to cached chunks as well, so the cache never serves stale values. Reads
+    spanning more chunks than a quarter of the budget bypass the cache, so that full
+    scans do not evict the hot regions.
+    """
+
+    def __init__(self, ds, chunk_shape, max_bytes):
+        self.lat_size = ds.sizes['lat']
+        self.lon_size = ds.sizes['lon']
+        self.lat_chunk, self.lon_chunk = chunk_shape
+        self.dtype = ds['GWRPM25'].dtype
+        self.max_bytes = max_bytes
+        chunk_bytes = self.lat_chunk * self.lon_chunk * self.dtype.itemsize
+        self.max_scan_chunks = max(1, max_bytes // chunk_bytes // 4)
+
+        self._chunks = OrderedDict()
+        self._generations = {}  # chunk -> number of writes to it, to detect writes racing a load
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypasses = 0
+
+    def _chunk_slices(self, row, col):
+        return (
+            slice(row * self.lat_chunk, min((row + 1) * self.lat_chunk, self.lat_size)),
+            slice(col * self.lon_chunk, min((col + 1) * self.lon_chunk, self.lon_size))
+        )
+
+    def get_chunk(self, ds, row, col):
+        """
+        Get a decompressed chunk, loading it from the store on a miss.
+        
+        The returned array is owned by the cache and must not be modified. A chunk written
+        while it was being loaded is returned without being cached, as the load may have
+        missed the write.
+        """
+        key = (row, col)
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self._chunks.move_to_end(key)
+                self.hits += 1
+                return chunk
+            self.misses += 1
+            generation = self._generations.get(key, 0)
+
+        lat_slice, lon_slice = self._chunk_slices(row, col)
+        chunk = np.ascontiguousarray(ds['GWRPM25'].isel(lat=lat_slice, lon=lon_slice).values)
+
+        with self._lock:
+            if self._generations.get(key, 0) != generation:
+                return chunk
+            if key not in self._chunks:
+                self._chunks[key] = chunk
+                self.current_bytes += chunk.nbytes
+                while self.current_bytes > self.max_bytes and len(self._chunks) > 1:
+                    _, evicted = self._chunks.popitem(last=False)
+                    self.current_bytes -= evicted.nbytes
+                    self.evictions += 1
+            return self._chunks[key]
+
+    def read_block(self, ds, lat_slice, lon_slice):
+        """
+        Read a rectangular block of PM2.5 values, see read_pm25_block.
+        
+        Returns:
+            2D NumPy array owned by the caller.
+        """
+        lat_start, lat_stop, _ = lat_slice.indices(self.lat_size)
+        lon_start, lon_stop, _ = lon_slice.indices(self.lon_size)
+        rows = range(lat_start // self.lat_chunk, -(-lat_stop // self.lat_chunk))
+        cols = range(lon_start // self.lon_chunk, -(-lon_stop // self.lon_chunk))
+
+        if len(rows) * len(cols) > self.max_scan_chunks:
+            with self._lock:
+                self.bypasses += 1
+            return ds['GWRPM25'].isel(lat=slice(lat_start, lat_stop), lon=slice(lon_start, lon_stop)).values
+
+        block = np.empty((max(lat_stop - lat_start, 0), max(lon_stop - lon_start, 0)), dtype=self.dtype)
+        for row in rows:
+            for col in cols:
+                chunk = self.get_chunk(ds, row, col)
+                chunk_lat, chunk_lon = self._chunk_slices(row, col)
+                r0, r1 = max(lat_start, chunk_lat.start), min(lat_stop, chunk_lat.stop)
+                c0, c1 = max(lon_start, chunk_lon.start), min(lon_stop, chunk_lon.stop)
+                block[r0 - lat_start:r1 - lat_start, c0 - lon_start:c1 - lon_start] = (
+                    chunk[r0 - chunk_lat.start:r1 - chunk_lat.start, c0 - chunk_lon.start:c1 - chunk_lon.start]
+                )
+        return block
+
+    def write_through(self, lat_idx, lon_idx, values):
+        """
+        Apply written values to the cached chunks holding them.
+        """
+        rows, cols = lat_idx // self.lat_chunk, lon_idx // self.lon_chunk
+        with self._lock:
+            for position, key in enumerate(zip(rows.tolist(), cols.tolist())):
+                self._generations[key] = self._generations.get(key, 0) + 1
+                chunk = self._chunks.get(key)
+                if chunk is not None:
+                    chunk[lat_idx[position] - key[0] * self.lat_chunk, lon_idx[position] - key[1] * self.lon_chunk] = values[position]
+
+    def on_stale(self, ds, lat_idx, lon_idx):
+        rows, cols = lat_idx // self.lat_chunk, lon_idx // self.lon_chunk
+        with self._lock:
+            for key in zip(rows.tolist(), cols.tolist()):
+                self._generations[key] = self._generations.get(key, 0) + 1
+                chunk = self._chunks.pop(key, None)
+                if chunk is not None:
+                    self.current_bytes -= chunk.nbytes
+
+    def stats(self):
+        """
+        Counters of the cache.
+        
+        Returns:
+            A dictionary with the hits, misses, evictions, bypasses, number of chunks
+            and bytes held, and the byte budget.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bypasses': self.bypasses,
+                'chunks': len(self._chunks),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+def build_chunk_cache(ds, max_bytes):
+    """
+    Put a chunk cache in front of the store of the dataset and register it.
+    
+    Args:
+        ds: The dataset.
+        max_bytes: Byte budget of the cache.
+    
+    Returns:
+        ChunkCache for the dataset.
+    """
+    cache = ChunkCache(ds, get_chunk_shape(ds), max_bytes)
+    logging.info(f"Caching up to {max_bytes} bytes of decompressed chunks")
+    return set_derived(ds, 'chunk_cache', cache)
+
+
+def get_chunk_cache(ds):
+    """
+    Retrieve the chunk cache of the dataset, or None when reads go straight to the store.
+    """
+    return get_derived(ds, 'chunk_cache')
@@ -0,0 +1,499 @@
+import logging
+import threading
+import numpy as np
+from app.utils.dataset_registry import get_derived, set_derived
+from app.utils.grid_utils import get_chunk_shape, read_current_block
+from app.utils.dataset_version import get_dataset_version
+from app.config.main import histogram_min, histogram_max, histogram_ratio, exceedance_thresholds
+
+# How each partial aggregate is merged, and the value of an empty partial
+MERGE_FUNCTIONS = {'count': np.add, 'sum': np.add, 'min': np.fmin, 'max': np.fmax, 'histogram': np.add}
+EMPTY_VALUES = {'count': 0, 'sum': 0.0, 'min': np.nan, 'max': np.nan, 'histogram': 0}
+
+
+def histogram_edges(low, high, ratio, thresholds=()):
+    """
+    Bin edges of the per-chunk histograms.
+    
+    Edges grow geometrically from low to high, so every bin is at most ratio times wider
+    than its lower edge, which bounds the relative error of percentiles. Zero and the
+    exceedance thresholds are edges too, so exceedance fractions at those thresholds are
+    exact.
+    
+    Returns:
+        Sorted NumPy array of edges. Bin i holds the values in (edges[i - 1], edges[i]],
+        the first and last bins hold the values below and above every edge.
+    """
+    count = int(np.ceil(np.log(high / low) / np.log(ratio)))
+    geometric = low * ratio ** np.arange(count + 1)
+    return np.unique(np.concatenate([[0.0], geometric, np.asarray(thresholds, dtype=np.float64)]))
+
+
+HISTOGRAM_EDGES = histogram_edges(histogram_min, histogram_max, histogram_ratio, exceedance_thresholds)
+
+
+def slab_partials(slab, lon_starts):
+    """
+    Compute the partial aggregates of every chunk in a slab of whole chunk rows.
+    
+    Args:
+        slab: 2D NumPy array covering one chunk row (or a single block).
+        lon_starts: Start index of each chunk along the longitude axis of the slab.
+    
+    Returns:
+        Dictionary of count, sum, min and max NumPy arrays, one entry per chunk, and of
+        histogram NumPy arrays, one row of bin counts per chunk. Min and max are NaN for
+        chunks without valid data.
+    """
+    valid = ~np.isnan(slab)
+
+    # Bin of every valid value, offset by the chunk of its column
+    bins = len(HISTOGRAM_EDGES) + 1
+    columns = np.searchsorted(lon_starts, np.arange(slab.shape[1]), side='right') - 1
+    keys = np.searchsorted(HISTOGRAM_EDGES, slab[valid], side='left') + np.broadcast_to(columns, slab.shape)[valid] * bins
+    histogram = np.bincount(keys, minlength=len(lon_starts) * bins).astype(np.uint32).reshape(len(lon_starts), bins)
+
+    return {
+        'count': np.add.reduceat(valid.sum(axis=0, dtype=np.int64), lon_starts),
+        'sum': np.add.reduceat(np.where(valid, slab, 0).sum(axis=0, dtype=np.float64), lon_starts),
+        'min': np.fmin.reduceat(np.fmin.reduce(slab, axis=0), lon_starts),
+        'max': np.fmax.reduceat(np.fmax.reduce(slab, axis=0), lon_starts),
+        'histogram': histogram
+    }
+
+
+def merge_partials(parts):
+    """
+    Merge a list of partial aggregates into a single one.
+    """
+    if not parts:
+        return {name: np.asarray(value) for name, value in EMPTY_VALUES.items()}
+    return {name: merge.reduce([part[name] for part in parts]) for name, merge in MERGE_FUNCTIONS.items()}
+
+
+def coarsen_partials(partials):
+    """
+    Merge every 2x2 block of chunk partials into one, padding odd edges with empty partials.
+    """
+    coarse = {}
+    for name, array in partials.items():
+        rows, cols = array.shape[:2]
+        pad = [(0, rows % 2), (0, cols % 2)] + [(0, 0)] * (array.ndim - 2)
+        padded = np.pad(array, pad, constant_values=EMPTY_VALUES[name])
+        blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2, *array.shape[2:])
+        coarse[name] = MERGE_FUNCTIONS[name].reduce(MERGE_FUNCTIONS[name].reduce(blocks, axis=3), axis=1)
+    return coarse
+
+
+def propagate_partials(levels, rows, cols):
+    """
+    Merge the cells above the given level 0 cells again, up to the top of the pyramid.
+    """
+    cells = set(zip(rows.tolist(), cols.tolist()))
+    for level in range(1, len(levels)):
+        cells = {(row // 2, col // 2) for row, col in cells}
+        for row, col in cells:
+            for name, array in levels[level - 1].items():
+                merge = MERGE_FUNCTIONS[name]
+                children = array[2 * row:2 * row + 2, 2 * col:2 * col + 2]
+                levels[level][name][row, col] = merge.reduce(merge.reduce(children, axis=0), axis=0)
+
+
+def histogram_bounds(minimum, maximum):
+    """
+    Lower and upper bound of every histogram bin, clipped to the range of the values.
+    """
+    lower = np.clip(np.concatenate([[minimum], HISTOGRAM_EDGES]), minimum, maximum)
+    upper = np.clip(np.concatenate([HISTOGRAM_EDGES, [maximum]]), minimum, maximum)
+    return lower, upper
+
+
+def histogram_percentiles(histogram, minimum, maximum, percentiles):
+    """
+    Approximate percentiles from a merged histogram.
+    
+    Values are assumed to be spread evenly inside each bin. The error is bounded by the
+    width of the bin holding the percentile, and the result always lies in [minimum, maximum].
+    
+    Args:
+        histogram: Bin counts.
+        minimum: Smallest value.
+        maximum: Largest value.
+        percentiles: Percentiles to compute, between 0 and 100.
+    
+    Returns:
+        NumPy array of the percentiles, with the linear interpolation of np.percentile.
+    """
+    counts = np.asarray(histogram, dtype=np.int64)
+    total = counts.sum()
+    if total == 0:
+        return np.full(len(percentiles), np.nan)
+
+    cumulative = np.cumsum(counts)
+    ranks = np.asarray(percentiles, dtype=np.float64) / 100 * (total - 1)
+    bins = np.searchsorted(cumulative, ranks, side='right')
+    position = np.clip((ranks - (cumulative[bins] - counts[bins]) + 0.5) / counts[bins], 0, 1)
+    lower, upper = histogram_bounds(minimum, maximum)
+    values = lower[bins] + position * (upper[bins] - lower[bins])
+    # The extremes are known exactly
+    return np.where(ranks <= 0, minimum, np.where(ranks >= total - 1, maximum, values))
+
+
+def histogram_exceedances(histogram, minimum, maximum, thresholds):
+    """
+    Fraction of the values above each threshold, from a merged histogram.
+    
+    Exact for thresholds that are histogram edges, interpolated inside the bin otherwise.
+    
+    Returns:
+        NumPy array of fractions.
+    """
+    counts = np.asarray(histogram, dtype=np.int64)
+    total = counts.sum()
+    if total == 0:
+        return np.full(len(thresholds), np.nan)
+
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    above = np.concatenate([np.cumsum(counts[::-1])[::-1], [0]])  # values in bin i and above
+    bins = np.searchsorted(HISTOGRAM_EDGES, thresholds, side='left')
+    lower, upper = histogram_bounds(minimum, maximum)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(upper[bins] > lower[bins], (upper[bins] - thresholds) / (upper[bins] - lower[bins]), 0)
+    partial = counts[bins] * np.clip(share, 0, 1)
+    return (above[bins + 1] + partial) / total
+
+
+def summarize_partials(partials, dtype, percentiles=None, thresholds=None):
+    """
+    Turn merged partial aggregates into statistics.
+    
+    The mean is not bit-for-bit the one of a reduction over the grid itself: chunk sums
+    are accumulated in float64 and merged in pyramid order, while dask sums in the dtype
+    of the grid, in its own order. Rounded to the dtype of the grid, it differs by about
+    one unit in the last place, e.g. a relative 1e-7 for float32 grids, 1e-16 for float64.
+    
+    Args:
+        partials: Merged count, sum, min, max and histogram.
+        dtype: Data type of the grid.
+        percentiles: Optional percentiles to estimate, between 0 and 100.
+        thresholds: Optional thresholds to estimate the fraction of values above.
+    
+    Returns:
+        A dictionary with the count, mean, min and max of the PM2.5 values, plus the
+        requested percentiles (keyed 'p50', 'p95'...) and exceedance fractions (keyed by
+        threshold).
+    """
+    count = int(partials['count'])
+    mean_pm25 = partials['sum'] / count if count else np.nan
+    if dtype.kind == 'f':
+        # Report the mean at the precision of the grid, like a reduction over it would
+        mean_pm25 = dtype.type(mean_pm25)
+
+    summary = {
+        'count': count,
+        'mean_pm25': float(mean_pm25),
+        'min_pm25': float(partials['min']),
+        'max_pm25': float(partials['max'])
+    }
+    if percentiles:
+        values = histogram_percentiles(partials['histogram'], partials['min'], partials['max'], percentiles)
+        summary['percentiles'] = {f"p{percentile:g}": float(value) for percentile, value in zip(percentiles, values)}
+    if thresholds:
+        fractions = histogram_exceedances(partials['histogram'], partials['min'], partials['max'], thresholds)
+        summary['exceedance'] = {f"{threshold:g}": float(fraction) for threshold, fraction in zip(thresholds, fractions)}
+    return summary
+
+
+def summarize_snapshot(partials, dtype):
+    """
+    Global statistics from a snapshot of per-chunk partial aggregates, see ChunkStatistics.snapshot.
+    
+    Runs as a background job, so it only depends on its picklable arguments.
+    """
+    merged = {
+        name: MERGE_FUNCTIONS[name].reduce(array.reshape(-1, *array.shape[2:]), axis=0)
+        for name, array in partials.items()
+    }
+    return summarize_partials(merged, dtype)
+
+
+class ChunkStatistics:
+    """
+    Pyramid of partial aggregates (count, sum, min, max, histogram) of the PM2.5 grid.
+    
+    Level 0 holds one partial per chunk and every level above merges 2x2 cells of
+    the level below, up to a single cell for the whole grid. Partials are computed
+    once, refreshed chunk by chunk when the grid is written, and merged to answer
+    global and region statistics without scanning the grid.
+    
+    The chunks of a write are applied to the pyramid at once, and their previous
+    partials are kept as long as a snapshot older than the write is pinned, so that
+    readers of that snapshot get statistics as of its version, see DatasetVersion.
+    """
+
+    def __init__(self, ds, chunk_shape):
+        self.versions = get_dataset_version(ds)
+        self.version = self.versions.version  # Latest version applied to the pyramid
+        self._lock = threading.Lock()
+        self._preimages = []  # (version written, rows, cols, level 0 partials before), oldest first
+        self.versions.add_release_hook(self._on_release)
+        self.dtype = ds['GWRPM25'].dtype
+        self.lat_size = ds.sizes['lat']
+        self.lon_size = ds.sizes['lon']
+        self.lat_chunk, self.lon_chunk = chunk_shape
+        self.lon_starts = np.arange(0, self.lon_size, self.lon_chunk)
+        self.shape = (-(-self.lat_size // self.lat_chunk), len(self.lon_starts))
+
+        rows = [
+            slab_partials(read_current_block(ds, self._lat_slice(row), slice(0, self.lon_size)), self.lon_starts)
+            for row in range(self.shape[0])
+        ]
+        base = {name: np.stack([row[name] for row in rows]) for name in MERGE_FUNCTIONS}
+
+        self.levels = [base]
+        while self.levels[-1]['count'].shape != (1, 1):
+            self.levels.append(coarsen_partials(self.levels[-1]))
+
+    def _lat_slice(self, row):
+        start = row * self.lat_chunk
+        return slice(start, min(start + self.lat_chunk, self.lat_size))
+
+    def _lon_slice(self, col):
+        start = col * self.lon_chunk
+        return slice(start, min(start + self.lon_chunk, self.lon_size))
+
+    def refresh_chunks(self, ds, rows, cols, version=None):
+        """
+        Recompute the partial aggregates of chunks from the dataset and propagate them
+        up the pyramid, all at once for readers.
+        
+        Args:
+            ds: The dataset.
+            rows: NumPy array of chunk rows.
+            cols: NumPy array of chunk columns.
+            version: Dataset version being written, to keep the previous partials for
+                readers of older versions. None for writes made by other processes.
+        """
+        fresh = [
+            slab_partials(read_current_block(ds, self._lat_slice(row), self._lon_slice(col)), [0])
+            for row, col in zip(rows.tolist(), cols.tolist())
+        ]
+        with self._lock:
+            base = self.levels[0]
+            if version is not None:
+                self._preimages.append((version, rows, cols, {name: array[rows, cols].copy() for name, array in base.items()}))
+                self.version = version
+            for name, array in base.items():
+                array[rows, cols] = np.stack([partials[name][0] for partials in fresh])
+            propagate_partials(self.levels, rows, cols)
+            self._reclaim()
+
+    def _reclaim(self):
+        # Called with the lock held, drops the pre-images no reader needs anymore
+        oldest = self.versions.oldest_needed()
+        if self._preimages and self._preimages[0][0] <= oldest:
+            self._preimages = [entry for entry in self._preimages if entry[0] > oldest]
+
+    def _on_release(self):
+        with self._lock:
+            self._reclaim()
+
+    def on_write(self, ds, lat_idx, lon_idx, values):
+        # The write is committed once every structure is updated, see DatasetVersion.commit
+        rows, cols = self._chunks_of(lat_idx, lon_idx)
+        self.refresh_chunks(ds, rows, cols, self.versions.version + 1)
+
+    def on_stale(self, ds, lat_idx, lon_idx):
+        rows, cols = self._chunks_of(lat_idx, lon_idx)
+        self.refresh_chunks(ds, rows, cols)
+        self.version = max(self.version, self.versions.version)
+
+    def _chunks_of(self, lat_idx, lon_idx):
+        chunks = np.unique(np.stack([lat_idx // self.lat_chunk, lon_idx // self.lon_chunk]), axis=1)
+        return chunks[0], chunks[1]
+
+    def _read_version(self):
+        snapshot = self.versions.current_snapshot()
+        return snapshot.version if snapshot is not None else None
+
+    def _levels_at(self, version):
+        """
+        The pyramid as of a dataset version, called with the lock held.
+        
+        The live pyramid is returned for the latest version. For an older one, the
+        partials written since are replaced by their pre-images and the pyramid is
+        rebuilt from its base, which only happens while a write overtakes a reader.
+        """
+        preimages = [entry for entry in self._preimages if version is not None and entry[0] > version]
+        if not preimages:
+            return self.levels
+
+        base = {name: array.copy() for name, array in self.levels[0].items()}
+        for _, rows, cols, partials in reversed(preimages):
+            for name, array in base.items():
+                array[rows, cols] = partials[name]
+        levels = [base]
+        while levels[-1]['count'].shape != (1, 1):
+            levels.append(coarsen_partials(levels[-1]))
+        return levels
+
+    def _region_partials(self, levels, row_start, row_stop, col_start, col_stop):
+        """
+        Merge the partials of a rectangle of whole chunks.
+        
+        Unaligned border strips are merged at each level and the aligned interior is
+        handed to the next level up, so the work grows with the perimeter of the
+        rectangle rather than its area.
+        """
+        parts = []
+        for level, partials in enumerate(levels):
+            if row_start >= row_stop or col_start >= col_stop:
+                break
+
+            inner_row_start, inner_row_stop = -(-row_start // 2) * 2, row_stop // 2 * 2
+            inner_col_start, inner_col_stop = -(-col_start // 2) * 2, col_stop // 2 * 2
+            is_top = level == len(levels) - 1
+            if is_top or inner_row_start >= inner_row_stop or inner_col_start >= inner_col_stop:
+                strips = [(row_start, row_stop, col_start, col_stop)]
+            else:
+                strips = [
+                    (row_start, inner_row_start, col_start, col_stop),
+                    (inner_row_stop, row_stop, col_start, col_stop),
+                    (inner_row_start, inner_row_stop, col_start, inner_col_start),
+                    (inner_row_start, inner_row_stop, inner_col_stop, col_stop)
+                ]
+
+            for r0, r1, c0, c1 in strips:
+                if r0 < r1 and c0 < c1:
+                    parts.append({
+                        name: MERGE_FUNCTIONS[name].reduce(array[r0:r1, c0:c1].reshape(-1, *array.shape[2:]), axis=0)
+                        for name, array in partials.items()
+                    })
+
+            if len(strips) == 1:
+                break
+            row_start, row_stop = inner_row_start // 2, inner_row_stop // 2
+            col_start, col_stop = inner_col_start // 2, inner_col_stop // 2
+
+        return parts
+
+    def region_partials(self, ds, lat_slice, lon_slice):
+        """
+        Compute the partial aggregates of a rectangular region of the grid.
+        
+        Chunks fully inside the region are answered from the pyramid. Only the
+        partially covered chunks along the border of the region are read.
+        
+        Args:
+            ds: The dataset.
+            lat_slice: Slice of latitude indices of the region.
+            lon_slice: Slice of longitude indices of the region.
+        
+        Returns:
+            Dictionary with the merged count, sum, min, max and histogram of the region.
+        """
+        lat_start, lat_stop, _ = lat_slice.indices(self.lat_size)
+        lon_start, lon_stop, _ = lon_slice.indices(self.lon_size)
+        if lat_start >= lat_stop or lon_start >= lon_stop:
+            return merge_partials([])
+
+        # Range of chunks fully covered by the region, in chunk units
+        row_start = -(-lat_start // self.lat_chunk)
+        row_stop = self.shape[0] if lat_stop == self.lat_size else lat_stop // self.lat_chunk
+        col_start = -(-lon_start // self.lon_chunk)
+        col_stop = self.shape[1] if lon_stop == self.lon_size else lon_stop // self.lon_chunk
+
+        if row_start >= row_stop or col_start >= col_stop:
+            edges = [(lat_start, lat_stop, lon_start, lon_stop)]
+        else:
+            inner_lat_start = row_start * self.lat_chunk
+            inner_lat_stop = min(row_stop * self.lat_chunk, self.lat_size)
+            inner_lon_start = col_start * self.lon_chunk
+            inner_lon_stop = min(col_stop * self.lon_chunk, self.lon_size)
+            edges = [
+                (lat_start, inner_lat_start, lon_start, lon_stop),
+                (inner_lat_stop, lat_stop, lon_start, lon_stop),
+                (inner_lat_start, inner_lat_stop, lon_start, inner_lon_start),
+                (inner_lat_start, inner_lat_stop, inner_lon_stop, lon_stop)
+            ]
+
+        active = self.versions.current_snapshot()
+        with self._lock:
+            # The border is read at the version of the partials merged, so that both agree
+            snapshot = active or self.versions.pin(ds, self.version)
+            parts = []
+            if row_start < row_stop and col_start < col_stop:
+                parts = self._region_partials(self._levels_at(snapshot.version), row_start, row_stop, col_start, col_stop)
+
+        try:
+            for r0, r1, c0, c1 in edges:
+                if r0 < r1 and c0 < c1:
+                    block = snapshot.read_block(slice(r0, r1), slice(c0, c1))
+                    parts.append({name: value[0] for name, value in slab_partials(block, [0]).items()})
+        finally:
+            if active is None:
+                snapshot.release()
+
+        return merge_partials(parts)
+
+    def summarize(self, partials, percentiles=None, thresholds=None):
+        """
+        Turn merged partial aggregates into statistics, see summarize_partials.
+        """
+        return summarize_partials(partials, self.dtype, percentiles, thresholds)
+
+    def summary(self, percentiles=None, thresholds=None):
+        """
+        Global statistics, read from the top of the pyramid.
+        
+        Like every read of the pyramid, it is made as of the active snapshot of the
+        thread, if any, and as of the latest write otherwise.
+        """
+        with self._lock:
+            top = {name: np.array(array[0, 0]) for name, array in self._levels_at(self._read_version())[-1].items()}
+        return self.summarize(top, percentiles, thresholds)
+
+    def chunk_partials(self, name):
+        """
+        Copy of one of the per-chunk partial aggregates, e.g. the maximum of every chunk.
+        """
+        with self._lock:
+            return self._levels_at(self._read_version())[0][name].copy()
+
+    def snapshot(self):
+        """
+        Copy of the per-chunk partial aggregates, to summarize outside of this process.
+        
+        Returns:
+            tuple: The level 0 partials and the data type of the grid.
+        """
+        with self._lock:
+            return {name: array.copy() for name, array in self._levels_at(self._read_version())[0].items()}, self.dtype
+
+    def region_summary(self, ds, lat_slice, lon_slice, percentiles=None, thresholds=None):
+        """
+        Statistics of a rectangular region of the grid, see region_partials.
+        """
+        return self.summarize(self.region_partials(ds, lat_slice, lon_slice), percentiles, thresholds)
+
+
+def build_chunk_statistics(ds):
+    """
+    Compute the per-chunk partial aggregates of the dataset and register them.
+    
+    Args:
+        ds: The dataset.
+    
+    Returns:
+        ChunkStatistics for the dataset.
+    """
+    stats = ChunkStatistics(ds, get_chunk_shape(ds))
+    logging.info(f"Computed partial statistics for {stats.levels[0]['count'].size} chunks")
+    return set_derived(ds, 'chunk_statistics', stats)
+
+
+def get_chunk_statistics(ds):
+    """
+    Retrieve the per-chunk partial aggregates of the dataset, computing them if needed.
+    """
+    return get_derived(ds, 'chunk_statistics', build_chunk_statistics)
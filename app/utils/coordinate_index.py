@@ -0,0 +1,183 @@
+import numpy as np
+from app.utils.dataset_registry import get_derived, set_derived
+
+
+class AxisIndex:
+    """
+    Nearest-neighbour index over a single coordinate axis.
+    
+    Strictly ascending and strictly descending axes are searched in place with a
+    binary search. Any other axis falls back to a sorted permutation built once.
+    Results always match np.abs(values - x).argmin(), ties included.
+    """
+
+    def __init__(self, values):
+        self.values = np.ascontiguousarray(values, dtype=np.float64)
+        self.size = self.values.size
+
+        steps = np.diff(self.values)
+        if np.all(steps > 0):
+            self.order = 'ascending'
+            self._sorted = self.values
+            self._permutation = None
+        elif np.all(steps < 0):
+            self.order = 'descending'
+            self._sorted = self.values[::-1]
+            self._permutation = None
+        else:
+            self.order = 'irregular'
+            self._permutation = np.argsort(self.values, kind='stable')
+            self._sorted = self.values[self._permutation]
+
+    def _to_original(self, pos):
+        """Map a position in the sorted view back to an index in the original axis."""
+        if self.order == 'ascending':
+            return pos
+        if self.order == 'descending':
+            return self.size - 1 - pos
+        return self._permutation[pos]
+
+    def nearest(self, value):
+        """
+        Find the index of the coordinate closest to the given value.
+        
+        Args:
+            value: Coordinate value to look up.
+        
+        Returns:
+            int: Index in the original axis.
+        """
+        if value != value:
+            return 0
+
+        pos = int(np.searchsorted(self._sorted, value))
+        left = max(pos - 1, 0)
+        right = min(pos, self.size - 1)
+        if self._permutation is not None:
+            # Leftmost entry of a run of duplicates holds the lowest original index
+            left = int(np.searchsorted(self._sorted, self._sorted[left]))
+
+        left_idx = int(self._to_original(left))
+        right_idx = int(self._to_original(right))
+        left_dist = abs(self.values[left_idx] - value)
+        right_dist = abs(self.values[right_idx] - value)
+        if left_dist < right_dist or (left_dist == right_dist and left_idx <= right_idx):
+            return left_idx
+        return right_idx
+
+    def nearest_many(self, values):
+        """
+        Vectorized version of nearest.
+        
+        Args:
+            values: Array of coordinate values to look up.
+        
+        Returns:
+            NumPy array of indices in the original axis.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        pos = np.searchsorted(self._sorted, values)
+        left = np.clip(pos - 1, 0, self.size - 1)
+        right = np.clip(pos, 0, self.size - 1)
+        if self._permutation is not None:
+            left = np.searchsorted(self._sorted, self._sorted[left])
+
+        left_idx = self._to_original(left)
+        right_idx = self._to_original(right)
+        left_dist = np.abs(self.values[left_idx] - values)
+        right_dist = np.abs(self.values[right_idx] - values)
+        pick_left = (left_dist < right_dist) | ((left_dist == right_dist) & (left_idx <= right_idx))
+        result = np.where(pick_left, left_idx, right_idx)
+        result[np.isnan(values)] = 0
+        return result
+
+
+    def index_range(self, low, high):
+        """
+        Find the contiguous range of indices whose coordinate lies within [low, high].
+        
+        Args:
+            low: Lower coordinate bound (inclusive).
+            high: Upper coordinate bound (inclusive).
+        
+        Returns:
+            slice of indices in the original axis (possibly empty).
+        
+        Raises:
+            ValueError: If the axis is not monotonic.
+        """
+        if self.order == 'irregular':
+            raise ValueError('Range queries require a monotonic coordinate axis')
+
+        start = int(np.searchsorted(self._sorted, low, side='left'))
+        stop = int(np.searchsorted(self._sorted, high, side='right'))
+        if stop <= start:
+            return slice(0, 0)
+        if self.order == 'descending':
+            start, stop = self.size - stop, self.size - start
+        return slice(start, stop)
+
+
+class CoordinateIndex:
+    """
+    Latitude/longitude lookup structure built once per dataset.
+    """
+
+    def __init__(self, lat_values, lon_values):
+        self.lat = AxisIndex(lat_values)
+        self.lon = AxisIndex(lon_values)
+
+    def nearest(self, lat, lon):
+        """
+        Find the grid indices closest to a latitude/longitude pair.
+        
+        Returns:
+            tuple: (lat_idx, lon_idx).
+        """
+        return self.lat.nearest(lat), self.lon.nearest(lon)
+
+    def nearest_many(self, lats, lons):
+        """
+        Find the grid indices closest to each latitude/longitude pair.
+        
+        Returns:
+            tuple: (lat_idx, lon_idx) NumPy arrays.
+        """
+        return self.lat.nearest_many(lats), self.lon.nearest_many(lons)
+
+
+    def bbox_slices(self, bbox):
+        """
+        Convert a bounding box into index slices.
+        
+        Args:
+            bbox: Dictionary with lat_min, lat_max, lon_min and lon_max.
+        
+        Returns:
+            tuple: (lat_slice, lon_slice).
+        """
+        return (
+            self.lat.index_range(bbox['lat_min'], bbox['lat_max']),
+            self.lon.index_range(bbox['lon_min'], bbox['lon_max'])
+        )
+
+
+def build_coordinate_index(ds):
+    """
+    Build the coordinate index of the dataset and register it.
+    
+    Args:
+        ds: The dataset.
+    
+    Returns:
+        CoordinateIndex for the dataset.
+    """
+    index = CoordinateIndex(ds['lat'].values, ds['lon'].values)
+    return set_derived(ds, 'coordinate_index', index)
+
+
+def get_coordinate_index(ds):
+    """
+    Retrieve the coordinate index of the dataset, building it if needed.
+    """
+    return get_derived(ds, 'coordinate_index', build_coordinate_index)
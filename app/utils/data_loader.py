@@ -1,11 +1,42 @@
-import xarray as xr
+import os
 import logging
+from app.utils.coordinate_index import build_coordinate_index
+from app.utils.chunk_statistics import build_chunk_statistics
+from app.utils.valid_index import build_valid_index
+from app.utils.chunk_cache import build_chunk_cache
+from app.utils.persistence import replay_write_ahead_log
+from app.utils.overviews import load_overviews
+from app.utils.time_series import load_yearly_data
+from app.utils.metrics import open_metered_dataset, register_dask_metrics, startup_phase
+from app.config.main import chunk_cache_max_bytes, year_views_max
 
-def load_dataset(data_set_location):
+def load_dataset(data_set_location, wal_directory=None):
     try:
-        ds = xr.open_zarr(data_set_location, chunks={'lat': 100, 'lon': 100})
+        register_dask_metrics()
+        with startup_phase('open_store'):
+            if not os.path.exists(os.path.join(data_set_location, '.zmetadata')):
+                logging.warning(f"{data_set_location} has no consolidated metadata, run zarr.consolidate_metadata on it to open it faster")
+            # Dask chunks follow the chunks of the store, whatever it was converted with
+            ds = open_metered_dataset(data_set_location, chunks={})
         if ds is None:
             raise ValueError("Failed to load dataset.")
+        # Coordinates, indexes and summaries are all built here, so that with preload_app
+        # the gunicorn master builds them once and the workers share them
+        with startup_phase('coordinate_index'):
+            build_coordinate_index(ds)
+        if chunk_cache_max_bytes:
+            build_chunk_cache(ds, chunk_cache_max_bytes)
+        with startup_phase('overviews'):
+            load_overviews(ds, data_set_location)
+        with startup_phase('yearly_data'):
+            load_yearly_data(ds, data_set_location, year_views_max)
+        if wal_directory:
+            with startup_phase('wal_replay'):
+                replay_write_ahead_log(ds, wal_directory)
+        with startup_phase('chunk_statistics'):
+            build_chunk_statistics(ds)
+        with startup_phase('valid_index'):
+            build_valid_index(ds)
         return ds
     except Exception as e:
         logging.error(f"Error loading dataset: {e}")
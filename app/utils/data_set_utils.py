@@ -1,31 +1,52 @@
 import logging
 import numpy as np
-import dask
+from app.utils.coordinate_index import get_coordinate_index
+from app.utils.grid_utils import (
+    get_row_slabs, group_by_chunk, read_current_block, read_pm25_block, read_pm25_value, write_pm25_blocks,
+    write_through_cache
+)
+from app.utils.chunk_statistics import get_chunk_statistics
+from app.utils.dataset_registry import notify_before_write, notify_write
+from app.utils.dataset_version import get_dataset_version
+from app.utils.valid_index import get_valid_index
 
-def calculate_pm25_statistics(ds):
+def calculate_pm25_statistics(ds, percentiles=None, thresholds=None):
     """
-    Calculate PM2.5 statistics (count, mean, min, max) using Dask.
+    Calculate PM2.5 statistics (count, mean, min, max) from the per-chunk partial aggregates.
+    
+    The partials are computed once with Dask and kept up to date by update_pm25_value,
+    so this only merges one entry per chunk. Percentiles and exceedance fractions are
+    estimated from the merged per-chunk histograms.
     
     Args:
         ds: The dataset containing PM2.5 data.
+        percentiles: Optional list of percentiles to estimate, between 0 and 100.
+        thresholds: Optional list of thresholds to estimate the fraction of values above.
         
     Returns:
         A dictionary with the calculated statistics.
     """
-    pm25_da = ds['GWRPM25']
-    count, mean_pm25, min_pm25, max_pm25 = dask.compute(
-        pm25_da.count(), 
-        pm25_da.mean(), 
-        pm25_da.min(), 
-        pm25_da.max()
-    )
+    return get_chunk_statistics(ds).summary(percentiles, thresholds)
+
+
+def calculate_region_statistics(ds, bbox, percentiles=None, thresholds=None):
+    """
+    Calculate PM2.5 statistics (count, mean, min, max) inside a bounding box.
+    
+    Chunks fully inside the box are answered from the precomputed summaries, and only
+    the partially covered chunks on its border are read.
     
-    return {
-        'count': int(count),
-        'mean_pm25': float(mean_pm25),
-        'min_pm25': float(min_pm25),
-        'max_pm25': float(max_pm25)
-    }
+    Args:
+        ds: The dataset containing PM2.5 data.
+        bbox: Dictionary with lat_min, lat_max, lon_min and lon_max.
+        percentiles: Optional list of percentiles to estimate, between 0 and 100.
+        thresholds: Optional list of thresholds to estimate the fraction of values above.
+        
+    Returns:
+        A dictionary with the calculated statistics.
+    """
+    lat_slice, lon_slice = get_coordinate_index(ds).bbox_slices(bbox)
+    return get_chunk_statistics(ds).region_summary(ds, lat_slice, lon_slice, percentiles, thresholds)
 
 def get_lat_lon_indices(id, ds):
     """
@@ -52,9 +73,10 @@ def get_data_entry(index, ds):
 
         lat_idx, lon_idx = get_lat_lon_indices(index, ds)
 
-        lat_value = ds['lat'].isel(lat=lat_idx).values.item()
-        lon_value = ds['lon'].isel(lon=lon_idx).values.item()
-        pm25_value = ds['GWRPM25'].isel(lat=lat_idx, lon=lon_idx).values.item()
+        coord_index = get_coordinate_index(ds)
+        lat_value = coord_index.lat.values[lat_idx]
+        lon_value = coord_index.lon.values[lon_idx]
+        pm25_value = read_pm25_value(ds, lat_idx, lon_idx)
 
         pm25_value = float(pm25_value) if not np.isnan(pm25_value) else None
 
@@ -81,22 +103,119 @@ def get_pm25_at_lat_lon(ds, lat_idx, lon_idx):
     Returns:
         PM2.5 value (None if NaN).
     """
-    pm25_value = ds['GWRPM25'].isel(lat=lat_idx, lon=lon_idx).values.item()
+    pm25_value = read_pm25_value(ds, lat_idx, lon_idx)
     return float(pm25_value) if not np.isnan(pm25_value) else None
 
+def get_pm25_at_indices(ds, lat_idx, lon_idx):
+    """
+    Retrieve PM2.5 values for many grid points, reading each chunk only once.
+    
+    Args:
+        ds: The dataset.
+        lat_idx: NumPy array of latitude indices.
+        lon_idx: NumPy array of longitude indices.
+    
+    Returns:
+        NumPy array of PM2.5 values (NaN for missing data), in input order.
+    """
+    values = np.empty(len(lat_idx), dtype=np.float64)
+    for lat_slice, lon_slice, positions in group_by_chunk(ds, lat_idx, lon_idx):
+        block = read_pm25_block(ds, lat_slice, lon_slice)
+        values[positions] = block[lat_idx[positions] - lat_slice.start, lon_idx[positions] - lon_slice.start]
+    return values
+
+
 def update_pm25_value(ds, lat_idx, lon_idx, pm25):
-    ds['GWRPM25'][lat_idx, lon_idx] = pm25
+    # Written points are recorded, in the write-ahead log for one, before the grid changes
+    points = np.array([lat_idx]), np.array([lon_idx]), np.array([pm25], dtype=np.float64)
+    notify_before_write(ds, *points)
+
+    versions = get_dataset_version(ds)
+    lat_slice, lon_slice = slice(lat_idx, lat_idx + 1), slice(lon_idx, lon_idx + 1)
+    versions.preserve(lat_slice, lon_slice, read_current_block(ds, lat_slice, lon_slice))
+
+    write_pm25_blocks(ds, [(lat_slice, lon_slice, pm25)])
     ds['GWRPM25'].isel(lat=lat_idx, lon=lon_idx).load()
 
+    lat_idx, lon_idx, values = points
+    write_through_cache(ds, lat_idx, lon_idx, values)
+    notify_write(ds, lat_idx, lon_idx, values)
+    versions.commit(lat_idx, lon_idx)
+
+
+def update_pm25_values(ds, lat_idx, lon_idx, values):
+    """
+    Update the PM2.5 values of many grid points, with a single assignment for the batch.
+    
+    When a grid point appears several times, the last value wins. Readers see either
+    none or all of the batch, see DatasetVersion. The batch is recorded, in the
+    write-ahead log for one, before the grid changes, and is not applied if that fails.
+    
+    Args:
+        ds: The dataset.
+        lat_idx: NumPy array of latitude indices.
+        lon_idx: NumPy array of longitude indices.
+        values: NumPy array of PM2.5 values.
+    """
+    flat_ids = lat_idx * ds.sizes['lon'] + lon_idx
+    _, last = np.unique(flat_ids[::-1], return_index=True)
+    keep = np.sort(len(flat_ids) - 1 - last)
+    lat_idx, lon_idx, values = lat_idx[keep], lon_idx[keep], values[keep]
+    notify_before_write(ds, lat_idx, lon_idx, values)
+
+    versions = get_dataset_version(ds)
+    blocks = []
+    for lat_slice, lon_slice, positions in group_by_chunk(ds, lat_idx, lon_idx):
+        block = np.array(read_current_block(ds, lat_slice, lon_slice))
+        versions.preserve(lat_slice, lon_slice, block)
+        block[lat_idx[positions] - lat_slice.start, lon_idx[positions] - lon_slice.start] = values[positions]
+        blocks.append((lat_slice, lon_slice, block))
+    write_pm25_blocks(ds, blocks)
+
+    write_through_cache(ds, lat_idx, lon_idx, values)
+    notify_write(ds, lat_idx, lon_idx, values)
+    versions.commit(lat_idx, lon_idx)
+
 
 def is_valid_id(id, ds):
     total_points = ds.sizes['lat'] * ds.sizes['lon']
     return 0 <= id < total_points
 
+def build_data_entries(ids, lat_values, lon_values, pm25_values):
+    """
+    Build data entries from aligned NumPy arrays, in the same format as get_data_entry.
+    
+    Args:
+        ids: Iterable of flat indices.
+        lat_values: Latitude of each entry.
+        lon_values: Longitude of each entry.
+        pm25_values: PM2.5 value of each entry (NaN for missing data).
+    
+    Returns:
+        List of data entries.
+    """
+    lat_list = np.asarray(lat_values, dtype=np.float64).tolist()
+    lon_list = np.asarray(lon_values, dtype=np.float64).tolist()
+    pm25_list = np.asarray(pm25_values, dtype=np.float64).tolist()
+
+    return [
+        {
+            'id': int(index),
+            'lat': lat,
+            'lon': lon,
+            'pm25': pm25 if pm25 == pm25 else None
+        }
+        for index, lat, lon, pm25 in zip(ids, lat_list, lon_list, pm25_list)
+    ]
+
+
 def paginate_data(ds, page, per_page):
     """
     Paginate data from the dataset.
     
+    The requested range is read as a few contiguous row slabs, each with a single
+    indexing operation, instead of one lookup per entry.
+    
     Args:
         ds: The dataset.
         page: Page number.
@@ -109,13 +228,171 @@ def paginate_data(ds, page, per_page):
     end = start + per_page
 
     total_points = ds.sizes['lat'] * ds.sizes['lon']
-    if start >= total_points:
+    start = max(start, 0)
+    end = min(end, total_points)
+    if start >= end:
         return []
 
-    data = []
-    for idx in range(start, min(end, total_points)):
-        entry = get_data_entry(idx, ds)
-        if entry is not None:
-            data.append(entry)
-    return data
+    lon_size = ds.sizes['lon']
+    coord_index = get_coordinate_index(ds)
+    lat_coords = coord_index.lat.values
+    lon_coords = coord_index.lon.values
+
+    lat_parts, lon_parts, pm25_parts = [], [], []
+    for lat_slice, lon_slice in get_row_slabs(start, end, lon_size):
+        block = read_pm25_block(ds, lat_slice, lon_slice)
+        rows, cols = block.shape
+        lat_parts.append(np.repeat(lat_coords[lat_slice], cols))
+        lon_parts.append(np.tile(lon_coords[lon_slice], rows))
+        pm25_parts.append(block.ravel())
+
+    return build_data_entries(
+        range(start, end),
+        np.concatenate(lat_parts),
+        np.concatenate(lon_parts),
+        np.concatenate(pm25_parts)
+    )
+
+
+def paginate_valid_data(ds, per_page, after=None):
+    """
+    Paginate the data entries holding a PM2.5 value, skipping the missing ones.
+    
+    The IDs of the page are looked up in the valid cell index, so a page costs the same
+    wherever it is in the grid.
+    
+    Args:
+        ds: The dataset.
+        per_page: Number of entries per page.
+        after: Optional ID of the last entry already returned, to resume from.
+    
+    Returns:
+        tuple: (entries, last_id) where last_id is the ID to resume from, or None on the
+        last page.
+    """
+    ids = get_valid_index(ds).ids_after(after, per_page + 1)
+    last_id = int(ids[per_page - 1]) if ids.size > per_page else None
+    ids = ids[:per_page]
+
+    lat_idx, lon_idx = np.divmod(ids, ds.sizes['lon'])
+    pm25_values = get_pm25_at_indices(ds, lat_idx, lon_idx)
+    # Points deleted since the snapshot was pinned may have been dropped from the index already
+    valid = ~np.isnan(pm25_values)
+    coord_index = get_coordinate_index(ds)
+    entries = build_data_entries(
+        ids[valid],
+        coord_index.lat.values[lat_idx[valid]],
+        coord_index.lon.values[lon_idx[valid]],
+        pm25_values[valid]
+    )
+    return entries, last_id
+
+
+def get_page_slices(ds, page, per_page):
+    """
+    Get the block of the grid holding a page of data entries, see paginate_data.
+    
+    Returns:
+        tuple: (lat_slice, lon_slice), empty for a page past the end.
+    """
+    lon_size = ds.sizes['lon']
+    start = min(max((page - 1) * per_page, 0), ds.sizes['lat'] * lon_size)
+    end = min(max(start + per_page, start), ds.sizes['lat'] * lon_size)
+    if start >= end:
+        return slice(0, 0), slice(0, 0)
+    first_row, last_row = start // lon_size, (end - 1) // lon_size
+    if first_row == last_row:
+        return slice(first_row, first_row + 1), slice(start % lon_size, (end - 1) % lon_size + 1)
+    return slice(first_row, last_row + 1), slice(0, lon_size)
+
+
+def iter_exceedances(ds, threshold, lat_slice, lon_slice, after=None):
+    """
+    Iterate over the grid points whose PM2.5 value exceeds a threshold, chunk by chunk.
+    
+    Chunks whose maximum, taken from the per-chunk zone maps, does not exceed the
+    threshold are skipped without being read. Points are yielded in chunk order, and
+    in row-major order within each chunk.
+    
+    Args:
+        ds: The dataset.
+        threshold: PM2.5 value that must be strictly exceeded.
+        lat_slice: Slice of latitude indices to search.
+        lon_slice: Slice of longitude indices to search.
+        after: Optional ID of the last point already returned, to resume a search.
+    
+    Yields:
+        tuple: (lat_idx, lon_idx, pm25) NumPy arrays for the matches of each chunk.
+    """
+    stats = get_chunk_statistics(ds)
+    lat_chunk, lon_chunk = stats.lat_chunk, stats.lon_chunk
+    lat_start, lat_stop, _ = lat_slice.indices(ds.sizes['lat'])
+    lon_start, lon_stop, _ = lon_slice.indices(ds.sizes['lon'])
+    if lat_start >= lat_stop or lon_start >= lon_stop:
+        return
+
+    row_start, col_start = lat_start // lat_chunk, lon_start // lon_chunk
+    zone_max = stats.chunk_partials('max')[row_start:-(-lat_stop // lat_chunk), col_start:-(-lon_stop // lon_chunk)]
+
+    after_chunk = None
+    if after is not None:
+        after_lat, after_lon = get_lat_lon_indices(after, ds)
+        after_chunk = (after_lat // lat_chunk, after_lon // lon_chunk)
+
+    for row, col in zip(*np.nonzero(zone_max > threshold)):
+        chunk = (int(row) + row_start, int(col) + col_start)
+        if after_chunk is not None and chunk < after_chunk:
+            continue
+
+        block_lat = slice(max(chunk[0] * lat_chunk, lat_start), min((chunk[0] + 1) * lat_chunk, lat_stop))
+        block_lon = slice(max(chunk[1] * lon_chunk, lon_start), min((chunk[1] + 1) * lon_chunk, lon_stop))
+        block = read_pm25_block(ds, block_lat, block_lon)
+
+        rows, cols = np.nonzero(block > threshold)
+        lat_idx = rows + block_lat.start
+        lon_idx = cols + block_lon.start
+        values = block[rows, cols]
+
+        if chunk == after_chunk:
+            keep = (lat_idx > after_lat) | ((lat_idx == after_lat) & (lon_idx > after_lon))
+            lat_idx, lon_idx, values = lat_idx[keep], lon_idx[keep], values[keep]
+
+        if values.size:
+            yield lat_idx, lon_idx, values
+
+
+def search_exceedances(ds, threshold, lat_slice, lon_slice, limit, after=None):
+    """
+    Find grid points whose PM2.5 value exceeds a threshold, see iter_exceedances.
+    
+    Args:
+        ds: The dataset.
+        threshold: PM2.5 value that must be strictly exceeded.
+        lat_slice: Slice of latitude indices to search.
+        lon_slice: Slice of longitude indices to search.
+        limit: Maximum number of entries to return.
+        after: Optional ID of the last point already returned, to resume a search.
+    
+    Returns:
+        tuple: (entries, last_id) where last_id is the ID to resume from, or None when
+        no hit is left after the entries returned.
+    """
+    coord_index = get_coordinate_index(ds)
+    lon_size = ds.sizes['lon']
+    entries = []
+
+    for lat_idx, lon_idx, values in iter_exceedances(ds, threshold, lat_slice, lon_slice, after):
+        if len(entries) == limit:
+            # One more hit past the page, so the search is not exhausted
+            return entries, entries[-1]['id']
+        remaining = limit - len(entries)
+        entries.extend(build_data_entries(
+            (lat_idx[:remaining] * lon_size + lon_idx[:remaining]).tolist(),
+            coord_index.lat.values[lat_idx[:remaining]],
+            coord_index.lon.values[lon_idx[:remaining]],
+            values[:remaining]
+        ))
+        if lat_idx.size > remaining:
+            return entries, entries[-1]['id']
 
+    return entries, None
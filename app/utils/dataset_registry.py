@@ -0,0 +1,111 @@
+import weakref
+
+# Structures derived from a dataset (indexes, summaries...), keyed by the id of the dataset.
+# Entries are dropped automatically when the dataset is garbage collected.
+_registry = {}
+
+
+def get_derived(ds, name, builder=None):
+    """
+    Retrieve a structure derived from the dataset, building it on first use.
+    
+    Args:
+        ds: The dataset the structure was derived from.
+        name: Name of the derived structure.
+        builder: Optional callable taking the dataset and returning the structure.
+            If omitted, None is returned when the structure has not been built yet.
+    
+    Returns:
+        The derived structure, or None.
+    """
+    entries = _registry.get(id(ds))
+    if entries is not None and name in entries:
+        return entries[name]
+    if builder is None:
+        return None
+    return set_derived(ds, name, builder(ds))
+
+
+def set_derived(ds, name, value):
+    """
+    Register a structure derived from the dataset, replacing any previous one.
+    
+    Args:
+        ds: The dataset the structure was derived from.
+        name: Name of the derived structure.
+        value: The derived structure.
+    
+    Returns:
+        The registered structure.
+    """
+    key = id(ds)
+    entries = _registry.get(key)
+    if entries is None:
+        entries = _registry[key] = {}
+        weakref.finalize(ds, _registry.pop, key, None)
+    entries[name] = value
+    return value
+
+
+def notify_before_write(ds, lat_idx, lon_idx, values):
+    """
+    Let every structure derived from the dataset record a write before it is applied.
+    
+    Structures opt in by implementing a before_write(ds, lat_idx, lon_idx, values)
+    method. If one of them raises, the write is abandoned before anything changed.
+    
+    Args:
+        ds: The dataset about to be written.
+        lat_idx: NumPy array of latitude indices written.
+        lon_idx: NumPy array of longitude indices written.
+        values: NumPy array of the values written.
+    """
+    entries = _registry.get(id(ds))
+    if not entries:
+        return
+    for value in list(entries.values()):
+        before_write = getattr(value, 'before_write', None)
+        if before_write is not None:
+            before_write(ds, lat_idx, lon_idx, values)
+
+
+def notify_write(ds, lat_idx, lon_idx, values):
+    """
+    Let every structure derived from the dataset react to a write.
+    
+    Structures opt in by implementing an on_write(ds, lat_idx, lon_idx, values) method.
+    
+    Args:
+        ds: The dataset that was written.
+        lat_idx: NumPy array of latitude indices written.
+        lon_idx: NumPy array of longitude indices written.
+        values: NumPy array of the values written.
+    """
+    entries = _registry.get(id(ds))
+    if not entries:
+        return
+    for value in list(entries.values()):
+        on_write = getattr(value, 'on_write', None)
+        if on_write is not None:
+            on_write(ds, lat_idx, lon_idx, values)
+
+
+def notify_stale(ds, lat_idx, lon_idx):
+    """
+    Let every structure derived from the dataset refresh the chunks holding the given
+    grid points, after they were written by another process sharing the same grid.
+    
+    Structures opt in by implementing an on_stale(ds, lat_idx, lon_idx) method.
+    
+    Args:
+        ds: The dataset that was written.
+        lat_idx: NumPy array of latitude indices, one per stale chunk.
+        lon_idx: NumPy array of longitude indices, one per stale chunk.
+    """
+    entries = _registry.get(id(ds))
+    if not entries:
+        return
+    for value in list(entries.values()):
+        on_stale = getattr(value, 'on_stale', None)
+        if on_stale is not None:
+            on_stale(ds, lat_idx, lon_idx)
@@ -0,0 +1,263 @@
+import os
+import threading
+from collections import Counter
+import numpy as np
+from app.utils.dataset_registry import get_derived
+from app.utils.grid_utils import get_chunk_shape, read_current_block
+
+
+class Snapshot:
+    """
+    Consistent view of the PM2.5 grid at a dataset version, see DatasetVersion.pin.
+    
+    Used as a context manager, the snapshot is also made the active one of the thread,
+    so that every read_pm25_block of the dataset made inside the block reads it. It is
+    released when the block exits, or by calling release.
+    """
+
+    def __init__(self, versions, ds, version):
+        self.versions = versions
+        self.ds = ds
+        self.version = version
+        self._released = False
+
+    def read_block(self, lat_slice, lon_slice):
+        """
+        Read a rectangular block of PM2.5 values as of the snapshot.
+        
+        Returns:
+            2D NumPy array owned by the caller.
+        """
+        lat_slice = slice(*lat_slice.indices(self.ds.sizes['lat'])[:2])
+        lon_slice = slice(*lon_slice.indices(self.ds.sizes['lon'])[:2])
+        # The pre-images must be looked up after the read, see DatasetVersion.preserve
+        block = read_current_block(self.ds, lat_slice, lon_slice)
+        return self.versions.overlay(self.version, lat_slice, lon_slice, block)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.versions.release(self.version)
+
+    def __enter__(self):
+        self.versions._active_snapshots().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.versions._active_snapshots().remove(self)
+        self.release()
+
+
+class DatasetVersion:
+    """
+    Version counters of the dataset, bumped on every write, and snapshots of the grid.
+    
+    The dataset version changes whenever any grid point is written, and the version
+    of a chunk whenever one of its grid points is.
+    
+    Writes are copy-on-write: before a block of the grid is written, its current
+    values are kept as a pre-image tagged with the version being written. A reader
+    pins the version it starts at, reads the grid without any lock, and replaces the
+    values written after that version by the oldest pre-image covering them, so it
+    sees the grid exactly as it was, however long it runs. Pre-images are dropped once
+    no pinned reader is older than them.
+    
+    Versions restart at 0 with the process, and diverge between forked workers, so
+    they are qualified by a random epoch of the process when handed to clients, see etag.
+    """
+
+    def __init__(self, ds, chunk_shape):
+        self.lat_size, self.lon_size = ds.sizes['lat'], ds.sizes['lon']
+        self.lat_chunk, self.lon_chunk = chunk_shape
+        shape = (-(-self.lat_size // self.lat_chunk), -(-self.lon_size // self.lon_chunk))
+        self._epoch = None
+        self._epoch_pid = None
+        self.version = 0
+        self.chunk_versions = np.zeros(shape, dtype=np.int64)
+        self._lock = threading.Lock()
+        self._pins = Counter()  # pinned version -> number of readers
+        self._preimages = []  # (version written, lat_slice, lon_slice, values before), oldest first
+        self._local = threading.local()
+        self._release_hooks = []
+
+    def preserve(self, lat_slice, lon_slice, block):
+        """
+        Keep the values of a block about to be written, called by the writer before it
+        writes and before it commits.
+        
+        Args:
+            lat_slice: Slice of latitude indices of the block.
+            lon_slice: Slice of longitude indices of the block.
+            block: 2D NumPy array with the current values of the block, copied.
+        """
+        with self._lock:
+            self._preimages.append((self.version + 1, lat_slice, lon_slice, np.array(block)))
+
+    def commit(self, lat_idx, lon_idx):
+        """
+        Publish a write, once the grid and the structures derived from it are updated.
+        
+        Args:
+            lat_idx: NumPy array of latitude indices written.
+            lon_idx: NumPy array of longitude indices written.
+        """
+        with self._lock:
+            self.version += 1
+            self.chunk_versions[lat_idx // self.lat_chunk, lon_idx // self.lon_chunk] = self.version
+            self._reclaim()
+
+    def on_stale(self, ds, lat_idx, lon_idx):
+        # Written by another process sharing the grid, without pre-images
+        with self._lock:
+            self.version += 1
+            self.chunk_versions[lat_idx // self.lat_chunk, lon_idx // self.lon_chunk] = self.version
+
+    def region_chunks(self, lat_slice, lon_slice):
+        """
+        Ranges of the chunks holding a rectangular block of the grid.
+        
+        Returns:
+            tuple: (rows, cols) ranges of chunk indices.
+        """
+        lat_start, lat_stop, _ = lat_slice.indices(self.lat_size)
+        lon_start, lon_stop, _ = lon_slice.indices(self.lon_size)
+        return (
+            range(lat_start // self.lat_chunk, -(-lat_stop // self.lat_chunk)),
+            range(lon_start // self.lon_chunk, -(-lon_stop // self.lon_chunk))
+        )
+
+    def region_version(self, lat_slice, lon_slice):
+        """
+        Latest version that wrote any chunk holding a rectangular block of the grid, 0 if
+        none was written.
+        """
+        rows, cols = self.region_chunks(lat_slice, lon_slice)
+        with self._lock:
+            region = self.chunk_versions[rows.start:rows.stop, cols.start:cols.stop]
+            return int(region.max()) if region.size else 0
+
+    def etag(self, version):
+        """
+        Entity tag of the responses read at a version, unique across restarts.
+        """
+        # Workers forked from a master that built the versions get an epoch of their own
+        if self._epoch_pid != os.getpid():
+            self._epoch, self._epoch_pid = os.urandom(4).hex(), os.getpid()
+        return f"{self._epoch}-{version}"
+
+    def oldest_needed(self):
+        """
+        Oldest version a reader may still read, pinned or current.
+        """
+        with self._lock:
+            return self._oldest_needed()
+
+    def _oldest_needed(self):
+        return min(min(self._pins, default=self.version), self.version)
+
+    def _reclaim(self):
+        oldest = self._oldest_needed()
+        if self._preimages and self._preimages[0][0] <= oldest:
+            self._preimages = [entry for entry in self._preimages if entry[0] > oldest]
+
+    def pin(self, ds, version=None):
+        """
+        Pin a snapshot of the grid, to be released once read.
+        
+        Args:
+            ds: The dataset.
+            version: Version to pin, the current one by default. Older versions can only
+                be pinned while a reader still holds them.
+        
+        Returns:
+            Snapshot of the grid.
+        """
+        with self._lock:
+            version = self.version if version is None else version
+            self._pins[version] += 1
+        return Snapshot(self, ds, version)
+
+    def release(self, version):
+        with self._lock:
+            self._pins[version] -= 1
+            if not self._pins[version]:
+                del self._pins[version]
+            self._reclaim()
+        # Called without the lock held, hooks may read the pins
+        for hook in list(self._release_hooks):
+            hook()
+
+    def add_release_hook(self, hook):
+        """
+        Call a function whenever a snapshot is released, for structures keeping their own
+        pre-images to reclaim them.
+        """
+        self._release_hooks.append(hook)
+
+    def _active_snapshots(self):
+        if not hasattr(self._local, 'snapshots'):
+            self._local.snapshots = []
+        return self._local.snapshots
+
+    def current_snapshot(self):
+        """
+        Snapshot made active by the calling thread, or None.
+        """
+        snapshots = getattr(self._local, 'snapshots', None)
+        return snapshots[-1] if snapshots else None
+
+    def overlay(self, version, lat_slice, lon_slice, block):
+        """
+        Bring a block read from the current grid back to a version, see Snapshot.read_block.
+        """
+        with self._lock:
+            preimages = [
+                entry for entry in self._preimages
+                if entry[0] > version
+                and entry[1].start < lat_slice.stop and lat_slice.start < entry[1].stop
+                and entry[2].start < lon_slice.stop and lon_slice.start < entry[2].stop
+            ]
+        if not preimages:
+            return block
+
+        block = np.array(block)
+        # The oldest pre-image written after the version holds the value at that version
+        for _, lat_written, lon_written, values in reversed(preimages):
+            r0, r1 = max(lat_slice.start, lat_written.start), min(lat_slice.stop, lat_written.stop)
+            c0, c1 = max(lon_slice.start, lon_written.start), min(lon_slice.stop, lon_written.stop)
+            block[r0 - lat_slice.start:r1 - lat_slice.start, c0 - lon_slice.start:c1 - lon_slice.start] = (
+                values[r0 - lat_written.start:r1 - lat_written.start, c0 - lon_written.start:c1 - lon_written.start]
+            )
+        return block
+
+    def stats(self):
+        """
+        Counters of the snapshots.
+        
+        Returns:
+            A dictionary with the current version, the number of pinned readers and the
+            number and size of the pre-images held.
+        """
+        with self._lock:
+            return {
+                'version': self.version,
+                'pinned': sum(self._pins.values()),
+                'preimages': len(self._preimages),
+                'preimage_bytes': sum(entry[3].nbytes for entry in self._preimages)
+            }
+
+
+def get_dataset_version(ds):
+    """
+    Retrieve the version counters of the dataset, starting them if needed.
+    """
+    return get_derived(ds, 'dataset_version', lambda ds: DatasetVersion(ds, get_chunk_shape(ds)))
+
+
+def pin_snapshot(ds):
+    """
+    Pin a snapshot of the dataset at its current version, see DatasetVersion.pin.
+    
+    Use it as a context manager so that reads made inside the block see the snapshot.
+    """
+    return get_dataset_version(ds).pin(ds)
@@ -0,0 +1,111 @@
+import io
+import json
+import numpy as np
+from app.utils.coordinate_index import get_coordinate_index
+from app.utils.data_set_utils import build_data_entries
+from app.utils.dataset_version import get_dataset_version
+from app.utils.grid_utils import chunk_aligned_slices, get_chunk_shape
+
+
+def iter_chunk_records(ds, lat_slice, lon_slice, skip_nan=False):
+    """
+    Walk a region of the grid chunk by chunk.
+    
+    Only one chunk is held in memory at a time. Records are yielded in chunk order,
+    and in row-major order within each chunk. The whole walk reads a snapshot of the
+    grid pinned when it starts, so writes made meanwhile are not exported.
+    
+    Args:
+        ds: The dataset.
+        lat_slice: Slice of latitude indices to export.
+        lon_slice: Slice of longitude indices to export.
+        skip_nan: Whether to leave out grid points without data.
+    
+    Yields:
+        tuple: (ids, lat, lon, pm25) NumPy arrays for each non-empty chunk.
+    """
+    coord_index = get_coordinate_index(ds)
+    lat_chunk, lon_chunk = get_chunk_shape(ds)
+    lon_size = ds.sizes['lon']
+    lat_start, lat_stop, _ = lat_slice.indices(ds.sizes['lat'])
+    lon_start, lon_stop, _ = lon_slice.indices(lon_size)
+
+    # Pinned without being made active, as the generator may be resumed by any thread
+    snapshot = get_dataset_version(ds).pin(ds)
+    try:
+        for block_lat in chunk_aligned_slices(lat_start, lat_stop, lat_chunk):
+            for block_lon in chunk_aligned_slices(lon_start, lon_stop, lon_chunk):
+                block = snapshot.read_block(block_lat, block_lon)
+
+                lat_idx, lon_idx = np.indices(block.shape)
+                lat_idx, lon_idx, pm25 = lat_idx.ravel() + block_lat.start, lon_idx.ravel() + block_lon.start, block.ravel()
+                if skip_nan:
+                    valid = ~np.isnan(pm25)
+                    lat_idx, lon_idx, pm25 = lat_idx[valid], lon_idx[valid], pm25[valid]
+                if pm25.size:
+                    yield (
+                        lat_idx * lon_size + lon_idx,
+                        coord_index.lat.values[lat_idx],
+                        coord_index.lon.values[lon_idx],
+                        pm25
+                    )
+    finally:
+        snapshot.release()
+
+
+def iter_ndjson(ds, lat_slice, lon_slice, skip_nan=False):
+    """
+    Export a region of the grid as newline-delimited JSON, one chunk at a time.
+    
+    Each line is a data entry in the same format as get_data_entry.
+    
+    Yields:
+        bytes: The lines of one chunk.
+    """
+    for ids, lat, lon, pm25 in iter_chunk_records(ds, lat_slice, lon_slice, skip_nan):
+        lines = [json.dumps(entry, separators=(',', ':')) for entry in build_data_entries(ids.tolist(), lat, lon, pm25)]
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+def iter_arrow(ds, lat_slice, lon_slice, skip_nan=False):
+    """
+    Export a region of the grid as an Apache Arrow IPC stream, one record batch per chunk.
+    
+    Missing PM2.5 values are exported as nulls.
+    
+    Yields:
+        bytes: Successive pieces of the IPC stream.
+    """
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('lat', pa.float64()),
+        ('lon', pa.float64()),
+        ('pm25', pa.float64())
+    ])
+    sink = io.BytesIO()
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for ids, lat, lon, pm25 in iter_chunk_records(ds, lat_slice, lon_slice, skip_nan):
+            pm25 = pm25.astype(np.float64)
+            writer.write_batch(pa.record_batch([
+                pa.array(ids.astype(np.int64)),
+                pa.array(lat.astype(np.float64)),
+                pa.array(lon.astype(np.float64)),
+                pa.array(pm25, mask=np.isnan(pm25))
+            ], schema=schema))
+            yield drain()
+    yield drain()
+
+
+EXPORT_FORMATS = {
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+    'arrow': (iter_arrow, 'application/vnd.apache.arrow.stream')
+}
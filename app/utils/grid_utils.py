@@ -0,0 +1,328 @@
+from collections.abc import Mapping
+import dask.array as da
+import numpy as np
+from dask.highlevelgraph import HighLevelGraph
+from app.config.main import data_set_chunks
+from app.utils.dataset_registry import get_derived
+
+
+def get_chunk_shape(ds):
+    """
+    Get the chunk shape of the PM2.5 grid.
+    
+    Falls back to the on-disk chunking, and then to the configured chunking, when the
+    dataset is held in memory.
+    
+    Args:
+        ds: The dataset.
+    
+    Returns:
+        tuple: (lat_chunk, lon_chunk) sizes.
+    """
+    pm25_da = ds['GWRPM25']
+    if pm25_da.chunks:
+        return pm25_da.chunks[0][0], pm25_da.chunks[1][0]
+    encoded = pm25_da.encoding.get('chunks')
+    if encoded:
+        return int(encoded[0]), int(encoded[1])
+    return data_set_chunks['lat'], data_set_chunks['lon']
+
+
+def group_by_chunk(ds, lat_idx, lon_idx):
+    """
+    Group grid points by the chunk that holds them.
+    
+    Args:
+        ds: The dataset.
+        lat_idx: NumPy array of latitude indices.
+        lon_idx: NumPy array of longitude indices.
+    
+    Yields:
+        tuple: (lat_slice, lon_slice, positions) where the slices are the bounding box of
+        the points inside the chunk and positions are their indices in the input arrays.
+    """
+    lat_chunk, lon_chunk = get_chunk_shape(ds)
+    lon_chunks = -(-ds.sizes['lon'] // lon_chunk)
+
+    chunk_keys = (lat_idx // lat_chunk) * lon_chunks + lon_idx // lon_chunk
+    order = np.argsort(chunk_keys, kind='stable')
+    boundaries = np.flatnonzero(np.diff(chunk_keys[order])) + 1
+
+    for positions in np.split(order, boundaries):
+        if positions.size == 0:
+            continue
+        lats = lat_idx[positions]
+        lons = lon_idx[positions]
+        yield (
+            slice(int(lats.min()), int(lats.max()) + 1),
+            slice(int(lons.min()), int(lons.max()) + 1),
+            positions
+        )
+
+
+def chunk_aligned_slices(start, stop, chunk):
+    """
+    Split the index range [start, stop) into slices that do not cross chunk boundaries.
+    """
+    boundaries = [start] + list(range((start // chunk + 1) * chunk, stop, chunk)) + [stop]
+    return [slice(low, high) for low, high in zip(boundaries[:-1], boundaries[1:])]
+
+
+def read_pm25_block(ds, lat_slice, lon_slice):
+    """
+    Read a rectangular block of PM2.5 values in a single indexing operation.
+    
+    Goes through the chunk cache of the dataset when it has one. When the calling
+    thread made a snapshot of the dataset active, the block is read as of that
+    snapshot, see dataset_version.pin_snapshot.
+    
+    Args:
+        ds: The dataset.
+        lat_slice: Slice of latitude indices.
+        lon_slice: Slice of longitude indices.
+    
+    Returns:
+        2D NumPy array with the PM2.5 values of the block.
+    """
+    versions = get_derived(ds, 'dataset_version')
+    snapshot = versions.current_snapshot() if versions is not None else None
+    if snapshot is not None:
+        return snapshot.read_block(lat_slice, lon_slice)
+    return read_current_block(ds, lat_slice, lon_slice)
+
+
+def read_current_block(ds, lat_slice, lon_slice):
+    """
+    Read a rectangular block of the latest PM2.5 values, ignoring any active snapshot.
+    
+    Used by writers and by the structures derived from the grid, which must follow its
+    latest state.
+    """
+    cache = get_derived(ds, 'chunk_cache')
+    if cache is not None:
+        return cache.read_block(ds, lat_slice, lon_slice)
+    return ds['GWRPM25'].isel(lat=lat_slice, lon=lon_slice).values
+
+
+def read_pm25_value(ds, lat_idx, lon_idx):
+    """
+    Read the PM2.5 value of a single grid point, see read_pm25_block.
+    
+    Returns:
+        The value as a Python scalar (NaN for missing data).
+    """
+    return read_pm25_block(ds, slice(lat_idx, lat_idx + 1), slice(lon_idx, lon_idx + 1)).item()
+
+
+class ChunkOverlayLayer(Mapping):
+    """
+    Dask graph layer of a grid whose written chunks are held in memory, while the
+    other chunks are aliases of the chunks of the original array.
+    """
+
+    def __init__(self, name, base_name, numblocks, written):
+        self.name = name
+        self.base_name = base_name
+        self.numblocks = numblocks
+        self.written = written
+
+    def __getitem__(self, key):
+        if len(key) != 3 or key[0] != self.name or not all(0 <= i < n for i, n in zip(key[1:], self.numblocks)):
+            raise KeyError(key)
+        chunk = self.written.get(key[1:])
+        return chunk if chunk is not None else (self.base_name, *key[1:])
+
+    def __iter__(self):
+        return ((self.name, *index) for index in np.ndindex(*self.numblocks))
+
+    def __len__(self):
+        return int(np.prod(self.numblocks))
+
+
+class WrittenChunks:
+    """
+    Chunks of a Dask-backed grid written since it was opened, held in memory.
+    
+    Every write builds a new array on top of the original one, with a single graph
+    layer where the written chunks are literal arrays. The graph therefore keeps the
+    same size however many writes are made, instead of growing by one layer per
+    assignment.
+    
+    Chunks are held until they are written back to the store the original array reads
+    from, see release, so that memory only grows with the chunks not persisted yet.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.offsets = [np.concatenate([[0], np.cumsum(sizes)]) for sizes in base.chunks]
+        self.chunks = {}
+        self._writes = {}  # (row, col) -> number of writes to the chunk
+        self._count = 0
+
+    def _chunks_of(self, lat_slice, lon_slice):
+        rows = range(np.searchsorted(self.offsets[0], lat_slice.start, side='right') - 1,
+                     np.searchsorted(self.offsets[0], lat_slice.stop, side='left'))
+        cols = range(np.searchsorted(self.offsets[1], lon_slice.start, side='right') - 1,
+                     np.searchsorted(self.offsets[1], lon_slice.stop, side='left'))
+        return [(row, col) for row in rows for col in cols]
+
+    def write(self, blocks):
+        """
+        Write blocks of values, copying each chunk touched.
+        
+        Args:
+            blocks: List of (lat_slice, lon_slice, values) tuples, values being a scalar
+                or an array of the shape of the block.
+        
+        Returns:
+            The new Dask array of the grid.
+        """
+        for lat_slice, lon_slice, values in blocks:
+            values = np.broadcast_to(values, (lat_slice.stop - lat_slice.start, lon_slice.stop - lon_slice.start))
+            for row, col in self._chunks_of(lat_slice, lon_slice):
+                chunk = self.chunks.get((row, col))
+                # Copied, as readers may still compute from the previous array
+                chunk = np.array(self.base.blocks[row, col]) if chunk is None else chunk.copy()
+                lat_start, lon_start = self.offsets[0][row], self.offsets[1][col]
+                r0, r1 = max(lat_slice.start, lat_start), min(lat_slice.stop, self.offsets[0][row + 1])
+                c0, c1 = max(lon_slice.start, lon_start), min(lon_slice.stop, self.offsets[1][col + 1])
+                chunk[r0 - lat_start:r1 - lat_start, c0 - lon_start:c1 - lon_start] = (
+                    values[r0 - lat_slice.start:r1 - lat_slice.start, c0 - lon_slice.start:c1 - lon_slice.start]
+                )
+                self.chunks[(row, col)] = chunk
+                self._writes[(row, col)] = self._writes.get((row, col), 0) + 1
+        return self._array()
+
+    def writes_of(self, lat_slice, lon_slice):
+        """
+        Number of writes of the chunks held that lie entirely inside a block of the
+        grid, see release.
+        
+        Returns:
+            Dictionary of (row, col) chunk positions to their number of writes.
+        """
+        return {
+            (row, col): self._writes[(row, col)] for row, col in self._chunks_of(lat_slice, lon_slice)
+            if (row, col) in self.chunks
+            and lat_slice.start <= self.offsets[0][row] and self.offsets[0][row + 1] <= lat_slice.stop
+            and lon_slice.start <= self.offsets[1][col] and self.offsets[1][col + 1] <= lon_slice.stop
+        }
+
+    def release(self, writes):
+        """
+        Drop chunks written back to the store, unless they were written again since.
+        
+        Args:
+            writes: Chunks written back, as returned by writes_of when their values
+                were read.
+        
+        Returns:
+            The new Dask array of the grid, reading the dropped chunks from the store,
+            or None if no chunk was dropped.
+        """
+        released = [key for key, count in writes.items() if key in self.chunks and self._writes[key] == count]
+        for key in released:
+            del self.chunks[key]
+        return self._array() if released else None
+
+    def _array(self):
+        self._count += 1
+        name = f"{self.base.name}-written-{self._count}"
+        layer = ChunkOverlayLayer(name, self.base.name, self.base.numblocks, dict(self.chunks))
+        graph = HighLevelGraph.from_collections(name, layer, dependencies=[self.base])
+        return da.Array(graph, name, chunks=self.base.chunks, dtype=self.base.dtype, meta=self.base._meta)
+
+
+def write_pm25_blocks(ds, blocks):
+    """
+    Write rectangular blocks of PM2.5 values into the dataset, as a single update.
+    
+    A Dask-backed grid is replaced by a new array in a single assignment, see
+    WrittenChunks, so that readers computing from the previous array meanwhile are not
+    affected.
+    
+    Args:
+        ds: The dataset.
+        blocks: List of (lat_slice, lon_slice, values) tuples, values being a scalar or
+            an array of the shape of the block.
+    """
+    pm25_da = ds['GWRPM25']
+    if pm25_da.chunks:
+        written = get_derived(ds, 'written_chunks', lambda ds: WrittenChunks(pm25_da.data))
+        pm25_da.data = written.write(blocks)
+    else:
+        for lat_slice, lon_slice, values in blocks:
+            pm25_da[lat_slice, lon_slice] = values
+
+
+def written_chunks_of(ds, lat_slice, lon_slice):
+    """
+    Chunks of a block of the grid held in memory since they were written, with their
+    number of writes, to be passed to release_written_chunks once the block is persisted.
+    """
+    written = get_derived(ds, 'written_chunks')
+    return written.writes_of(lat_slice, lon_slice) if written is not None else {}
+
+
+def release_written_chunks(ds, writes):
+    """
+    Read chunks written back to the store from it again, instead of holding them in
+    memory, see WrittenChunks.release.
+    
+    Must be called with the lock serializing writes held.
+    """
+    written = get_derived(ds, 'written_chunks')
+    if written is not None and writes:
+        array = written.release(writes)
+        if array is not None:
+            ds['GWRPM25'].data = array
+
+
+def write_through_cache(ds, lat_idx, lon_idx, values):
+    """
+    Apply values just written to the dataset to its chunk cache, if it has one.
+    
+    Must be called before the derived structures are notified of the write, as they
+    read the written chunks back.
+    
+    Args:
+        ds: The dataset.
+        lat_idx: NumPy array of latitude indices written.
+        lon_idx: NumPy array of longitude indices written.
+        values: NumPy array of the values written.
+    """
+    cache = get_derived(ds, 'chunk_cache')
+    if cache is not None:
+        cache.write_through(lat_idx, lon_idx, values)
+
+
+def get_row_slabs(start, end, lon_size):
+    """
+    Split a range of flat indices into the contiguous row slabs it covers.
+    
+    A range spanning several rows is split into at most three slabs: the tail of
+    the first row, the full rows in between and the head of the last row.
+    
+    Args:
+        start: First flat index (inclusive).
+        end: Last flat index (exclusive).
+        lon_size: Number of longitude points per row.
+    
+    Returns:
+        List of (lat_slice, lon_slice) tuples, in flat index order.
+    """
+    first_row, first_col = divmod(start, lon_size)
+    last_row, last_col = divmod(end, lon_size)
+
+    if first_row == last_row:
+        return [(slice(first_row, first_row + 1), slice(first_col, last_col))]
+
+    slabs = []
+    if first_col:
+        slabs.append((slice(first_row, first_row + 1), slice(first_col, lon_size)))
+        first_row += 1
+    if first_row < last_row:
+        slabs.append((slice(first_row, last_row), slice(0, lon_size)))
+    if last_col:
+        slabs.append((slice(last_row, last_row + 1), slice(0, last_col)))
+    return slabs
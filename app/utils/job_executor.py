@@ -0,0 +1,240 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+
+JOB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+)
+'''
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _connect(store_path):
+    connection = sqlite3.connect(store_path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
+def _raise_timeout(signum, frame):
+    raise JobTimeout()
+
+
+def _run_job(store_path, job_id, fn, args, timeout):
+    """
+    Run a job in a pool process, recording its state in the job store.
+    
+    The result of a job revoked while it was running is discarded.
+    """
+    with closing(_connect(store_path)) as connection:
+        started = connection.execute(
+            "UPDATE jobs SET state = 'STARTED', started_at = ? WHERE id = ? AND state = 'PENDING'",
+            (time.time(), job_id)
+        ).rowcount
+        if not started:
+            return
+
+        if timeout:
+            signal.signal(signal.SIGALRM, _raise_timeout)
+            signal.alarm(int(timeout))
+        try:
+            result = json.dumps(fn(*args))
+            state, error = 'SUCCESS', None
+        except JobTimeout:
+            result, state, error = None, 'FAILURE', f"Job timed out after {timeout} seconds"
+        except Exception as e:
+            result, state, error = None, 'FAILURE', str(e)
+        finally:
+            if timeout:
+                signal.alarm(0)
+
+        connection.execute(
+            "UPDATE jobs SET state = ?, result = ?, error = ?, finished_at = ? WHERE id = ? AND state = 'STARTED'",
+            (state, result, error, time.time(), job_id)
+        )
+
+
+class LocalJobExecutor:
+    """
+    Job execution backend running jobs in a local process pool, without any broker.
+    
+    Job state, results and timings are kept in a SQLite database that every worker
+    process can reach, so a job can be polled from any of them. Finished jobs are
+    purged once their result TTL has elapsed.
+    """
+
+    def __init__(self, store_path, max_workers=None, result_ttl=3600, timeout=None):
+        self.store_path = store_path
+        self.max_workers = max_workers or os.cpu_count()
+        self.result_ttl = result_ttl
+        self.timeout = timeout
+        self._pool = None
+        self._pool_pid = None
+        self._futures = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+        with closing(_connect(store_path)) as connection:
+            connection.execute(JOB_SCHEMA)
+
+    def _get_pool(self):
+        # Pools are not inherited across forks, each worker process starts its own on first use
+        if self._pool is None or self._pool_pid != os.getpid():
+            context = multiprocessing.get_context('forkserver')
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            self._pool_pid = os.getpid()
+            self._futures = {}
+        return self._pool
+
+    def submit(self, fn, *args):
+        """
+        Submit a job.
+        
+        Args:
+            fn: Picklable callable returning a JSON-serializable result.
+            *args: Picklable arguments of the callable.
+        
+        Returns:
+            str: ID of the job.
+        """
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with closing(_connect(self.store_path)) as connection:
+            connection.execute('DELETE FROM jobs WHERE finished_at < ?', (now - self.result_ttl,))
+            connection.execute("INSERT INTO jobs (id, state, submitted_at) VALUES (?, 'PENDING', ?)", (job_id, now))
+
+        future = self._get_pool().submit(_run_job, self.store_path, job_id, fn, args, self.timeout)
+        self._futures[job_id] = future
+        future.add_done_callback(lambda future: self._on_done(job_id, future))
+        return job_id
+
+    def _on_done(self, job_id, future):
+        self._futures.pop(job_id, None)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            # The job could not run at all, e.g. the pool broke or the job could not be pickled
+            logging.error(f"Job {job_id} failed to run: {error}")
+            with closing(_connect(self.store_path)) as connection:
+                connection.execute(
+                    "UPDATE jobs SET state = 'FAILURE', error = ?, finished_at = ? WHERE id = ? AND state IN ('PENDING', 'STARTED')",
+                    (str(error), time.time(), job_id)
+                )
+
+    def status(self, job_id):
+        """
+        Get the state of a job, with its result when it succeeded.
+        
+        Returns:
+            A dictionary with the state ('PENDING', 'STARTED', 'SUCCESS', 'FAILURE' or
+            'REVOKED'), result, error and timings of the job. Unknown jobs are reported
+            as pending, like Celery does.
+        """
+        with closing(_connect(self.store_path)) as connection:
+            row = connection.execute(
+                'SELECT state, result, error, submitted_at, started_at, finished_at FROM jobs WHERE id = ?',
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return {'state': 'PENDING'}
+
+        state, result, error, submitted_at, started_at, finished_at = row
+        status = {'state': state, 'submitted_at': submitted_at, 'started_at': started_at, 'finished_at': finished_at}
+        if state == 'SUCCESS':
+            status['result'] = json.loads(result)
+        if error:
+            status['error'] = error
+        if started_at is not None and finished_at is not None:
+            status['runtime_seconds'] = finished_at - started_at
+        return status
+
+    def cancel(self, job_id):
+        """
+        Cancel a job.
+        
+        A pending job never runs. A job already running is not stopped: its process
+        keeps running until the job completes, and only its result is discarded.
+        
+        Returns:
+            bool: Whether the job was still pending or running.
+        """
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.cancel()
+        with closing(_connect(self.store_path)) as connection:
+            return bool(connection.execute(
+                "UPDATE jobs SET state = 'REVOKED', finished_at = ? WHERE id = ? AND state IN ('PENDING', 'STARTED')",
+                (time.time(), job_id)
+            ).rowcount)
+
+
+class CeleryJobBackend:
+    """
+    Job execution backend running jobs as Celery tasks.
+    
+    The Celery app is only created, and Celery only imported, when the first job is
+    submitted or polled, so that startup does not pay for it, and in each worker
+    process, so that none of its state is inherited across forks.
+    """
+
+    def __init__(self, make_celery):
+        """
+        Args:
+            make_celery: Callable returning the Celery app.
+        """
+        self._make_celery = make_celery
+        self._task = None
+        self._task_pid = None
+
+    def _get_task(self):
+        if self._task is None or self._task_pid != os.getpid():
+            celery = self._make_celery()
+            # Jobs are plain callables, which only pickle can carry
+            celery.conf.update(task_serializer='pickle', result_serializer='pickle', accept_content=['pickle', 'json'])
+
+            @celery.task(bind=True)
+            def run_job(task, fn, args):
+                """
+                Background task running a job using Celery.
+                """
+                try:
+                    return fn(*args)
+                except Exception as e:
+                    task.update_state(state='FAILURE', meta={'exc': str(e)})
+                    raise
+
+            self._task = run_job
+            self._task_pid = os.getpid()
+        return self._task
+
+    def submit(self, fn, *args):
+        return self._get_task().apply_async(args=(fn, args)).id
+
+    def status(self, job_id):
+        task = self._get_task().AsyncResult(job_id)
+        status = {'state': task.state}
+        if task.state == 'SUCCESS':
+            status['result'] = task.result
+        return status
+
+    def cancel(self, job_id):
+        task = self._get_task().AsyncResult(job_id)
+        pending = task.state in ('PENDING', 'STARTED')
+        task.revoke()
+        return pending
@@ -0,0 +1,369 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from dask.callbacks import Callback
+from zarr.storage import DirectoryStore
+import xarray as xr
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values.items()]
+
+
+class Gauge:
+    """
+    Value that can go up and down, optionally split by labels.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.labels), 0)
+
+    def values(self):
+        """
+        Current values, keyed by the tuple of their label values.
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in self.values().items()]
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, optionally split by labels.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[position] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels.get(name, '') for name in self.labels))
+        return entry[-1] if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(entry) for key, entry in self._values.items()}
+        lines = []
+        for key, entry in values.items():
+            for bound, count in zip(self.buckets, entry):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {entry[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(entry[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {entry[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Metrics of the process, rendered in the Prometheus text exposition format.
+    
+    Collectors are callables returning (name, kind, documentation, value) tuples, read
+    when the metrics are rendered, for values kept elsewhere such as cache counters.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def set_collector(self, name, collector):
+        self._collectors[name] = collector
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        for collector in list(self._collectors.values()):
+            for name, kind, documentation, value in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling requests.', labels=('endpoint', 'method', 'status')
+))
+LOCK_WAIT = REGISTRY.register(Histogram('data_lock_wait_seconds', 'Time spent waiting to acquire the data lock.'))
+DASK_COMPUTE = REGISTRY.register(Histogram(
+    'dask_compute_seconds', 'Time spent in dask computations, by endpoint.', labels=('endpoint',)
+))
+DASK_TASKS = REGISTRY.register(Counter('dask_tasks_total', 'Tasks in the dask graphs computed, by endpoint.', labels=('endpoint',)))
+STORE_BYTES_READ = REGISTRY.register(Counter('store_bytes_read_total', 'Bytes read from the zarr store.'))
+STARTUP_PHASE = REGISTRY.register(Gauge(
+    'startup_phase_seconds', 'Time spent in each phase of the startup of the service.', labels=('phase',)
+))
+
+# Endpoint served by the current thread, to attribute dask computations to it
+_current = threading.local()
+
+
+def set_current_endpoint(endpoint):
+    _current.endpoint = endpoint
+
+
+def get_current_endpoint():
+    return getattr(_current, 'endpoint', None) or 'background'
+
+
+class InstrumentedLock:
+    """
+    Lock wrapper recording the time spent waiting to acquire the lock.
+    """
+
+    def __init__(self, lock):
+        self.lock = lock
+
+    def acquire(self, *args, **kwargs):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(*args, **kwargs)
+        LOCK_WAIT.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class DaskMetricsCallback(Callback):
+    """
+    Dask callback recording the duration and task count of every computation.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._starts = threading.local()
+
+    def _start(self, dsk):
+        self._starts.value = time.perf_counter()
+        DASK_TASKS.inc(len(dsk), endpoint=get_current_endpoint())
+
+    def _finish(self, dsk, state, errored):
+        start = getattr(self._starts, 'value', None)
+        if start is not None:
+            DASK_COMPUTE.observe(time.perf_counter() - start, endpoint=get_current_endpoint())
+            self._starts.value = None
+
+
+_dask_callback = None
+
+
+def register_dask_metrics():
+    """
+    Record every dask computation of the process, once.
+    """
+    global _dask_callback
+    if _dask_callback is None:
+        _dask_callback = DaskMetricsCallback()
+        _dask_callback.register()
+
+
+@contextmanager
+def startup_phase(name):
+    """
+    Time a phase of the startup of the service, see get_startup_timings.
+    """
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    STARTUP_PHASE.set(seconds, phase=name)
+    logging.info(f"Startup phase {name} took {seconds:.3f}s")
+
+
+def get_startup_timings():
+    """
+    Seconds spent in each phase of the startup of the service, in the order they ran.
+    """
+    return {phase: seconds for (phase,), seconds in STARTUP_PHASE.values().items()}
+
+
+class MeteredStore(DirectoryStore):
+    """
+    Zarr directory store counting the bytes read from it.
+    """
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        STORE_BYTES_READ.inc(len(value))
+        return value
+
+
+def open_metered_dataset(store_location, group=None, **kwargs):
+    """
+    Open a dataset of a zarr store through a MeteredStore.
+    
+    Stores written by convert_to_zarr have consolidated metadata, read all at once
+    instead of one object per array and attribute. Other stores are opened without
+    first trying to find it.
+    
+    Args:
+        store_location: Location of the zarr store.
+        group: Optional group of the store.
+        **kwargs: Passed to xarray.open_zarr.
+    """
+    store = MeteredStore(store_location)
+    return xr.open_zarr(store, group=group, consolidated='.zmetadata' in store, **kwargs)
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler dumping the hottest stacks of requests slower than a threshold.
+    
+    A background thread samples the stack of every thread serving a request at a fixed
+    interval. When a request finishes above the threshold, its samples are logged in
+    folded format (one 'frame;frame;frame count' line per stack) and, optionally, written
+    to a directory.
+    """
+
+    def __init__(self, threshold, interval=0.01, directory=None, max_stacks=20):
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        self.max_stacks = max_stacks
+        self._lock = threading.Lock()
+        self._active = {}  # thread id -> Counter of folded stacks
+        self._pid = None
+
+    def _ensure_started(self):
+        # Threads are not inherited across forks, each worker process starts its own sampler
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._active = {}
+            threading.Thread(target=self._run, name='slow-request-profiler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, stacks in active.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+
+    def start_request(self):
+        with self._lock:
+            self._ensure_started()
+            self._active[threading.get_ident()] = StackCounter()
+
+    def finish_request(self, description, duration):
+        """
+        Stop sampling the current thread, dumping its stacks if the request was slow.
+        
+        Returns:
+            List of the hottest folded stacks and their sample counts, or None if the
+            request was not slow.
+        """
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+        if stacks is None or duration < self.threshold:
+            return None
+
+        hottest = stacks.most_common(self.max_stacks)
+        logging.warning(
+            f"Slow request {description} took {duration:.3f}s, hottest stacks:\n"
+            + '\n'.join(f"{stack} {count}" for stack, count in hottest)
+        )
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{threading.get_ident()}.folded")
+            with open(path, 'w') as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+        return hottest
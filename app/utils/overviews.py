@@ -0,0 +1,336 @@
+import itertools
+import logging
+import os
+import numpy as np
+import xarray as xr
+import zarr
+from threading import Lock
+from app.utils.dataset_registry import get_derived, set_derived
+from app.utils.coordinate_index import get_coordinate_index
+from app.utils.grid_utils import get_chunk_shape, read_current_block, read_pm25_block
+from app.utils.metrics import open_metered_dataset
+
+# Overview levels live in groups of the dataset store, e.g. overviews/4 for the 4x level
+OVERVIEW_GROUP = 'overviews'
+OVERVIEW_FIELDS = {'mean': 'GWRPM25', 'max': 'GWRPM25_max', 'count': 'GWRPM25_count'}
+
+
+def overview_factors(shape, min_size):
+    """
+    Downsampling factors (2, 4, 8...) of the overview levels of a grid.
+    
+    Args:
+        shape: Shape of the full resolution grid.
+        min_size: Size of the longest side of the coarsest level, at least.
+        
+    Returns:
+        List of factors, finest first.
+    """
+    factors = []
+    factor = 2
+    while max(shape) // factor >= min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def block_fields(block):
+    """
+    Overview fields of a full resolution block, one cell per grid point.
+    """
+    count = (~np.isnan(block)).astype(np.int64)
+    return {'mean': block.astype(np.float64), 'max': block.astype(np.float64), 'count': count}
+
+
+def coarsen_fields(fields, factor):
+    """
+    Merge every factor x factor block of overview cells into one, ignoring missing data.
+    
+    Means are weighted by the count of valid values of each cell, so coarsening a level
+    gives the same result as coarsening the full resolution grid. Edges are padded with
+    empty cells.
+    
+    Args:
+        fields: Dictionary of mean, max and count 2D arrays.
+        factor: Number of cells merged along each axis.
+        
+    Returns:
+        Dictionary of mean, max and count 2D arrays.
+    """
+    rows, cols = fields['count'].shape
+    out_rows, out_cols = -(-rows // factor), -(-cols // factor)
+    pad = [(0, out_rows * factor - rows), (0, out_cols * factor - cols)]
+
+    def blocks(array, fill):
+        return np.pad(array, pad, constant_values=fill).reshape(out_rows, factor, out_cols, factor)
+
+    count = blocks(fields['count'], 0).sum(axis=(1, 3))
+    total = blocks(np.where(fields['count'] > 0, fields['mean'] * fields['count'], 0), 0).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / count, np.nan)
+    maximum = np.fmax.reduce(np.fmax.reduce(blocks(fields['max'], np.nan), axis=3), axis=1)
+    return {'mean': mean, 'max': maximum, 'count': count}
+
+
+def write_overviews(ds, store_location, min_size=256):
+    """
+    Build the overview levels of the PM2.5 grid into the zarr store of the dataset.
+    
+    Every level is coarsened from the full resolution grid, with NaN-aware mean and max
+    and the count of valid values behind each cell.
+    
+    Args:
+        ds: The dataset, chunked with dask.
+        store_location: Location of the zarr store.
+        min_size: Size of the longest side of the coarsest level, at least.
+        
+    Returns:
+        List of the factors written.
+    """
+    pm25_da = ds['GWRPM25']
+    chunks = dict(zip(pm25_da.dims, get_chunk_shape(ds)))
+    factors = overview_factors(pm25_da.shape, min_size)
+    for factor in factors:
+        window = {'lat': factor, 'lon': factor}
+        coarse = pm25_da.coarsen(window, boundary='pad')
+        level = xr.Dataset({
+            OVERVIEW_FIELDS['mean']: coarse.mean(),
+            OVERVIEW_FIELDS['max']: coarse.max(),
+            OVERVIEW_FIELDS['count']: pm25_da.notnull().coarsen(window, boundary='pad').sum().astype(np.int32)
+        })
+        level = level.chunk(chunks)
+        for variable in level.variables.values():
+            variable.encoding.pop('chunks', None)
+        level.to_zarr(store_location, group=f'{OVERVIEW_GROUP}/{factor}', mode='w')
+        logging.info(f"Wrote {factor}x overview of shape {level[OVERVIEW_FIELDS['mean']].shape}")
+    return factors
+
+
+class Overviews:
+    """
+    Downsampled levels of the PM2.5 grid, read to serve large windows at a low resolution.
+    
+    Levels are read from the store. Writes made since the levels were built mark the
+    overview cells they cover as dirty, and dirty cells are recomputed from the full
+    resolution grid the next time they are read.
+    """
+
+    def __init__(self, levels, store_location=None):
+        self.levels = levels
+        self.store_location = store_location
+        self._lock = Lock()
+        self._dirty = {factor: set() for factor in levels}
+        self._patches = {factor: {} for factor in levels}
+        self._arrays = None
+
+    def _mark_dirty(self, lat_idx, lon_idx):
+        with self._lock:
+            for factor in self.levels:
+                self._dirty[factor].update(zip((lat_idx // factor).tolist(), (lon_idx // factor).tolist()))
+
+    def on_write(self, ds, lat_idx, lon_idx, values):
+        self._mark_dirty(np.asarray(lat_idx), np.asarray(lon_idx))
+
+    def on_stale(self, ds, lat_idx, lon_idx):
+        # One point per stale chunk, mark every cell overlapping the chunk
+        lat_chunk, lon_chunk = get_chunk_shape(ds)
+        with self._lock:
+            for lat, lon in zip(np.asarray(lat_idx).tolist(), np.asarray(lon_idx).tolist()):
+                lat_start, lon_start = lat - lat % lat_chunk, lon - lon % lon_chunk
+                lat_stop = min(lat_start + lat_chunk, ds.sizes['lat'])
+                lon_stop = min(lon_start + lon_chunk, ds.sizes['lon'])
+                for factor in self.levels:
+                    self._dirty[factor].update(itertools.product(
+                        range(lat_start // factor, -(-lat_stop // factor)),
+                        range(lon_start // factor, -(-lon_stop // factor))
+                    ))
+
+    def pick_factor(self, needed):
+        """
+        Coarsest level whose resolution is at least the one needed, 1 for the full grid.
+        """
+        return max((factor for factor in self.levels if factor <= needed), default=1)
+
+    def _cell_fields(self, ds, factor, row, col):
+        # Patches are shared by every reader, so they follow the latest grid
+        block = read_current_block(
+            ds,
+            slice(row * factor, min((row + 1) * factor, ds.sizes['lat'])),
+            slice(col * factor, min((col + 1) * factor, ds.sizes['lon']))
+        )
+        return {name: value[0, 0] for name, value in coarsen_fields(block_fields(block), factor).items()}
+
+    def read_level(self, ds, factor, row_slice, col_slice):
+        """
+        Read a block of a level, with the cells written since it was built brought up to date.
+        
+        Args:
+            ds: The dataset.
+            factor: Factor of the level, 1 for the full resolution grid.
+            row_slice: Slice of rows of the level.
+            col_slice: Slice of columns of the level.
+            
+        Returns:
+            Dictionary of mean, max and count 2D arrays.
+        """
+        if factor == 1:
+            return block_fields(read_pm25_block(ds, row_slice, col_slice))
+
+        level = self.levels[factor]
+        fields = {
+            name: np.asarray(level[variable][row_slice, col_slice].values, dtype=np.float64 if name != 'count' else np.int64)
+            for name, variable in OVERVIEW_FIELDS.items()
+        }
+
+        def inside(cell):
+            return row_slice.start <= cell[0] < row_slice.stop and col_slice.start <= cell[1] < col_slice.stop
+
+        with self._lock:
+            stale = [cell for cell in self._dirty[factor] if inside(cell)]
+            self._dirty[factor].difference_update(stale)
+        patches = {cell: self._cell_fields(ds, factor, *cell) for cell in stale}
+        with self._lock:
+            self._patches[factor].update(patches)
+            patches = {cell: patch for cell, patch in self._patches[factor].items() if inside(cell)}
+
+        for (row, col), patch in patches.items():
+            for name, value in patch.items():
+                fields[name][row - row_slice.start, col - col_slice.start] = value
+        return fields
+
+    def write_back(self, ds, lat_slice, lon_slice):
+        """
+        Rewrite the stored overview cells covering a block of the full resolution grid.
+        
+        Used when the written grid is flushed to the store, so that the levels stay in
+        line with it.
+        """
+        if not self.levels or self.store_location is None:
+            return
+        if self._arrays is None:
+            group = zarr.open(self.store_location, mode='r+')
+            self._arrays = {
+                factor: {name: group[f'{OVERVIEW_GROUP}/{factor}/{variable}'] for name, variable in OVERVIEW_FIELDS.items()}
+                for factor in self.levels
+            }
+
+        for factor, arrays in self._arrays.items():
+            rows = slice(lat_slice.start // factor, -(-lat_slice.stop // factor))
+            cols = slice(lon_slice.start // factor, -(-lon_slice.stop // factor))
+            block = read_current_block(
+                ds,
+                slice(rows.start * factor, min(rows.stop * factor, ds.sizes['lat'])),
+                slice(cols.start * factor, min(cols.stop * factor, ds.sizes['lon']))
+            )
+            fields = coarsen_fields(block_fields(block), factor)
+            for name, array in arrays.items():
+                array[rows, cols] = fields[name].astype(array.dtype)
+
+
+def load_overviews(ds, store_location):
+    """
+    Open the overview levels stored next to the dataset and register them.
+    
+    Args:
+        ds: The dataset.
+        store_location: Location of the zarr store.
+        
+    Returns:
+        Overviews of the dataset, without levels if the store has none.
+    """
+    levels = {}
+    if os.path.isdir(os.path.join(store_location, OVERVIEW_GROUP)):
+        for name in os.listdir(os.path.join(store_location, OVERVIEW_GROUP)):
+            if name.isdigit():
+                levels[int(name)] = open_metered_dataset(store_location, group=f'{OVERVIEW_GROUP}/{name}')
+    logging.info(f"Loaded overview levels {sorted(levels)}")
+    return set_derived(ds, 'overviews', Overviews(dict(sorted(levels.items())), store_location))
+
+
+def get_overviews(ds):
+    """
+    Retrieve the overview levels of the dataset, or an instance without levels if none were loaded.
+    """
+    return get_derived(ds, 'overviews', lambda ds: Overviews({}))
+
+
+def _window_level(ds, bbox, width, height):
+    # Grid block of the bounding box, and overview level and residual factor it is read at
+    if bbox:
+        lat_slice, lon_slice = get_coordinate_index(ds).bbox_slices(bbox)
+    else:
+        lat_slice, lon_slice = slice(0, ds.sizes['lat']), slice(0, ds.sizes['lon'])
+    lat_cells = lat_slice.stop - lat_slice.start
+    lon_cells = lon_slice.stop - lon_slice.start
+    if lat_cells == 0 or lon_cells == 0:
+        return lat_slice, lon_slice, 1, 1
+
+    needed = max(-(-lat_cells // height), -(-lon_cells // width))
+    level = get_overviews(ds).pick_factor(needed)
+    return lat_slice, lon_slice, level, -(-needed // level)
+
+
+def get_window_slices(ds, bbox, width, height):
+    """
+    Get the block of the grid behind the overview cells read by read_window.
+    
+    Returns:
+        tuple: (lat_slice, lon_slice) of grid indices, aligned on the cells of the level read.
+    """
+    lat_slice, lon_slice, level, _ = _window_level(ds, bbox, width, height)
+    return (
+        slice(lat_slice.start // level * level, min(-(-lat_slice.stop // level) * level, ds.sizes['lat'])),
+        slice(lon_slice.start // level * level, min(-(-lon_slice.stop // level) * level, ds.sizes['lon']))
+    )
+
+
+def read_window(ds, bbox, width, height, agg='mean'):
+    """
+    Read the PM2.5 values of a bounding box at a resolution of at most width x height cells.
+    
+    The coarsest overview level that still meets the requested resolution is read, and
+    coarsened further on the fly when needed, so the cost depends on the output size
+    rather than on the size of the box.
+    
+    Args:
+        ds: The dataset.
+        bbox: Dictionary with lat_min, lat_max, lon_min and lon_max, or None for the whole grid.
+        width: Maximum number of output cells along longitude.
+        height: Maximum number of output cells along latitude.
+        agg: 'mean' or 'max'.
+        
+    Returns:
+        A dictionary with the factor of the level read, the total downsampling factor,
+        the latitude and longitude of the output cells, and their PM2.5 values (None
+        where no data is available).
+        
+    Raises:
+        ValueError: If the coordinate axes are not monotonic.
+    """
+    lat_slice, lon_slice, level, residual = _window_level(ds, bbox, width, height)
+    if lat_slice.stop == lat_slice.start or lon_slice.stop == lon_slice.start:
+        return {'level': 1, 'factor': 1, 'lat': [], 'lon': [], 'pm25': []}
+
+    overviews = get_overviews(ds)
+    factor = level * residual
+
+    rows = slice(lat_slice.start // level, -(-lat_slice.stop // level))
+    cols = slice(lon_slice.start // level, -(-lon_slice.stop // level))
+    fields = overviews.read_level(ds, level, rows, cols)
+    if residual > 1:
+        fields = coarsen_fields(fields, residual)
+
+    def cell_coordinates(values, level_slice):
+        # Mean coordinate of the grid points behind each output cell
+        values = values[level_slice.start * level:level_slice.stop * level]
+        starts = np.arange(0, values.size, factor)
+        return (np.add.reduceat(values, starts) / np.diff(np.append(starts, values.size))).tolist()
+
+    pm25 = fields[agg]
+    return {
+        'level': level,
+        'factor': factor,
+        'lat': cell_coordinates(ds['lat'].values.astype(np.float64), rows),
+        'lon': cell_coordinates(ds['lon'].values.astype(np.float64), cols),
+        'pm25': [[value if value == value else None for value in row] for row in pm25.tolist()]
+    }
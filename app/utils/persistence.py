@@ -0,0 +1,291 @@
+import atexit
+import fcntl
+import logging
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+import zarr
+from app.utils.data_set_utils import update_pm25_values
+from app.utils.dataset_registry import set_derived
+from app.utils.grid_utils import read_pm25_block, release_written_chunks, written_chunks_of
+from app.utils.overviews import get_overviews
+
+# A WAL frame is a header (number of records, CRC32 of the payload) followed by the records
+WAL_FRAME_HEADER = struct.Struct('<II')
+WAL_RECORD = np.dtype([('lat', '<i8'), ('lon', '<i8'), ('pm25', '<f8')])
+WAL_SUFFIX = '.wal'
+
+
+def list_wal_segments(wal_directory):
+    """
+    List the segments of a write-ahead log, oldest first.
+    """
+    if not os.path.isdir(wal_directory):
+        return []
+    names = sorted(name for name in os.listdir(wal_directory) if name.endswith(WAL_SUFFIX))
+    return [os.path.join(wal_directory, name) for name in names]
+
+
+def read_wal_segment(path):
+    """
+    Read the records of a write-ahead log segment.
+    
+    Reading stops at the first incomplete or corrupted frame, which can only be the
+    last one, left behind by a crash in the middle of an append.
+    
+    Returns:
+        NumPy structured array of WAL_RECORD.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    frames = []
+    offset = 0
+    while offset + WAL_FRAME_HEADER.size <= len(data):
+        count, checksum = WAL_FRAME_HEADER.unpack_from(data, offset)
+        start = offset + WAL_FRAME_HEADER.size
+        payload = data[start:start + count * WAL_RECORD.itemsize]
+        if len(payload) < count * WAL_RECORD.itemsize or zlib.crc32(payload) != checksum:
+            logging.warning(f"Ignoring torn write-ahead log frame at offset {offset} of {path}")
+            break
+        frames.append(np.frombuffer(payload, dtype=WAL_RECORD))
+        offset = start + len(payload)
+
+    return np.concatenate(frames) if frames else np.empty(0, dtype=WAL_RECORD)
+
+
+def replay_write_ahead_log(ds, wal_directory):
+    """
+    Apply every write recorded in the write-ahead log to the dataset, oldest first.
+    
+    Args:
+        ds: The dataset, as loaded from the store.
+        wal_directory: Directory holding the write-ahead log.
+    
+    Returns:
+        int: Number of records replayed.
+    """
+    segments = [read_wal_segment(path) for path in list_wal_segments(wal_directory)]
+    records = np.concatenate(segments) if segments else np.empty(0, dtype=WAL_RECORD)
+    if records.size:
+        update_pm25_values(ds, records['lat'], records['lon'], records['pm25'])
+        logging.info(f"Replayed {records.size} writes from the write-ahead log")
+    return records.size
+
+
+class WriteAheadLog:
+    """
+    Append-only log of PM2.5 writes, split into numbered segments.
+    """
+
+    def __init__(self, wal_directory, fsync=True):
+        self.directory = wal_directory
+        self.fsync = fsync
+        os.makedirs(wal_directory, exist_ok=True)
+
+        existing = list_wal_segments(wal_directory)
+        self.sealed = existing
+        self.sequence = int(os.path.basename(existing[-1])[:-len(WAL_SUFFIX)]) + 1 if existing else 0
+        self._file = self._open_segment()
+
+    def _open_segment(self):
+        return open(os.path.join(self.directory, f"{self.sequence:012d}{WAL_SUFFIX}"), 'ab')
+
+    def append(self, lat_idx, lon_idx, values):
+        """
+        Append a batch of writes as a single frame, durable once this returns.
+        """
+        records = np.empty(len(values), dtype=WAL_RECORD)
+        records['lat'], records['lon'], records['pm25'] = lat_idx, lon_idx, values
+        payload = records.tobytes()
+
+        self._file.write(WAL_FRAME_HEADER.pack(records.size, zlib.crc32(payload)) + payload)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """
+        Seal the current segment and start a new one.
+        
+        Returns:
+            List of the paths of every sealed segment not removed yet.
+        """
+        self._file.close()
+        self.sealed.append(self._file.name)
+        self.sequence += 1
+        self._file = self._open_segment()
+        return list(self.sealed)
+
+    def remove(self, segments):
+        """
+        Remove sealed segments whose writes have been flushed to the store.
+        """
+        for path in segments:
+            os.remove(path)
+            self.sealed.remove(path)
+
+    def close(self):
+        self._file.close()
+
+
+class PersistenceManager:
+    """
+    Durable write path for the PM2.5 grid.
+    
+    Every write is appended to the write-ahead log before it is acknowledged, and the
+    chunks it touched are marked dirty. A background thread periodically rewrites each
+    dirty chunk of the zarr store once, then drops the log segments it covered.
+    """
+
+    def __init__(self, ds, store_location, wal_directory, data_lock,
+                 flush_interval=30, flush_max_dirty_cells=100000, fsync=True):
+        self.ds = ds
+        self.data_lock = data_lock
+        self.flush_interval = flush_interval
+        self.flush_max_dirty_cells = flush_max_dirty_cells
+
+        # Only one process may own the log and flush to the store
+        os.makedirs(wal_directory, exist_ok=True)
+        self._lock_file = open(os.path.join(wal_directory, 'LOCK'), 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"The write-ahead log in {wal_directory} is owned by another process")
+
+        self.array = zarr.open(store_location, mode='r+')['GWRPM25']
+        self.lat_chunk, self.lon_chunk = self.array.chunks
+        self.wal = WriteAheadLog(wal_directory, fsync=fsync)
+
+        # Writes replayed from sealed segments still have to reach the store
+        self._dirty = set()
+        self._dirty_cells = 0
+        for path in self.wal.sealed:
+            records = read_wal_segment(path)
+            self._mark_dirty(records['lat'], records['lon'])
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='zarr-flusher', daemon=True)
+
+    def _mark_dirty(self, lat_idx, lon_idx):
+        chunks = zip((lat_idx // self.lat_chunk).tolist(), (lon_idx // self.lon_chunk).tolist())
+        self._dirty.update(chunks)
+        self._dirty_cells += len(lat_idx)
+
+    def before_write(self, ds, lat_idx, lon_idx, values):
+        # Called with data_lock held by the writer, before the grid changes, so that a
+        # write failing to reach the log leaves nothing behind
+        self.wal.append(lat_idx, lon_idx, values)
+
+    def on_write(self, ds, lat_idx, lon_idx, values):
+        # Called with data_lock held by the writer
+        self._mark_dirty(lat_idx, lon_idx)
+        if self._dirty_cells >= self.flush_max_dirty_cells:
+            self._wake.set()
+
+    def flush(self):
+        """
+        Rewrite every dirty chunk of the store once, then drop the log segments covered.
+        
+        If a chunk cannot be rewritten, the chunks left are marked dirty again and the
+        segments are kept, so that a later flush or a replay still covers them.
+        
+        Returns:
+            int: Number of chunks rewritten.
+        """
+        with self.data_lock:
+            dirty, dirty_cells = self._dirty, self._dirty_cells
+            self._dirty, self._dirty_cells = set(), 0
+            segments = self.wal.rotate()
+
+        overviews = get_overviews(self.ds)
+        lat_size, lon_size = self.array.shape
+        remaining = sorted(dirty)
+        try:
+            while remaining:
+                row, col = remaining[0]
+                lat_slice = slice(row * self.lat_chunk, min((row + 1) * self.lat_chunk, lat_size))
+                lon_slice = slice(col * self.lon_chunk, min((col + 1) * self.lon_chunk, lon_size))
+                with self.data_lock:
+                    block = read_pm25_block(self.ds, lat_slice, lon_slice)
+                    written = written_chunks_of(self.ds, lat_slice, lon_slice)
+                    # Keep the stored overview levels in line with the rewritten chunk
+                    overviews.write_back(self.ds, lat_slice, lon_slice)
+                self.array[lat_slice, lon_slice] = block
+                remaining.pop(0)
+                # The chunk is read from the store again, unless it was written meanwhile
+                with self.data_lock:
+                    release_written_chunks(self.ds, written)
+        except Exception:
+            # The segments are kept, and the chunks not rewritten are flushed next time
+            with self.data_lock:
+                self._dirty.update(remaining)
+                self._dirty_cells += dirty_cells
+            raise
+
+        self.wal.remove(segments)
+        if dirty:
+            logging.info(f"Flushed {len(dirty)} dirty chunks to the store")
+        return len(dirty)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                if self._dirty or self.wal.sealed:
+                    self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing dirty chunks: {e}", exc_info=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """
+        Stop the background flusher and flush the remaining dirty chunks.
+        """
+        if self._stop.is_set():
+            return
+        atexit.unregister(self.stop)
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+        self.close()
+
+    def close(self):
+        """
+        Release the write-ahead log without flushing; unflushed writes are replayed on the next load.
+        """
+        self.wal.close()
+        self._lock_file.close()
+
+
+def start_persistence(ds, store_location, wal_directory, data_lock, **kwargs):
+    """
+    Enable the durable write path for the dataset and start its background flusher.
+    
+    The write-ahead log must have been replayed into the dataset beforehand, see
+    replay_write_ahead_log.
+    
+    Args:
+        ds: The dataset.
+        store_location: Location of the zarr store the dataset was loaded from.
+        wal_directory: Directory holding the write-ahead log.
+        data_lock: Lock held by writers of the dataset.
+        **kwargs: Flush interval, size limit and fsync options of PersistenceManager.
+    
+    Returns:
+        The running PersistenceManager.
+    """
+    manager = PersistenceManager(ds, store_location, wal_directory, data_lock, **kwargs)
+    set_derived(ds, 'persistence', manager)
+    return manager.start()
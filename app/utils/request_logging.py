@@ -0,0 +1,170 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from app.config.main import request_log_queue_size, request_log_body_max_bytes, request_log_body_sample_rate
+from app.utils.metrics import REGISTRY, Counter
+
+REQUEST_LOGS_DROPPED = REGISTRY.register(Counter(
+    'request_logs_dropped_total', 'Request log records dropped because the log queue was full.'
+))
+
+
+class RequestLogEntry:
+    """
+    Fields of a logged request, turned into a log line only when a handler formats it.
+    
+    The request thread only copies the fields it needs, while parsing the body and
+    building the line happen in the writer thread.
+    """
+
+    def __init__(self, remote_addr, method, url, status, duration, body=None, body_size=0, body_logged=True):
+        self.remote_addr = remote_addr
+        self.method = method
+        self.url = url
+        self.status = status
+        self.duration = duration
+        self.body = body
+        self.body_size = body_size
+        self.body_logged = body_logged
+
+    def fields(self):
+        """
+        Fields of the entry as a dictionary, for structured handlers.
+        """
+        return dict(vars(self))
+
+    def __str__(self):
+        message = f"{self.remote_addr} - {self.method} {self.url} - {self.status} in {self.duration * 1000:.1f}ms"
+        if self.method not in ('POST', 'PUT', 'PATCH'):
+            return message
+        if not self.body_logged:
+            return message + f" - Body not sampled ({self.body_size} bytes)"
+        if self.body is None:
+            return message + " - No JSON body in the request."
+        if len(self.body) < self.body_size:
+            return message + f" - Body: {self.body.decode('utf-8', 'replace')}... (truncated, {self.body_size} bytes)"
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            data = None
+        if not data:
+            return message + " - No JSON body in the request."
+        return message + f" - Body: {json.dumps(data, separators=(',', ':'))}"
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler leaving the formatting of records to the listener thread, and
+    dropping records instead of blocking when the queue is full.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            REQUEST_LOGS_DROPPED.inc()
+
+
+class RequestLog:
+    """
+    Request logging pipeline: request threads enqueue entries and a background thread
+    formats and writes them with the given handlers.
+    
+    Bodies of POST, PUT and PATCH requests are logged for a sample of the requests and
+    truncated to a maximum size. The writer thread is started on first use in every
+    process, so the pipeline survives forking workers.
+    """
+
+    def __init__(self, handlers=None, queue_size=10000, max_body_bytes=4096, body_sample_rate=1.0):
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.max_body_bytes = max_body_bytes
+        self.body_sample_rate = body_sample_rate
+        self._lock = Lock()
+        self._pid = None
+        self._queue = None
+        self._listener = None
+        self._logger = logging.getLogger(f"{__name__}.{id(self)}")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            handlers = self.handlers or logging.getLogger().handlers or [logging.StreamHandler()]
+            self._queue = queue.Queue(self.queue_size)
+            self._listener = QueueListener(self._queue, *handlers, respect_handler_level=True)
+            self._listener.start()
+            for handler in list(self._logger.handlers):
+                self._logger.removeHandler(handler)
+            self._logger.addHandler(DeferredQueueHandler(self._queue))
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def sample_body(self, request):
+        """
+        Copy the body of a request to log, if any.
+        
+        Returns:
+            Tuple: (body, body_size, body_logged) - where 'body' is the bytes to log (at most
+            max_body_bytes, or None if the request has no JSON body).
+        """
+        if request.method not in ('POST', 'PUT', 'PATCH'):
+            return None, 0, True
+        size = request.content_length or 0
+        if self.body_sample_rate < 1 and random.random() >= self.body_sample_rate:
+            return None, size, False
+        if not request.is_json:
+            return None, size, True
+        body = request.get_data(cache=True)
+        return body[:self.max_body_bytes], len(body), True
+
+    def log(self, entry):
+        """
+        Enqueue a request log entry.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        self._logger.info(entry, extra={'request': entry})
+
+    def flush(self):
+        """
+        Wait until every entry enqueued so far has been written.
+        """
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def stop(self):
+        """
+        Write the pending entries and stop the writer thread.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                self._listener.stop()
+                self._pid = None
+
+
+_request_log = None
+
+
+def get_request_log():
+    """
+    Request logging pipeline of the process, configured from app.config.main.
+    """
+    global _request_log
+    if _request_log is None:
+        _request_log = RequestLog(
+            queue_size=request_log_queue_size,
+            max_body_bytes=request_log_body_max_bytes,
+            body_sample_rate=request_log_body_sample_rate
+        )
+    return _request_log
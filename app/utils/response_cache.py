@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+from app.utils.dataset_registry import set_derived
+from app.utils.dataset_version import get_dataset_version
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of serialized read responses, keyed by request.
+    
+    Each entry is tagged with the ETag of the version of the chunks it was read from,
+    see DatasetVersion.region_version, and is only served to a request computing the
+    same ETag. Writes drop the entries read from the chunks they touch, so that the
+    budget is spent on responses that can still be served.
+    """
+
+    def __init__(self, versions, max_entries, max_bytes):
+        self.versions = versions
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()  # key -> (etag, body, rows, cols)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, etag):
+        """
+        Get the body of a cached response, or None if there is none with this ETag.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, etag, lat_slice, lon_slice, body):
+        """
+        Cache the body of a response read from a rectangular block of the grid.
+        """
+        if len(body) > self.max_bytes:
+            return
+        rows, cols = self.versions.region_chunks(lat_slice, lon_slice)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (etag, body, rows, cols)
+            self.current_bytes += len(body)
+            while self.current_bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= len(entry[1])
+
+    def on_write(self, ds, lat_idx, lon_idx, values):
+        self.on_stale(ds, lat_idx, lon_idx)
+
+    def on_stale(self, ds, lat_idx, lon_idx):
+        written = set(zip((lat_idx // self.versions.lat_chunk).tolist(), (lon_idx // self.versions.lon_chunk).tolist()))
+        with self._lock:
+            stale = [
+                key for key, (_, _, rows, cols) in self._entries.items()
+                if any(row in rows and col in cols for row, col in written)
+            ]
+            for key in stale:
+                self._drop(key)
+            self.invalidations += len(stale)
+
+    def stats(self):
+        """
+        Counters of the cache.
+        
+        Returns:
+            A dictionary with the hits, misses, evictions, invalidations, number of
+            entries and bytes held, and the byte budget.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+def build_response_cache(ds, max_entries, max_bytes):
+    """
+    Cache the read responses served from the dataset and register the cache, so that
+    it follows writes.
+    
+    Args:
+        ds: The dataset.
+        max_entries: Maximum number of responses held.
+        max_bytes: Byte budget of the cache.
+    
+    Returns:
+        ResponseCache for the dataset.
+    """
+    return set_derived(ds, 'response_cache', ResponseCache(get_dataset_version(ds), max_entries, max_bytes))
@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+
+class VersionedResultCache:
+    """
+    Bounded cache of computation results, keyed by a computation key and the dataset
+    version the result was computed at.
+    
+    Concurrent requests for the same key and version are deduplicated onto a single
+    in-flight computation (single flight). Only the latest version of each key is kept.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def peek(self, key, version):
+        """
+        Get a cached result without computing it.
+        
+        Returns:
+            tuple: (found, result).
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] == version:
+                self._results.move_to_end(key)
+                return True, entry[1]
+            return False, None
+
+    def get_or_compute(self, key, version, compute):
+        """
+        Get the result for a key at a dataset version, computing it at most once.
+        
+        Args:
+            key: Hashable key identifying the computation.
+            version: Dataset version the result depends on.
+            compute: Callable computing the result.
+        
+        Returns:
+            The result.
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] == version:
+                self._results.move_to_end(key)
+                return entry[1]
+
+            flight = self._in_flight.get((key, version))
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[(key, version)] = {'done': threading.Event()}
+
+        if not leader:
+            flight['done'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['result']
+
+        try:
+            flight['result'] = compute()
+            with self._lock:
+                current = self._results.get(key)
+                if current is None or current[0] <= version:
+                    self._results[key] = (version, flight['result'])
+                    self._results.move_to_end(key)
+                    while len(self._results) > self.max_entries:
+                        self._results.popitem(last=False)
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[(key, version)]
+            flight['done'].set()
@@ -0,0 +1,188 @@
+import fcntl
+import logging
+import os
+import threading
+import numpy as np
+import xarray as xr
+import zarr
+from app.utils.chunk_statistics import build_chunk_statistics
+from app.utils.valid_index import build_valid_index
+from app.utils.coordinate_index import build_coordinate_index
+from app.utils.dataset_registry import get_derived, notify_stale, set_derived
+from app.utils.overviews import load_overviews
+from app.utils.metrics import startup_phase
+from app.utils.time_series import load_yearly_data
+from app.config.main import year_views_max
+
+READY_MARKER = 'READY'
+
+
+class SharedLock:
+    """
+    Lock shared by every process attached to the same lock file.
+    
+    Combines a thread lock, for threads of the same process, with an exclusive flock
+    on a file opened by each process, for the other processes. Usable wherever
+    data_lock is, as a context manager.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def _lock_file(self):
+        # flock is tied to the open file, which forked processes would otherwise share
+        if self._pid != os.getpid():
+            self._file = open(self.path, 'a')
+            self._pid = os.getpid()
+        return self._file
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            fcntl.flock(self._lock_file(), fcntl.LOCK_EX)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        return True
+
+    def release(self):
+        fcntl.flock(self._lock_file(), fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class SharedGrid:
+    """
+    PM2.5 grid and coordinates held in memory-mapped files shared by every process.
+    
+    A per-chunk write counter lives next to the grid. Writers bump it, and each
+    process compares it with its own copy to refresh the structures it derived from
+    chunks written by other processes.
+    """
+
+    def __init__(self, path, chunk_shape):
+        self.path = path
+        self.lat_chunk, self.lon_chunk = chunk_shape
+        self.pm25 = np.load(os.path.join(path, 'GWRPM25.npy'), mmap_mode='r+')
+        self.lat = np.load(os.path.join(path, 'lat.npy'), mmap_mode='r')
+        self.lon = np.load(os.path.join(path, 'lon.npy'), mmap_mode='r')
+        self.chunk_versions = np.load(os.path.join(path, 'chunk_versions.npy'), mmap_mode='r+')
+        self.seen_versions = np.array(self.chunk_versions)
+        self._sync_lock = threading.Lock()
+
+    def on_write(self, ds, lat_idx, lon_idx, values):
+        # Called with the shared data lock held by the writer
+        rows, cols = lat_idx // self.lat_chunk, lon_idx // self.lon_chunk
+        with self._sync_lock:
+            stale = self.chunk_versions != self.seen_versions
+            np.add.at(self.chunk_versions, (rows, cols), 1)
+            # Chunks only written by this process are already up to date locally
+            fresh = ~stale[rows, cols]
+            self.seen_versions[rows[fresh], cols[fresh]] = self.chunk_versions[rows[fresh], cols[fresh]]
+
+    def sync(self, ds):
+        """
+        Refresh the structures derived from chunks written by other processes.
+        
+        Returns:
+            int: Number of stale chunks refreshed.
+        """
+        with self._sync_lock:
+            current = np.array(self.chunk_versions)
+            rows, cols = np.nonzero(current != self.seen_versions)
+            self.seen_versions = current
+        if rows.size:
+            notify_stale(ds, rows * self.lat_chunk, cols * self.lon_chunk)
+        return rows.size
+
+
+def _store_signature(data_set_location):
+    array_metadata = os.path.join(data_set_location, 'GWRPM25', '.zarray')
+    return f"{os.path.abspath(data_set_location)}:{os.stat(array_metadata).st_mtime_ns}"
+
+
+def _build_shared_files(data_set_location, path):
+    source = zarr.open(data_set_location, mode='r')
+    pm25_source = source['GWRPM25']
+    lat_chunk, lon_chunk = pm25_source.chunks
+
+    pm25 = np.lib.format.open_memmap(os.path.join(path, 'GWRPM25.npy'), mode='w+', dtype=pm25_source.dtype, shape=pm25_source.shape)
+    for start in range(0, pm25_source.shape[0], lat_chunk):
+        pm25[start:start + lat_chunk] = pm25_source[start:start + lat_chunk]
+    pm25.flush()
+
+    for name in ['lat', 'lon']:
+        np.save(os.path.join(path, f"{name}.npy"), source[name][:])
+
+    versions_shape = (-(-pm25_source.shape[0] // lat_chunk), -(-pm25_source.shape[1] // lon_chunk))
+    np.save(os.path.join(path, 'chunk_versions.npy'), np.zeros(versions_shape, dtype=np.int64))
+
+
+def load_shared_dataset(data_set_location, shared_memory_path):
+    """
+    Load the dataset into memory-mapped files shared by every worker process.
+    
+    The first process to get here copies the zarr store into the shared files, the
+    others attach to them. All of them then read and write the same memory, so the
+    grid is held once and writes are visible to every worker.
+    
+    Args:
+        data_set_location: Location of the zarr store.
+        shared_memory_path: Directory for the shared files, ideally on a tmpfs such as /dev/shm.
+    
+    Returns:
+        tuple: (ds, data_lock) with the dataset backed by the shared files and the lock
+        coordinating writers across processes.
+    """
+    os.makedirs(shared_memory_path, exist_ok=True)
+    data_lock = SharedLock(os.path.join(shared_memory_path, 'LOCK'))
+    signature = _store_signature(data_set_location)
+    marker = os.path.join(shared_memory_path, READY_MARKER)
+
+    with startup_phase('shared_memory'), data_lock:
+        current = open(marker).read() if os.path.exists(marker) else None
+        if current != signature:
+            logging.info(f"Copying {data_set_location} into shared memory at {shared_memory_path}")
+            if current is not None:
+                os.remove(marker)
+            _build_shared_files(data_set_location, shared_memory_path)
+            with open(marker, 'w') as f:
+                f.write(signature)
+
+    source = zarr.open(data_set_location, mode='r')['GWRPM25']
+    chunk_shape = tuple(source.chunks)
+    grid = SharedGrid(shared_memory_path, chunk_shape)
+    ds = xr.Dataset(
+        {'GWRPM25': (['lat', 'lon'], grid.pm25)},
+        coords={'lat': np.asarray(grid.lat), 'lon': np.asarray(grid.lon)}
+    )
+    ds['GWRPM25'].encoding['chunks'] = chunk_shape
+    if 'year' in source.attrs:
+        ds['GWRPM25'].attrs['year'] = source.attrs['year']
+    set_derived(ds, 'shared_grid', grid)
+    with startup_phase('coordinate_index'):
+        build_coordinate_index(ds)
+    with startup_phase('overviews'):
+        load_overviews(ds, data_set_location)
+    with startup_phase('yearly_data'):
+        load_yearly_data(ds, data_set_location, year_views_max)
+    with startup_phase('chunk_statistics'):
+        build_chunk_statistics(ds)
+    with startup_phase('valid_index'):
+        build_valid_index(ds)
+    return ds, data_lock
+
+
+def get_shared_grid(ds):
+    """
+    Retrieve the shared grid backing the dataset, or None for a process-private dataset.
+    """
+    return get_derived(ds, 'shared_grid')
@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import xarray as xr
+from app.utils.dataset_registry import get_derived, set_derived
+from app.utils.grid_utils import read_pm25_block
+from app.utils.metrics import open_metered_dataset
+
+# Yearly grids live in groups of the dataset store, along a time dimension holding the year:
+# years/ is chunked one year at a time like the served grid, timeseries/ holds every year of
+# small tiles in each chunk, for reading long series at a few points
+YEARS_GROUP = 'years'
+TIMESERIES_GROUP = 'timeseries'
+LAYOUT_GROUPS = (YEARS_GROUP, TIMESERIES_GROUP)
+
+
+def write_year(grid, year, store_location, chunks, compressor=None):
+    """
+    Append the grid of a year to the yearly layout of a store, creating it if needed.
+    
+    Years must be written in increasing order.
+    
+    Args:
+        grid: 2D PM2.5 DataArray of the year, with lat and lon dimensions.
+        year: The year.
+        store_location: Location of the zarr store.
+        chunks: (lat, lon) chunk shape.
+        compressor: numcodecs compressor, or None for no compression.
+    """
+    yearly = (
+        grid.rename('GWRPM25')
+        .expand_dims(time=[int(year)])
+        .chunk({'time': 1, 'lat': chunks[0], 'lon': chunks[1]})
+        .to_dataset()
+    )
+    for variable in yearly.variables.values():
+        variable.encoding.clear()
+
+    if os.path.isdir(os.path.join(store_location, YEARS_GROUP)):
+        yearly.to_zarr(store_location, group=YEARS_GROUP, append_dim='time', consolidated=False)
+    else:
+        encoding = {'GWRPM25': {'chunks': (1, *chunks), 'compressor': compressor}}
+        yearly.to_zarr(store_location, group=YEARS_GROUP, mode='w', encoding=encoding, consolidated=False)
+
+
+def write_timeseries_layout(store_location, tile, compressor=None):
+    """
+    Copy the yearly layout of a store into the time series layout, rechunked to hold
+    every year of tile x tile grid points in each chunk.
+    
+    Args:
+        store_location: Location of the zarr store, with a yearly layout.
+        tile: Size of the chunks along lat and lon.
+        compressor: numcodecs compressor, or None for no compression.
+    """
+    yearly = xr.open_zarr(store_location, group=YEARS_GROUP, consolidated=False)
+    series = yearly.chunk({'time': -1, 'lat': tile, 'lon': tile})
+    for variable in series.variables.values():
+        variable.encoding.clear()
+    encoding = {'GWRPM25': {'chunks': (series.sizes['time'], tile, tile), 'compressor': compressor}}
+    series.to_zarr(store_location, group=TIMESERIES_GROUP, mode='w', encoding=encoding, consolidated=False)
+
+
+def chunks_touched(array, time_idx, lat_idx, lon_idx):
+    """
+    Number of chunks of a [time, lat, lon] array holding the product of the given indices.
+    """
+    count = 1
+    for sizes, indices in zip(array.chunks, (time_idx, lat_idx, lon_idx)):
+        count *= np.unique(np.asarray(indices) // sizes[0]).size
+    return count
+
+
+class YearlyData:
+    """
+    PM2.5 grids of every year of the dataset, in one or two layouts of the same values.
+    
+    The grid served and written by the API is the one of the latest year, and always
+    wins over its stored copy. Other years are read-only: each is exposed as a 2D
+    dataset shaped like the served one, so every helper working on the served grid
+    works on it, and the most recently used ones are kept with their derived structures.
+    """
+
+    def __init__(self, layouts, served_year, max_views=4):
+        # layouts: group -> [time, lat, lon] DataArray
+        self.layouts = layouts
+        self.served_year = served_year
+        self.years = [int(year) for year in next(iter(layouts.values()))['time'].values]
+        self.max_views = max_views
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+
+    def select_years(self, first, last):
+        """
+        Years of the dataset between first and last, inclusive.
+        """
+        return [year for year in self.years if first <= year <= last]
+
+    def pick_layout(self, time_idx, lat_idx, lon_idx):
+        """
+        Layout reading the fewest bytes for the product of the given indices.
+        
+        Returns:
+            The [time, lat, lon] DataArray of the layout.
+        """
+        def cost(array):
+            chunk_bytes = np.prod([sizes[0] for sizes in array.chunks]) * array.dtype.itemsize
+            return chunks_touched(array, time_idx, lat_idx, lon_idx) * chunk_bytes
+
+        return min(self.layouts.values(), key=cost)
+
+    def year_view(self, ds, year):
+        """
+        2D dataset of the grid of a year, the served dataset itself for the served year.
+        """
+        if year == self.served_year:
+            return ds
+        with self._lock:
+            view = self._views.get(year)
+            if view is None:
+                grid = self.layouts[YEARS_GROUP].sel(time=year, drop=True)
+                view = self._views[year] = xr.Dataset({'GWRPM25': grid})
+                while len(self._views) > self.max_views:
+                    self._views.popitem(last=False)
+            self._views.move_to_end(year)
+            return view
+
+    def read_series(self, ds, lat_idx, lon_idx, years):
+        """
+        Read the PM2.5 values of a grid point over several years, from the cheapest layout.
+        
+        Returns:
+            NumPy array of the values, in the order of years (NaN for missing data).
+        """
+        time_idx = np.searchsorted(self.years, years)
+        array = self.pick_layout(time_idx, [lat_idx], [lon_idx])
+        values = np.array(array.isel(time=time_idx, lat=lat_idx, lon=lon_idx).values, dtype=np.float64)
+        if self.served_year in years:
+            # The stored copy of the served year misses the writes made since it was converted
+            values[years.index(self.served_year)] = read_pm25_block(
+                ds, slice(lat_idx, lat_idx + 1), slice(lon_idx, lon_idx + 1)
+            ).item()
+        return values
+
+
+def load_yearly_data(ds, store_location, max_views=4):
+    """
+    Open the yearly layouts stored next to the dataset and register them.
+    
+    Args:
+        ds: The dataset.
+        store_location: Location of the zarr store.
+        max_views: Number of years other than the served one kept open with their derived structures.
+    
+    Returns:
+        YearlyData of the dataset, or None if the store has no yearly layout.
+    """
+    layouts = {
+        group: open_metered_dataset(store_location, group=group)['GWRPM25']
+        for group in LAYOUT_GROUPS if os.path.isdir(os.path.join(store_location, group))
+    }
+    if YEARS_GROUP not in layouts:
+        return None
+    yearly = YearlyData(layouts, ds['GWRPM25'].attrs.get('year'), max_views)
+    logging.info(f"Loaded years {yearly.years} in layouts {sorted(layouts)}")
+    return set_derived(ds, 'yearly_data', yearly)
+
+
+def get_yearly_data(ds):
+    """
+    Retrieve the yearly grids of the dataset, or None if it only has the served grid.
+    """
+    return get_derived(ds, 'yearly_data')
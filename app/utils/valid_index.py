@@ -0,0 +1,113 @@
+import logging
+import threading
+import numpy as np
+from app.utils.dataset_registry import get_derived, set_derived
+from app.utils.grid_utils import get_chunk_shape, read_current_block
+
+
+class ValidCellIndex:
+    """
+    Bitmap of the grid points holding a PM2.5 value, with the number of them per row.
+    
+    One bit per grid point, packed along longitude, so the whole grid costs an eighth
+    of a byte per point. Built with a single pass over the grid and kept current by
+    writes, including deletes, it lets pages of valid entries be found without reading
+    the NaN cells before them.
+    """
+
+    def __init__(self, ds, chunk_shape):
+        self.lat_size = ds.sizes['lat']
+        self.lon_size = ds.sizes['lon']
+        self.lat_chunk, self.lon_chunk = chunk_shape
+        self.bits = np.zeros((self.lat_size, -(-self.lon_size // 8)), dtype=np.uint8)
+        self.row_counts = np.zeros(self.lat_size, dtype=np.int64)
+        self._lock = threading.Lock()
+
+        # One band of chunk rows at a time, to bound memory
+        for lat_start in range(0, self.lat_size, self.lat_chunk):
+            self._refresh(ds, slice(lat_start, min(lat_start + self.lat_chunk, self.lat_size)), slice(0, self.lon_size))
+
+    def _refresh(self, ds, lat_slice, lon_slice):
+        valid = ~np.isnan(read_current_block(ds, lat_slice, lon_slice))
+        with self._lock:
+            rows = np.unpackbits(self.bits[lat_slice], axis=1, count=self.lon_size).astype(bool)
+            rows[:, lon_slice] = valid
+            self.bits[lat_slice] = np.packbits(rows, axis=1)
+            self.row_counts[lat_slice] = rows.sum(axis=1)
+
+    def on_write(self, ds, lat_idx, lon_idx, values):
+        valid = ~np.isnan(values)
+        masks = (0x80 >> (lon_idx % 8)).astype(np.uint8)
+        with self._lock:
+            np.bitwise_or.at(self.bits, (lat_idx[valid], lon_idx[valid] // 8), masks[valid])
+            np.bitwise_and.at(self.bits, (lat_idx[~valid], lon_idx[~valid] // 8), ~masks[~valid])
+            rows = np.unique(lat_idx)
+            self.row_counts[rows] = np.unpackbits(self.bits[rows], axis=1).sum(axis=1)
+
+    def on_stale(self, ds, lat_idx, lon_idx):
+        # One point per stale chunk, refresh the whole chunk
+        for lat, lon in zip(lat_idx.tolist(), lon_idx.tolist()):
+            lat_start, lon_start = lat - lat % self.lat_chunk, lon - lon % self.lon_chunk
+            self._refresh(
+                ds,
+                slice(lat_start, min(lat_start + self.lat_chunk, self.lat_size)),
+                slice(lon_start, min(lon_start + self.lon_chunk, self.lon_size))
+            )
+
+    def count(self):
+        """
+        Number of grid points holding a value.
+        """
+        with self._lock:
+            return int(self.row_counts.sum())
+
+    def ids_after(self, after, limit):
+        """
+        IDs of the grid points holding a value, in order.
+        
+        Only the rows holding valid points are unpacked, so the cost depends on the
+        number of IDs returned rather than on the position in the grid.
+        
+        Args:
+            after: ID after which to start, or None to start at the beginning.
+            limit: Maximum number of IDs to return.
+        
+        Returns:
+            NumPy array of flat IDs.
+        """
+        start = 0 if after is None else after + 1
+        first_row, first_col = divmod(start, self.lon_size)
+        ids, found = [], 0
+        with self._lock:
+            for row in (np.flatnonzero(self.row_counts[first_row:]) + first_row).tolist():
+                if found >= limit:
+                    break
+                cols = np.flatnonzero(np.unpackbits(self.bits[row], count=self.lon_size))
+                if row == first_row:
+                    cols = cols[cols >= first_col]
+                cols = cols[:limit - found]
+                ids.append(row * self.lon_size + cols)
+                found += cols.size
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+
+
+def build_valid_index(ds):
+    """
+    Index the grid points of the dataset holding a value and register the index.
+    
+    Args:
+        ds: The dataset.
+    
+    Returns:
+        ValidCellIndex for the dataset.
+    """
+    index = ValidCellIndex(ds, get_chunk_shape(ds))
+    logging.info(f"Indexed {index.count()} grid points holding a value")
+    return set_derived(ds, 'valid_index', index)
+
+
+def get_valid_index(ds):
+    """
+    Retrieve the index of the grid points holding a value, building it if needed.
+    """
+    return get_derived(ds, 'valid_index', build_valid_index)
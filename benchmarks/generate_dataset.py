@@ -0,0 +1,69 @@
+import argparse
+import logging
+import dask.array as da
+import numpy as np
+import xarray as xr
+import zarr
+from app.utils.overviews import write_overviews
+
+
+def generate_dataset(path, lat_size=1800, lon_size=3600, nan_fraction=0.3, chunks=(100, 100), seed=0,
+                     overviews=True, overview_min_size=256):
+    """
+    Write a synthetic PM2.5 grid shaped like the served dataset into a zarr store.
+    
+    Values follow a gamma distribution over a latitude gradient, and missing cells are
+    drawn at random, so the store can be generated offline at any size. The grid is
+    built chunk by chunk with dask and never held in memory at once.
+    
+    Args:
+        path: Location of the zarr store, overwritten.
+        lat_size: Number of latitudes.
+        lon_size: Number of longitudes.
+        nan_fraction: Fraction of missing cells.
+        chunks: (lat, lon) chunk shape.
+        seed: Seed of the random generator, the same seed gives the same store.
+        overviews: Whether to build the overview levels into the store.
+        overview_min_size: Size of the longest side of the coarsest overview level.
+    
+    Returns:
+        The dataset written.
+    """
+    state = da.random.RandomState(seed)
+    shape = (lat_size, lon_size)
+    lat = np.linspace(-90, 90, lat_size, endpoint=False) + 90 / lat_size
+    lon = np.linspace(-180, 180, lon_size, endpoint=False) + 180 / lon_size
+
+    gradient = da.from_array((1.5 - np.abs(lat) / 90)[:, None], chunks=(chunks[0], 1))
+    pm25 = state.gamma(2.0, 6.0, size=shape, chunks=chunks) * gradient
+    pm25 = da.where(state.random_sample(shape, chunks=chunks) < nan_fraction, np.nan, pm25).astype(np.float32)
+
+    ds = xr.Dataset({'GWRPM25': (['lat', 'lon'], pm25)}, coords={'lat': lat, 'lon': lon})
+    ds.to_zarr(path, mode='w', encoding={'GWRPM25': {'chunks': chunks}}, consolidated=False)
+    if overviews:
+        write_overviews(xr.open_zarr(path, consolidated=False), path, min_size=overview_min_size)
+    zarr.consolidate_metadata(path)
+    logging.info(f"Generated {lat_size}x{lon_size} grid in {path}")
+    return ds
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Generate a synthetic PM2.5 zarr store.')
+    parser.add_argument('--output', default='./data/benchmark.zarr', help='Zarr store to write')
+    parser.add_argument('--lat-size', type=int, default=1800)
+    parser.add_argument('--lon-size', type=int, default=3600)
+    parser.add_argument('--nan-fraction', type=float, default=0.3)
+    parser.add_argument('--chunks', type=int, nargs=2, default=[100, 100], metavar=('LAT', 'LON'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-overviews', action='store_true', help='Do not build the overview levels')
+    args = parser.parse_args(argv)
+
+    generate_dataset(
+        args.output, args.lat_size, args.lon_size, args.nan_fraction, tuple(args.chunks), args.seed,
+        overviews=not args.no_overviews
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import numpy as np
+import xarray as xr
+from flask import Flask
+from benchmarks.generate_dataset import generate_dataset
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def random_bbox(rng, grid, size=10.0):
+    lat_size = min(size, grid['lat_max'] - grid['lat_min'])
+    lon_size = min(size, grid['lon_max'] - grid['lon_min'])
+    lat = rng.uniform(grid['lat_min'], grid['lat_max'] - lat_size)
+    lon = rng.uniform(grid['lon_min'], grid['lon_max'] - lon_size)
+    return f"lat_min={lat}&lat_max={lat + lat_size}&lon_min={lon}&lon_max={lon + lon_size}"
+
+
+def random_point(rng, grid):
+    return float(rng.uniform(grid['lat_min'], grid['lat_max'])), float(rng.uniform(grid['lon_min'], grid['lon_max']))
+
+
+# Requests of each scenario, built from a random generator and the extent of the grid:
+# name -> (method, function returning the path and the JSON body)
+SCENARIOS = {
+    'get_by_id': ('GET', lambda rng, grid: (f"/data/{rng.integers(grid['size'])}", None)),
+    'get_all': ('GET', lambda rng, grid: (f"/data?page={rng.integers(1, max(grid['size'] // 100, 2))}&per_page=100", None)),
+    'filter': ('GET', lambda rng, grid: ("/data/filter?lat={}&long={}".format(*random_point(rng, grid)), None)),
+    'filter_batch': ('POST', lambda rng, grid: ('/data/filter/batch', dict(zip(
+        ('lat', 'lon'), map(list, zip(*[random_point(rng, grid) for _ in range(1000)]))
+    )))),
+    'stats': ('GET', lambda rng, grid: ('/data/stats', None)),
+    'region_stats': ('GET', lambda rng, grid: (f"/data/stats?{random_bbox(rng, grid)}", None)),
+    'stats_async': ('GET', lambda rng, grid: ('/data/stats-async', None)),
+    'search': ('GET', lambda rng, grid: (f"/data/search?threshold={rng.uniform(20, 60)}&limit=100", None)),
+    'export': ('GET', lambda rng, grid: (f"/data/export?format=ndjson&{random_bbox(rng, grid, 2.0)}", None)),
+    'window': ('GET', lambda rng, grid: (f"/data/window?width=256&height=256&{random_bbox(rng, grid, 60.0)}", None)),
+    'update': ('PUT', lambda rng, grid: (f"/data/{rng.integers(grid['size'])}", {'pm25': float(rng.uniform(0, 50))})),
+    'update_batch': ('POST', lambda rng, grid: ('/data/batch', {
+        'id': rng.integers(grid['size'], size=1000).tolist(), 'pm25': rng.uniform(0, 50, 1000).tolist()
+    })),
+    'add': ('POST', lambda rng, grid: ('/data', dict(zip(('lat', 'lon'), random_point(rng, grid)), pm25=10.0))),
+    'delete': ('DELETE', lambda rng, grid: (f"/data/{rng.integers(grid['size'])}", None)),
+}
+
+
+class FlaskTarget:
+    """
+    Runs the app in process and sends requests through the Flask test client.
+    """
+
+    def __init__(self, store):
+        from app.routes.main import init_routes
+        from app.utils.data_loader import load_dataset
+        from app.utils.job_executor import LocalJobExecutor
+        from app.utils.metrics import get_startup_timings, startup_phase
+
+        self._jobs_directory = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        start = time.perf_counter()
+        ds = load_dataset(store)
+        with startup_phase('routes'):
+            init_routes(self.app, ds, Lock(), LocalJobExecutor(os.path.join(self._jobs_directory, 'jobs.sqlite3')))
+        self.ready_seconds = time.perf_counter() - start
+        self.startup_phases = get_startup_timings()
+        self._local = threading.local()
+
+    def request(self, method, path, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        shutil.rmtree(self._jobs_directory, ignore_errors=True)
+
+
+class GunicornTarget:
+    """
+    Runs the app with gunicorn on a local port and sends requests over HTTP keep-alive connections.
+    
+    Gunicorn runs from a temporary directory where ./data/data.zarr points to the store,
+    so the configuration of the service is used as is.
+    """
+
+    def __init__(self, store, workers=4, port=5099, startup_timeout=300):
+        self.port = port
+        self._directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self._directory, 'data'))
+        os.symlink(os.path.abspath(store), os.path.join(self._directory, 'data', 'data.zarr'))
+        self._process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_ROOT, 'app', 'config', 'main.py'),
+                '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--chdir', self._directory, 'app.main:app'
+            ],
+            env={**os.environ, 'PYTHONPATH': REPO_ROOT}
+        )
+        self._local = threading.local()
+
+        start = time.perf_counter()
+        deadline = time.time() + startup_timeout
+        while True:
+            try:
+                if self.request('GET', '/data/cache-stats', None) == 200:
+                    break
+            except OSError:
+                self._local.connection = None
+            if time.time() > deadline or self._process.poll() is not None:
+                self.close()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.1)
+        self.ready_seconds = time.perf_counter() - start
+        # With preload_app the phases ran in the master, and every worker reports them
+        self.startup_phases = parse_startup_phases(self.fetch('/metrics'))
+
+    def fetch(self, path):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        try:
+            connection.request('GET', path)
+            return connection.getresponse().read().decode()
+        finally:
+            connection.close()
+
+    def request(self, method, path, body):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            self._local.connection = None
+            raise
+        return response.status
+
+    def close(self):
+        self._process.terminate()
+        self._process.wait()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+
+def parse_startup_phases(metrics):
+    """
+    Seconds spent in each startup phase, from the text of the metrics endpoint.
+    """
+    phases = {}
+    for line in metrics.splitlines():
+        if line.startswith('startup_phase_seconds{'):
+            labels, value = line.rsplit(' ', 1)
+            phases[labels[len('startup_phase_seconds{phase="'):-len('"}')]] = float(value)
+    return phases
+
+
+def grid_extent(store):
+    """
+    Extent of the grid of a store, used to build requests.
+    """
+    ds = xr.open_zarr(store)
+    lat, lon = ds['lat'].values, ds['lon'].values
+    return {
+        'lat_min': float(lat.min()), 'lat_max': float(lat.max()),
+        'lon_min': float(lon.min()), 'lon_max': float(lon.max()),
+        'size': int(lat.size * lon.size)
+    }
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Throughput and latency percentiles of a scenario.
+    
+    Args:
+        latencies: Seconds taken by each request.
+        errors: Number of requests answered with a 5xx status or failing.
+        elapsed: Wall-clock seconds of the whole scenario.
+    
+    Returns:
+        Dictionary of the request count, errors, throughput in requests per second, and
+        mean, p50, p95 and p99 latency in milliseconds.
+    """
+    latencies_ms = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / elapsed,
+        'mean_ms': float(latencies_ms.mean()),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99)
+    }
+
+
+def run_scenario(target, name, grid, requests=200, concurrency=1, seed=0):
+    """
+    Send the requests of a scenario to a target and measure them.
+    
+    Requests are built up front from a seeded generator, so every run sends the same ones.
+    
+    Returns:
+        Summary of the scenario, see summarize.
+    """
+    method, build = SCENARIOS[name]
+    rng = np.random.default_rng(seed)
+    planned = [build(rng, grid) for _ in range(requests)]
+
+    def send(request):
+        start = time.perf_counter()
+        try:
+            failed = target.request(method, *request) >= 500
+        except (http.client.HTTPException, OSError):
+            failed = True
+        return time.perf_counter() - start, failed
+
+    target.request(method, *planned[0])  # Warm up
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, planned))
+    elapsed = time.perf_counter() - start
+
+    return summarize([latency for latency, _ in results], sum(failed for _, failed in results), elapsed)
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Find the scenarios whose latency regressed against a baseline report.
+    
+    Args:
+        report: Report of the current run.
+        baseline: Report of a previous run.
+        tolerance: Relative increase of a percentile tolerated before it counts as a regression.
+    
+    Returns:
+        List of dictionaries with the scenario, metric, baseline and current values.
+        Startup regressions are reported under the 'startup' scenario.
+    """
+    regressions = []
+    for metric in ('ready_seconds', 'total_seconds'):
+        previous, current = baseline.get('startup', {}).get(metric), report['startup'][metric]
+        if previous is not None and current > previous * (1 + tolerance):
+            regressions.append({'scenario': 'startup', 'metric': metric, 'baseline': previous, 'current': current})
+    for name, current in report['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append({
+                    'scenario': name, 'metric': metric, 'baseline': previous[metric], 'current': current[metric]
+                })
+    return regressions
+
+
+def run(store, target='flask', scenarios=None, requests=200, concurrency=1, workers=4, seed=0):
+    """
+    Run the benchmark scenarios against a store.
+    
+    Args:
+        store: Location of the zarr store served.
+        target: 'flask' for the in-process test client, 'gunicorn' for a local gunicorn.
+        scenarios: Names of the scenarios to run, all of them by default. Read scenarios
+            run before the ones writing to the grid.
+        requests: Requests per scenario.
+        concurrency: Requests in flight at once.
+        workers: Gunicorn workers.
+        seed: Seed of the generated requests.
+    
+    Returns:
+        Report with the settings of the run, the startup timings of the target and a
+        summary per scenario.
+    """
+    grid = grid_extent(store)
+    target_instance = FlaskTarget(store) if target == 'flask' else GunicornTarget(store, workers=workers)
+    startup = {
+        'ready_seconds': target_instance.ready_seconds,
+        'total_seconds': sum(target_instance.startup_phases.values()),
+        'phases': target_instance.startup_phases
+    }
+    logging.info(f"startup: {startup}")
+    try:
+        results = {}
+        for name in scenarios or list(SCENARIOS):
+            results[name] = run_scenario(target_instance, name, grid, requests, concurrency, seed)
+            logging.info(f"{name}: {results[name]}")
+    finally:
+        target_instance.close()
+
+    return {
+        'meta': {
+            'target': target, 'store': store, 'grid_size': grid['size'], 'requests': requests,
+            'concurrency': concurrency, 'workers': workers if target == 'gunicorn' else None, 'seed': seed,
+            'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'startup': startup,
+        'scenarios': results
+    }
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Benchmark the API endpoints.')
+    parser.add_argument('--store', default='./data/benchmark.zarr', help='Zarr store served, generated if missing')
+    parser.add_argument('--lat-size', type=int, default=1800, help='Latitudes of a generated store')
+    parser.add_argument('--lon-size', type=int, default=3600, help='Longitudes of a generated store')
+    parser.add_argument('--nan-fraction', type=float, default=0.3, help='Missing cells of a generated store')
+    parser.add_argument('--target', choices=['flask', 'gunicorn'], default='flask')
+    parser.add_argument('--workers', type=int, default=4, help='Gunicorn workers')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=None)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight at once')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file')
+    parser.add_argument('--baseline', default=None, help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative latency increase counted as a regression')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.store):
+        generate_dataset(args.store, args.lat_size, args.lon_size, args.nan_fraction, seed=args.seed)
+
+    report = run(args.store, args.target, args.scenarios, args.requests, args.concurrency, args.workers, args.seed)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    startup = report['startup']
+    print(f"startup: ready in {startup['ready_seconds']:.2f}s, "
+          + ', '.join(f"{phase} {seconds:.3f}s" for phase, seconds in startup['phases'].items()))
+    print(f"{'scenario':<16}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, summary in report['scenarios'].items():
+        print(f"{name:<16}{summary['throughput_rps']:>10.1f}{summary['p50_ms']:>10.2f}"
+              f"{summary['p95_ms']:>10.2f}{summary['p99_ms']:>10.2f}{summary['errors']:>8}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        for setting in ('target', 'grid_size', 'requests', 'concurrency', 'cpus'):
+            if baseline['meta'].get(setting) != report['meta'][setting]:
+                logging.warning(f"Baseline was run with a different {setting}: {baseline['meta'].get(setting)}")
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            unit = 's' if regression['scenario'] == 'startup' else 'ms'
+            print(f"REGRESSION {regression['scenario']} {regression['metric']}: "
+                  f"{regression['baseline']:.2f} -> {regression['current']:.2f} {unit}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
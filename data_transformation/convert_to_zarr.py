@@ -1,7 +1,278 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import dask
+import numpy as np
 import xarray as xr
+import zarr
+from numcodecs import Blosc, LZ4, Zstd
+from app.config.main import overview_min_size
+from app.utils.overviews import write_overviews
+from app.utils.time_series import write_timeseries_layout, write_year
 
-# Open the NetCDF file using Xarray with Dask
-ds = xr.open_dataset('./data_transformation/data.nc', chunks={'lat': 100, 'lon': 100})
+SHUFFLES = {'noshuffle': Blosc.NOSHUFFLE, 'shuffle': Blosc.SHUFFLE, 'bitshuffle': Blosc.BITSHUFFLE}
+COMPRESSORS = ['blosc-lz4', 'blosc-zstd', 'lz4', 'zstd', 'none']
 
-# Convert to Zarr format
-ds.to_zarr('./data/data.zarr', mode='w')
+
+def parse_chunks(value):
+    """
+    Parse a chunk shape given as LATxLON, e.g. 100x100.
+    """
+    try:
+        lat, lon = (int(size) for size in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid chunk shape '{value}', expected LATxLON")
+    if lat <= 0 or lon <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid chunk shape '{value}', sizes must be positive")
+    return lat, lon
+
+
+def make_compressor(name, clevel=5, shuffle='shuffle'):
+    """
+    Build a numcodecs compressor.
+    
+    Args:
+        name: One of COMPRESSORS. Blosc compressors apply the shuffle filter themselves.
+        clevel: Compression level.
+        shuffle: One of SHUFFLES, for Blosc compressors.
+        
+    Returns:
+        The compressor, or None for no compression.
+    """
+    if name == 'none':
+        return None
+    if name.startswith('blosc-'):
+        return Blosc(cname=name[len('blosc-'):], clevel=clevel, shuffle=SHUFFLES[shuffle])
+    if name == 'zstd':
+        return Zstd(level=clevel)
+    if name == 'lz4':
+        return LZ4(acceleration=1)
+    raise ValueError(f"Unknown compressor '{name}'")
+
+
+def convert(input_path, output_path, chunks=(100, 100), compressor=None, workers=None, shard_rows=None,
+            overviews=True):
+    """
+    Convert a gridded PM2.5 dataset into a zarr store with consolidated metadata.
+    
+    Chunks are encoded in parallel with dask. With shard_rows, the grid is written in
+    bands of that many chunk rows, one after the other, which bounds the memory and the
+    size of the task graph for grids too large to convert in one go.
+    
+    Args:
+        input_path: Any dataset xarray can open (NetCDF, zarr...).
+        output_path: Location of the zarr store, overwritten.
+        chunks: (lat, lon) chunk shape.
+        compressor: numcodecs compressor, or None for no compression.
+        workers: Number of threads encoding chunks, defaults to the number of cores.
+        shard_rows: Optional number of chunk rows written per band.
+        overviews: Whether to build the overview levels into the store.
+        
+    Returns:
+        float: Seconds spent writing the store.
+    """
+    ds = xr.open_dataset(input_path, chunks={}).chunk(dict(zip(('lat', 'lon'), chunks)))
+    for variable in ds.variables.values():
+        variable.encoding.clear()
+    encoding = {'GWRPM25': {'chunks': chunks, 'compressor': compressor}}
+
+    start = time.perf_counter()
+    with dask.config.set(scheduler='threads', num_workers=workers or os.cpu_count()):
+        if shard_rows:
+            # Write the metadata and coordinates first, then fill the grid band by band
+            ds.to_zarr(output_path, mode='w', encoding=encoding, compute=False, consolidated=False)
+            band = shard_rows * chunks[0]
+            for lat_start in range(0, ds.sizes['lat'], band):
+                region = {'lat': slice(lat_start, min(lat_start + band, ds.sizes['lat']))}
+                ds[['GWRPM25']].isel(region).drop_vars(['lon']).to_zarr(output_path, region=region, consolidated=False)
+        else:
+            ds.to_zarr(output_path, mode='w', encoding=encoding, consolidated=False)
+
+        if overviews:
+            write_overviews(xr.open_zarr(output_path, consolidated=False), output_path, min_size=overview_min_size)
+
+    # Readers open the store with a single metadata read
+    zarr.consolidate_metadata(output_path)
+    return time.perf_counter() - start
+
+
+def convert_years(input_paths, years, output_path, chunks=(100, 100), compressor=None, workers=None,
+                  shard_rows=None, overviews=True, timeseries_tile=None):
+    """
+    Convert the PM2.5 grids of several years into a zarr store, see convert.
+    
+    The grid of the latest year is the one served and written by the API. Every year,
+    that one included, is also appended along the time dimension of the yearly layout,
+    and optionally copied into the time series layout, see app.utils.time_series.
+    
+    Args:
+        input_paths: Datasets xarray can open, one per year.
+        years: Year of each dataset.
+        output_path: Location of the zarr store, overwritten.
+        chunks: (lat, lon) chunk shape.
+        compressor: numcodecs compressor, or None for no compression.
+        workers: Number of threads encoding chunks, defaults to the number of cores.
+        shard_rows: Optional number of chunk rows written per band, for the served grid.
+        overviews: Whether to build the overview levels of the served grid into the store.
+        timeseries_tile: Optional lat and lon size of the chunks of the time series layout.
+        
+    Returns:
+        float: Seconds spent writing the store.
+    """
+    order = np.argsort(years)
+    input_paths, years = [input_paths[i] for i in order], [int(years[i]) for i in order]
+    seconds = convert(input_paths[-1], output_path, chunks, compressor, workers, shard_rows, overviews)
+
+    start = time.perf_counter()
+    with dask.config.set(scheduler='threads', num_workers=workers or os.cpu_count()):
+        for input_path, year in zip(input_paths, years):
+            write_year(xr.open_dataset(input_path, chunks={})['GWRPM25'], year, output_path, chunks, compressor)
+            logging.info(f"Appended the grid of {year}")
+        if timeseries_tile:
+            write_timeseries_layout(output_path, timeseries_tile, compressor)
+
+    zarr.open(output_path, mode='r+')['GWRPM25'].attrs['year'] = years[-1]
+    zarr.consolidate_metadata(output_path)
+    return seconds + time.perf_counter() - start
+
+
+def store_size(path):
+    """
+    Total size in bytes of the files of a store.
+    """
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def measure_reads(path, points=1000, repeat=3):
+    """
+    Measure the read latency of a store for the access patterns of the service.
+    
+    Args:
+        path: Location of the zarr store.
+        points: Number of random single points read.
+        repeat: Runs per pattern, the best one is kept.
+        
+    Returns:
+        Dictionary of seconds per point read, per slab read (one row of chunks across the
+        grid) and per full scan.
+    """
+    array = zarr.open_consolidated(path, mode='r')['GWRPM25']
+    rng = np.random.default_rng(0)
+    lat_idx = rng.integers(0, array.shape[0], points)
+    lon_idx = rng.integers(0, array.shape[1], points)
+
+    def best(run):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    return {
+        'point_read_seconds': best(lambda: [array[lat, lon] for lat, lon in zip(lat_idx, lon_idx)]) / points,
+        'slab_read_seconds': best(lambda: array[:array.chunks[0], :]),
+        'full_scan_seconds': best(lambda: np.nanmean(array[:]))
+    }
+
+
+def benchmark(input_path, layouts, workers=None, points=1000):
+    """
+    Convert the input with every candidate layout in a temporary directory and measure each one.
+    
+    Args:
+        input_path: Any dataset xarray can open.
+        layouts: List of dictionaries with the chunks, compressor, clevel and shuffle of each layout.
+        workers: Number of threads encoding chunks.
+        points: Number of random single points read per layout.
+        
+    Returns:
+        List of dictionaries, one per layout, with its settings, store size, write time
+        and read latencies.
+    """
+    results = []
+    for layout in layouts:
+        path = tempfile.mkdtemp(suffix='.zarr')
+        try:
+            compressor = make_compressor(layout['compressor'], layout['clevel'], layout['shuffle'])
+            write_seconds = convert(input_path, path, layout['chunks'], compressor, workers=workers, overviews=False)
+            results.append({
+                **layout,
+                'chunks': 'x'.join(str(size) for size in layout['chunks']),
+                'size_bytes': store_size(path),
+                'write_seconds': write_seconds,
+                **measure_reads(path, points)
+            })
+            logging.info(f"Benchmarked {results[-1]}")
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a PM2.5 grid into the zarr store served by the API.')
+    parser.add_argument('--input', nargs='+', default=['./data_transformation/data.nc'],
+                        help='Dataset to convert, one per year with --years')
+    parser.add_argument('--years', type=int, nargs='+', default=None,
+                        help='Year of each input, to write them along a time dimension')
+    parser.add_argument('--timeseries-tile', type=int, default=None,
+                        help='Also write the yearly grids rechunked for time series reads, in tiles of this size')
+    parser.add_argument('--output', default='./data/data.zarr', help='Zarr store to write')
+    parser.add_argument('--chunks', type=parse_chunks, nargs='+', default=[(100, 100)],
+                        help='Chunk shape as LATxLON, several candidates with --benchmark')
+    parser.add_argument('--compressor', choices=COMPRESSORS, nargs='+', default=['blosc-lz4'],
+                        help='Compressor, several candidates with --benchmark')
+    parser.add_argument('--clevel', type=int, nargs='+', default=[5], help='Compression level')
+    parser.add_argument('--shuffle', choices=list(SHUFFLES), default='shuffle', help='Shuffle filter of Blosc compressors')
+    parser.add_argument('--workers', type=int, default=None, help='Threads encoding chunks, defaults to the number of cores')
+    parser.add_argument('--shard-rows', type=int, default=None, help='Write the grid in bands of this many chunk rows')
+    parser.add_argument('--no-overviews', action='store_true', help='Do not build the overview levels')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Measure every combination of --chunks, --compressor and --clevel instead of converting')
+    parser.add_argument('--points', type=int, default=1000, help='Random points read per layout with --benchmark')
+    args = parser.parse_args(argv)
+
+    if not args.benchmark and (len(args.chunks) > 1 or len(args.compressor) > 1 or len(args.clevel) > 1):
+        parser.error('Several candidate layouts are only accepted with --benchmark')
+    if args.years is None and (len(args.input) > 1 or args.timeseries_tile):
+        parser.error('--years is required with several inputs or --timeseries-tile')
+    if args.years is not None and len(args.years) != len(args.input):
+        parser.error('--years must give one year per input')
+    if args.benchmark and len(args.input) > 1:
+        parser.error('A single input is accepted with --benchmark')
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+
+    if args.benchmark:
+        layouts = [
+            {'chunks': chunks, 'compressor': compressor, 'clevel': clevel, 'shuffle': args.shuffle}
+            for chunks, compressor, clevel in itertools.product(args.chunks, args.compressor, args.clevel)
+        ]
+        print(json.dumps(benchmark(args.input[0], layouts, workers=args.workers, points=args.points), indent=2))
+        return
+
+    compressor = make_compressor(args.compressor[0], args.clevel[0], args.shuffle)
+    if args.years is not None:
+        seconds = convert_years(
+            args.input, args.years, args.output, args.chunks[0], compressor, workers=args.workers,
+            shard_rows=args.shard_rows, overviews=not args.no_overviews, timeseries_tile=args.timeseries_tile
+        )
+    else:
+        seconds = convert(
+            args.input[0], args.output, args.chunks[0], compressor,
+            workers=args.workers, shard_rows=args.shard_rows, overviews=not args.no_overviews
+        )
+    logging.info(f"Wrote {args.output} ({store_size(args.output)} bytes) in {seconds:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import os
+import time
 import pytest
 from app.routes.main import init_routes
 import xarray as xr
@@ -5,6 +7,10 @@ import numpy as np
 from threading import Lock
 from flask import Flask
 from unittest.mock import Mock
+from app.utils.data_set_utils import get_data_entry, get_pm25_at_indices, paginate_data
+from app.utils.coordinate_index import AxisIndex
+from app.utils.chunk_statistics import ChunkStatistics, summarize_snapshot
+from app.utils.job_executor import LocalJobExecutor
 
 @pytest.fixture
 def mock_dataset(monkeypatch):
@@ -81,6 +87,49 @@ def test_get_all_data(client, mock_dataset):
     assert data[-1]['lon'] == -120.0
     assert data[-1]['pm25'] == 16.5
 
+# Test GET /data pages spanning several rows match the per-entry lookup
+@pytest.mark.parametrize('page, per_page', [(1, 25), (2, 7), (3, 3), (4, 7), (1, 1), (5, 6), (0, 5)])
+def test_get_all_data_matches_entries(client, mock_dataset, page, per_page):
+    response = client.get(f'/data?page={page}&per_page={per_page}')
+    assert response.status_code == 200
+
+    start = max((page - 1) * per_page, 0)
+    end = min(page * per_page, 25)
+    expected = [get_data_entry(idx, mock_dataset) for idx in range(start, end)]
+    assert response.get_json() == expected
+
+    chunked = mock_dataset.chunk({'lat': 2, 'lon': 2})
+    assert paginate_data(chunked, page, per_page) == expected
+
+# Test GET /data?valid_only pages through the entries holding a value, following writes and deletes
+def test_get_valid_data(chunked_client, chunked_dataset):
+    def valid_entries(per_page):
+        entries, cursor = [], None
+        while True:
+            url = f'/data?valid_only=true&per_page={per_page}' + (f'&cursor={cursor}' if cursor else '')
+            page = chunked_client.get(url).get_json()
+            assert len(page['data']) <= per_page
+            entries += page['data']
+            cursor = page['next_cursor']
+            if cursor is None:
+                return entries
+
+    def expected():
+        return [entry for entry in map(lambda idx: get_data_entry(idx, chunked_dataset), range(25)) if entry['pm25'] is not None]
+
+    assert len(expected()) == 22
+    assert valid_entries(4) == expected()
+    assert valid_entries(21) == expected()
+
+    chunked_client.delete('/data/0')
+    chunked_client.put('/data/3', json={'pm25': 14.5})
+    chunked_client.post('/data/batch', json={'id': [16, 24], 'pm25': [1.0, float('nan')]})
+    assert valid_entries(3) == expected()
+    assert [entry['id'] for entry in valid_entries(25)][:3] == [1, 2, 3]
+
+    assert chunked_client.get('/data?valid_only=true&per_page=0').status_code == 400
+    assert chunked_client.get('/data?valid_only=true&cursor=LTE=').status_code == 400
+
 # Test GET /data/filter with valid values
 def test_filter_data(client, mock_dataset):
     response = client.get('/data/filter?lat=30.0&long=-100.0')
@@ -99,6 +148,65 @@ def test_filter_data_nearest(client, mock_dataset):
     assert data['lon'] == -100.0
     assert data['pm25'] == 12.0
 
+# Test the coordinate index matches a brute-force nearest search on every axis layout
+@pytest.mark.parametrize('values', [
+    [10.0, 20.0, 30.0, 40.0, 50.0],
+    [-80.0, -90.0, -100.0, -110.0, -120.0],
+    [30.0, 10.0, 20.0, 10.0, 50.0, 40.0],
+])
+def test_axis_index_nearest(values):
+    axis = AxisIndex(np.array(values))
+    queries = np.array([-200.0, -115.0, -105.0, -85.0, 0.0, 10.0, 15.0, 25.0, 35.0, 45.0, 55.0, 200.0])
+
+    expected = [int(np.abs(np.array(values) - q).argmin()) for q in queries]
+    assert [axis.nearest(q) for q in queries] == expected
+    assert axis.nearest_many(queries).tolist() == expected
+
+# Test POST /data/filter/batch returns the same values as /data/filter, in request order
+def test_filter_data_batch(client, mock_dataset):
+    lats = [35.0, 10.0, 50.0, 35.0, 22.0]
+    lons = [-105.0, -80.0, -120.0, -105.0, -101.0]
+    response = client.post('/data/filter/batch', json={'lat': lats, 'lon': lons})
+    assert response.status_code == 200
+
+    expected = [client.get(f'/data/filter?lat={lat}&long={lon}').get_json() for lat, lon in zip(lats, lons)]
+    assert response.get_json() == expected
+
+    packed = np.column_stack([lats, lons]).astype('<f8').tobytes()
+    response = client.post('/data/filter/batch', data=packed, content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert response.get_json() == expected
+
+def test_get_pm25_at_indices_chunked(mock_dataset):
+    lat_idx = np.array([4, 0, 2, 3, 0, 4])
+    lon_idx = np.array([4, 0, 2, 1, 3, 0])
+    expected = mock_dataset['GWRPM25'].values[lat_idx, lon_idx]
+
+    values = get_pm25_at_indices(mock_dataset.chunk({'lat': 2, 'lon': 2}), lat_idx, lon_idx)
+    np.testing.assert_array_equal(values, expected)
+
+def test_filter_data_batch_invalid_input(client, mock_dataset):
+    response = client.post('/data/filter/batch', json={'lat': [10.0, 'a'], 'lon': [-80.0, -90.0]})
+    assert response.status_code == 400
+    assert 'lat' in response.get_json()['error']
+
+    response = client.post('/data/filter/batch', json={'lat': [10.0], 'lon': [-80.0, -90.0]})
+    assert response.status_code == 400
+
+    response = client.post('/data/filter/batch', json={'lat': [[10.0, 20.0], 30.0], 'lon': [-80.0, -90.0]})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'lat must be a list of numbers'
+
+    response = client.post('/data/filter/batch', data='{"lat": [10.0, NaN], "lon": [-80.0, -90.0]}', content_type='application/json')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'lat and lon must be finite'
+
+    packed = np.array([[10.0, -80.0], [np.inf, -90.0]], dtype='<f8').tobytes()
+    response = client.post('/data/filter/batch', data=packed, content_type='application/octet-stream')
+    assert response.status_code == 400
+
+    assert client.get('/data/filter?lat=nan&long=-80').status_code == 400
+
 # Test GET /data/stats
 def test_get_stats(client, mock_dataset):
     response = client.get('/data/stats')
@@ -109,6 +217,892 @@ def test_get_stats(client, mock_dataset):
     assert stats['min_pm25'] == 8.5
     assert stats['max_pm25'] == 16.5
 
+@pytest.fixture
+def chunked_dataset(mock_dataset):
+    return mock_dataset.chunk({'lat': 2, 'lon': 2})
+
+@pytest.fixture
+def chunked_client(chunked_dataset):
+    app = Flask(__name__)
+    init_routes(app, chunked_dataset, Lock(), Mock())
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+def expected_stats(ds):
+    pm25_da = ds['GWRPM25']
+    return {
+        'count': int(pm25_da.count()),
+        'mean_pm25': float(pm25_da.mean()),
+        'min_pm25': float(pm25_da.min()),
+        'max_pm25': float(pm25_da.max())
+    }
+
+# Test GET /data/stats stays in line with a full recompute after writes
+def test_get_stats_after_writes(chunked_client, chunked_dataset):
+    assert chunked_client.get('/data/stats').get_json() == expected_stats(chunked_dataset)
+
+    chunked_client.put('/data/1', json={'pm25': 42.0})
+    chunked_client.delete('/data/20')
+    chunked_client.post('/data', json={'lat': 50.0, 'lon': -120.0, 'pm25': 2.0})
+
+    stats = chunked_client.get('/data/stats').get_json()
+    expected = expected_stats(chunked_dataset)
+    assert stats['count'] == expected['count'] == 21
+    assert stats['mean_pm25'] == pytest.approx(expected['mean_pm25'], rel=1e-12)
+    assert stats['min_pm25'] == expected['min_pm25'] == 2.0
+    assert stats['max_pm25'] == expected['max_pm25'] == 42.0
+
+# Test GET /data/stats restricted to a bounding box
+def test_get_region_stats(chunked_client, chunked_dataset):
+    response = chunked_client.get('/data/stats?lat_min=15&lat_max=45&lon_min=-115&lon_max=-85')
+    assert response.status_code == 200
+
+    region = chunked_dataset.sel(lat=slice(15, 45), lon=slice(-85, -115))
+    assert response.get_json() == pytest.approx(expected_stats(region), rel=1e-12)
+
+    response = chunked_client.get('/data/stats?lat_min=15&lat_max=45')
+    assert response.status_code == 400
+    for bounds in ('lat_min=nan&lat_max=45', 'lat_min=15&lat_max=inf'):
+        response = chunked_client.get(f'/data/stats?{bounds}&lon_min=-115&lon_max=-85')
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Bounds must be finite'
+
+# Test region partials merged from the pyramid match a direct reduction, after writes too
+def test_chunk_statistics_regions():
+    rng = np.random.default_rng(0)
+    grid = rng.uniform(0, 100, size=(23, 37))
+    grid[rng.uniform(size=grid.shape) < 0.3] = np.nan
+    ds = xr.Dataset({'GWRPM25': (['lat', 'lon'], grid)}, coords={'lat': np.arange(23.0), 'lon': np.arange(37.0)})
+    stats = ChunkStatistics(ds, (3, 4))
+
+    ds['GWRPM25'][5, 7] = 250.0
+    ds['GWRPM25'][22, 36] = np.nan
+    stats.on_write(ds, np.array([5, 22]), np.array([7, 36]), np.array([250.0, np.nan]))
+
+    for lat_slice, lon_slice in [
+        (slice(0, 23), slice(0, 37)), (slice(1, 22), slice(2, 35)), (slice(3, 21), slice(4, 36)),
+        (slice(5, 6), slice(0, 37)), (slice(0, 23), slice(9, 10)), (slice(4, 4), slice(0, 37))
+    ]:
+        block = grid[lat_slice, lon_slice]
+        partials = stats.region_partials(ds, lat_slice, lon_slice)
+        assert int(partials['count']) == np.count_nonzero(~np.isnan(block))
+        assert float(partials['sum']) == pytest.approx(np.nansum(block), rel=1e-12)
+        if block.size and not np.all(np.isnan(block)):
+            assert float(partials['min']) == np.nanmin(block)
+            assert float(partials['max']) == np.nanmax(block)
+
+# Test percentiles and exceedance fractions merged from the chunk histograms, after writes too
+def test_chunk_statistics_percentiles():
+    rng = np.random.default_rng(1)
+    grid = rng.gamma(2.0, 10.0, size=(40, 50)) + 1.0
+    grid[rng.uniform(size=grid.shape) < 0.2] = np.nan
+    ds = xr.Dataset({'GWRPM25': (['lat', 'lon'], grid)}, coords={'lat': np.arange(40.0), 'lon': np.arange(50.0)})
+    stats = ChunkStatistics(ds, (7, 6))
+
+    ds['GWRPM25'][3, 4] = 400.0
+    stats.on_write(ds, np.array([3]), np.array([4]), np.array([400.0]))
+
+    for lat_slice, lon_slice in [(slice(0, 40), slice(0, 50)), (slice(5, 33), slice(2, 41))]:
+        block = grid[lat_slice, lon_slice]
+        summary = stats.region_summary(ds, lat_slice, lon_slice, percentiles=[0, 50, 95, 99, 100], thresholds=[15, 35, 20.5])
+        for percentile in [0, 50, 95, 99, 100]:
+            assert summary['percentiles'][f'p{percentile}'] == pytest.approx(np.nanpercentile(block, percentile), rel=0.05)
+        valid = block[~np.isnan(block)]
+        assert summary['exceedance']['15'] == np.mean(valid > 15)
+        assert summary['exceedance']['35'] == np.mean(valid > 35)
+        assert summary['exceedance']['20.5'] == pytest.approx(np.mean(valid > 20.5), abs=0.01)
+
+    assert 'percentiles' not in stats.summary()
+
+# Test GET /data/stats with percentiles and thresholds
+def test_get_stats_percentiles(client, mock_dataset):
+    response = client.get('/data/stats?percentiles=0,50,100&thresholds=10,15')
+    assert response.status_code == 200
+    stats = response.get_json()
+    assert stats['count'] == 22
+    assert stats['percentiles']['p0'] == 8.5
+    assert stats['percentiles']['p50'] == pytest.approx(np.nanpercentile(mock_dataset['GWRPM25'].values, 50), rel=0.05)
+    assert stats['percentiles']['p100'] == 16.5
+    assert stats['exceedance'] == {'10': 18 / 22, '15': 2 / 22}
+
+    region = client.get('/data/stats?lat_min=15&lat_max=45&lon_min=-115&lon_max=-85&thresholds=10,15').get_json()
+    assert region['exceedance'] == {'10': 1.0, '15': 0.0}
+
+    assert client.get('/data/stats?percentiles=50,101').status_code == 400
+    assert client.get('/data/stats?thresholds=a').status_code == 400
+
+def search_all(client, query):
+    entries, cursor = [], None
+    while True:
+        url = f'/data/search?{query}' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url)
+        assert response.status_code == 200
+        page = response.get_json()
+        entries.extend(page['data'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return entries
+
+# Test GET /data/search pages through every exceedance, and sees writes to skipped chunks
+def test_search_data(chunked_client, chunked_dataset):
+    entries = search_all(chunked_client, 'threshold=13.0&limit=3')
+    values = chunked_dataset['GWRPM25'].values
+    expected_ids = sorted(int(i) for i in np.flatnonzero(values > 13.0))
+    assert sorted(entry['id'] for entry in entries) == expected_ids
+    assert all(entry == get_data_entry(entry['id'], chunked_dataset) for entry in entries)
+
+    # A page holding exactly the hits left has no cursor to an empty page
+    page = chunked_client.get(f'/data/search?threshold=13.0&limit={len(expected_ids)}').get_json()
+    assert len(page['data']) == len(expected_ids) and page['next_cursor'] is None
+    page = chunked_client.get(f'/data/search?threshold=13.0&limit={len(expected_ids) - 1}').get_json()
+    assert page['next_cursor'] is not None
+
+    # Entry 20 sits in a chunk whose maximum (9.5) is below the threshold
+    chunked_client.put('/data/20', json={'pm25': 30.0})
+    entries = search_all(chunked_client, 'threshold=13.0&limit=3&lat_min=40&lat_max=50&lon_min=-120&lon_max=-80')
+    assert entries == [{'id': 20, 'lat': 50.0, 'lon': -80.0, 'pm25': 30.0}]
+
+def test_search_data_invalid_input(client, mock_dataset):
+    assert client.get('/data/search').status_code == 400
+    assert client.get('/data/search?threshold=10&cursor=not-a-cursor').status_code == 400
+    assert client.get('/data/search?threshold=10&cursor=LTE=').status_code == 400
+    assert client.get('/data/search?threshold=10&limit=0').status_code == 400
+
+# Test GET /data/export streams every entry once, as NDJSON and as Arrow IPC
+def test_export_data(chunked_client, chunked_dataset):
+    import json
+    import pyarrow as pa
+
+    response = chunked_client.get('/data/export')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    entries = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert sorted(entries, key=lambda entry: entry['id']) == [get_data_entry(idx, chunked_dataset) for idx in range(25)]
+
+    response = chunked_client.get('/data/export?format=arrow&skip_nan=true&lat_min=15&lat_max=45&lon_min=-115&lon_max=-85')
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.data).read_all()
+    expected = [get_data_entry(idx, chunked_dataset) for idx in [6, 8, 11, 12, 13, 17, 18]]
+    assert sorted(table.to_pylist(), key=lambda entry: entry['id']) == expected
+
+    assert chunked_client.get('/data/export?format=csv').status_code == 400
+
+# Test POST /data/batch applies valid records and reports rejected ones
+def test_update_data_batch(chunked_client, chunked_dataset):
+    records = [
+        {'id': 1, 'pm25': 18.0},
+        {'lat': 35.0, 'lon': -115.0, 'pm25': 19.0},
+        {'id': 99, 'pm25': 1.0},
+        {'id': 2, 'pm25': 'invalid_value'},
+        {'pm25': 3.0},
+        {'id': 24, 'pm25': 5.0},
+        {'id': 24, 'pm25': 6.0},
+    ]
+    response = chunked_client.post('/data/batch', json={'records': records})
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['updated'] == 4
+    assert result['rejected'] == 3
+    assert [r['status'] for r in result['results']] == ['updated', 'updated', 'rejected', 'rejected', 'rejected', 'updated', 'updated']
+    assert result['results'][1]['id'] == 13
+    assert result['results'][2]['error'] == 'Invalid ID'
+    assert 'pm25' in result['results'][3]['error']
+
+    assert chunked_client.get('/data/1').get_json()['pm25'] == 18.0
+    assert chunked_client.get('/data/13').get_json()['pm25'] == 19.0
+    assert chunked_client.get('/data/24').get_json()['pm25'] == 6.0
+    assert chunked_client.get('/data/2').get_json()['pm25'] == 14.0
+    assert chunked_client.get('/data/stats').get_json()['max_pm25'] == 19.0
+
+    response = chunked_client.post('/data/batch', json={'id': [0, 3], 'pm25': [1.0, 2.0]})
+    assert response.get_json()['updated'] == 2
+    assert chunked_client.get('/data/3').get_json()['pm25'] == 2.0
+
+    assert chunked_client.post('/data/batch', json={'id': [0, 3], 'pm25': [1.0]}).status_code == 400
+
+    response = chunked_client.post('/data/batch', data='[{"lat": NaN, "lon": -90.0, "pm25": 1.0}, {"id": [1, 2], "pm25": [1, 2]}, {"id": [3, 4], "pm25": 1.0}]', content_type='application/json')
+    assert response.status_code == 200
+    assert [r['error'] for r in response.get_json()['results']] == ['lat and lon must be finite', 'pm25 must be a number', 'id must be an integer']
+
+    # Writes do not grow the task graph of the grid
+    layers = len(chunked_dataset['GWRPM25'].data.dask.layers)
+    for pm25 in range(20):
+        chunked_client.post('/data/batch', json={'id': [0, 3, 24], 'pm25': [pm25, pm25, pm25]})
+    assert len(chunked_dataset['GWRPM25'].data.dask.layers) == layers
+    assert chunked_client.get('/data/24').get_json()['pm25'] == 19.0
+
+# Test acknowledged writes survive a crash through the write-ahead log, and reach the store on flush
+def test_persistence_replay_and_flush(tmp_path, mock_dataset):
+    import zarr
+    from app.utils.data_loader import load_dataset
+    from app.utils.dataset_registry import set_derived
+    from app.utils.persistence import PersistenceManager, list_wal_segments
+
+    store, wal = str(tmp_path / 'data.zarr'), str(tmp_path / 'wal')
+    mock_dataset.to_zarr(store)
+
+    ds = load_dataset(store, wal_directory=wal)
+    data_lock = Lock()
+    manager = set_derived(ds, 'persistence', PersistenceManager(ds, store, wal, data_lock))
+    app = Flask(__name__)
+    init_routes(app, ds, data_lock, Mock())
+    with app.test_client() as client:
+        client.put('/data/1', json={'pm25': 18.0})
+        client.delete('/data/2')
+        client.post('/data/batch', json={'id': [1, 24], 'pm25': [19.0, 2.0]})
+    manager.close()  # Crash before any flush
+    assert zarr.open(store)['GWRPM25'][0, 1] == 13.0
+
+    ds = load_dataset(store, wal_directory=wal)
+    assert get_data_entry(1, ds)['pm25'] == 19.0
+    assert get_data_entry(2, ds)['pm25'] is None
+    assert get_data_entry(24, ds)['pm25'] == 2.0
+
+    manager = PersistenceManager(ds, store, wal, Lock())
+    assert manager.flush() == 1
+    manager.close()
+    assert zarr.open(store)['GWRPM25'][0, 1] == 19.0
+    assert np.isnan(zarr.open(store)['GWRPM25'][0, 2])
+    assert all(os.path.getsize(path) == 0 for path in list_wal_segments(wal))
+
+# Test a failed flush keeps the chunks it did not rewrite dirty, and their log segments
+def test_persistence_failed_flush(tmp_path, mock_dataset):
+    import zarr
+    from app.utils.data_loader import load_dataset
+    from app.utils.dataset_registry import set_derived
+    from app.utils.persistence import PersistenceManager, list_wal_segments
+
+    store, wal = str(tmp_path / 'data.zarr'), str(tmp_path / 'wal')
+    mock_dataset.chunk({'lat': 2, 'lon': 2}).to_zarr(store)
+
+    ds = load_dataset(store, wal_directory=wal)
+    assert ds['GWRPM25'].chunks == ((2, 2, 1), (2, 2, 1))
+    data_lock = Lock()
+    manager = set_derived(ds, 'persistence', PersistenceManager(ds, store, wal, data_lock))
+    app = Flask(__name__)
+    init_routes(app, ds, data_lock, Mock())
+    with app.test_client() as client:
+        client.post('/data/batch', json={'id': [0, 24], 'pm25': [1.0, 2.0]})
+
+    array = manager.array
+    failing = Mock(shape=array.shape)
+    failing.__setitem__ = Mock(side_effect=[None, OSError('store unavailable')])
+    manager.array = failing
+    with pytest.raises(OSError):
+        manager.flush()
+    assert manager._dirty == {(2, 2)}
+
+    manager.array = array
+    with app.test_client() as client:
+        client.put('/data/1', json={'pm25': 3.0})
+    assert manager.flush() == 2
+    manager.close()
+    assert zarr.open(store)['GWRPM25'][4, 4] == 2.0
+    assert zarr.open(store)['GWRPM25'][0, 1] == 3.0
+    assert all(os.path.getsize(path) == 0 for path in list_wal_segments(wal))
+
+# Test written chunks are dropped from memory once flushed, unless written again meanwhile
+def test_persistence_releases_flushed_chunks(tmp_path, mock_dataset):
+    from app.utils.data_loader import load_dataset
+    from app.utils.dataset_registry import get_derived, set_derived
+    from app.utils.persistence import PersistenceManager
+
+    store, wal = str(tmp_path / 'data.zarr'), str(tmp_path / 'wal')
+    mock_dataset.chunk({'lat': 2, 'lon': 2}).to_zarr(store)
+
+    ds = load_dataset(store, wal_directory=wal)
+    data_lock = Lock()
+    manager = set_derived(ds, 'persistence', PersistenceManager(ds, store, wal, data_lock))
+    app = Flask(__name__)
+    init_routes(app, ds, data_lock, Mock())
+    with app.test_client() as client:
+        client.post('/data/batch', json={'id': [0, 24], 'pm25': [1.0, 2.0]})
+    written = get_derived(ds, 'written_chunks')
+    assert set(written.chunks) == {(0, 0), (2, 2)}
+
+    # A chunk written again after its values were read for the store is kept
+    flushed = written.writes_of(slice(0, 2), slice(0, 2))
+    with app.test_client() as client:
+        client.put('/data/1', json={'pm25': 3.0})
+    assert written.release(flushed) is None
+
+    assert manager.flush() == 2
+    assert written.chunks == {}
+    assert ds['GWRPM25'].values[0, :2].tolist() == [1.0, 3.0]
+    assert ds['GWRPM25'].values[4, 4] == 2.0
+    manager.close()
+
+# Test a write failing to reach the write-ahead log leaves the grid, statistics and ETags unchanged
+def test_persistence_failed_append(tmp_path, mock_dataset):
+    from app.utils.data_loader import load_dataset
+    from app.utils.dataset_registry import set_derived
+    from app.utils.persistence import PersistenceManager
+
+    store, wal = str(tmp_path / 'data.zarr'), str(tmp_path / 'wal')
+    mock_dataset.chunk({'lat': 2, 'lon': 2}).to_zarr(store)
+
+    ds = load_dataset(store, wal_directory=wal)
+    data_lock = Lock()
+    manager = set_derived(ds, 'persistence', PersistenceManager(ds, store, wal, data_lock))
+    app = Flask(__name__)
+    init_routes(app, ds, data_lock, Mock())
+    with app.test_client() as client:
+        stats = client.get('/data/stats')
+        etag = client.get('/data/1').headers['ETag']
+        manager.wal.append = Mock(side_effect=OSError('disk full'))
+
+        assert client.put('/data/1', json={'pm25': 99.0}).status_code == 500
+        assert client.post('/data/batch', json={'id': [1, 24], 'pm25': [98.0, 97.0]}).status_code == 500
+
+        assert get_data_entry(1, ds)['pm25'] == 13.0
+        assert get_data_entry(24, ds)['pm25'] == 12.0
+        assert client.get('/data/stats').get_json() == stats.get_json()
+        assert client.get('/data/1', headers={'If-None-Match': etag}).status_code == 304
+    assert manager._dirty == set()
+    manager.close()
+
+# Test yearly grids are converted along time, and served by year or range from the cheapest layout
+def test_yearly_data(tmp_path, mock_dataset):
+    from app.utils.data_loader import load_dataset
+    from app.utils.time_series import get_yearly_data
+    from data_transformation.convert_to_zarr import convert_years
+
+    paths, grids = [], {}
+    for year in (2001, 2000, 2002):
+        grids[year] = mock_dataset['GWRPM25'].values + (year - 2000) * 100
+        paths.append(str(tmp_path / f'{year}.zarr'))
+        mock_dataset.copy(data={'GWRPM25': grids[year]}).to_zarr(paths[-1])
+    store = str(tmp_path / 'data.zarr')
+    convert_years(paths, [2001, 2000, 2002], store, chunks=(2, 2), overviews=False, timeseries_tile=1)
+
+    ds = load_dataset(store)
+    yearly = get_yearly_data(ds)
+    assert yearly.years == [2000, 2001, 2002]
+    assert yearly.served_year == 2002
+    np.testing.assert_array_equal(ds['GWRPM25'].values, grids[2002])
+    # One point over every year is read from the time series layout, a whole year from the yearly one
+    assert yearly.pick_layout([0, 1, 2], [0], [0]) is yearly.layouts['timeseries']
+    assert yearly.pick_layout([1], range(5), range(5)) is yearly.layouts['years']
+
+    app = Flask(__name__)
+    init_routes(app, ds, Lock(), Mock())
+    client = app.test_client()
+    client.put('/data/1', json={'pm25': 5.0})
+
+    assert client.get('/data/filter?lat=10&long=-90&year=2000').get_json() == {'lat': 10.0, 'lon': -90.0, 'year': 2000, 'pm25': 13.0}
+    assert client.get('/data/filter?lat=10&long=-90&year=2002').get_json()['pm25'] == 5.0
+    series = client.get('/data/filter?lat=10&long=-90&year_start=1990&year_end=2010').get_json()
+    assert series == {'lat': 10.0, 'lon': -90.0, 'years': [2000, 2001, 2002], 'pm25': [13.0, 113.0, 5.0]}
+    assert client.get('/data/filter?lat=20&long=-100&year_start=2000&year_end=2001').get_json()['pm25'] == [None, None]
+
+    stats = client.get('/data/stats?year=2001').get_json()
+    assert stats['year'] == 2001
+    assert stats['count'] == 22
+    assert stats['max_pm25'] == 116.5
+    stats = client.get('/data/stats?year_start=2000&year_end=2002&lat_min=5&lat_max=15&lon_min=-125&lon_max=-75').get_json()
+    assert [entry['max_pm25'] for entry in stats['years']] == [16.5, 116.5, 216.5]
+
+    assert client.get('/data/stats?year=1999').status_code == 400
+    assert client.get('/data/filter?lat=10&long=-90&year=2000&year_start=2000').status_code == 400
+    assert client.get('/data/filter?lat=10&long=-90&year_start=2001&year_end=2000').status_code == 400
+    assert client.post('/data', json={'lat': 10.0, 'lon': -90.0, 'pm25': 1.0, 'year': 2000}).status_code == 400
+    assert client.post('/data', json={'lat': 10.0, 'lon': -90.0, 'pm25': 1.0, 'year': 2002}).status_code == 201
+
+    legacy = Flask(__name__)
+    init_routes(legacy, mock_dataset, Lock(), Mock())
+    assert legacy.test_client().get('/data/filter?lat=10&long=-90&year=2000').status_code == 400
+
+# Test windows are served from the coarsest sufficient overview level and follow writes
+def test_window_from_overviews(tmp_path):
+    import zarr
+    from app.utils.data_loader import load_dataset
+    from app.utils.overviews import write_overviews, coarsen_fields, block_fields
+    from app.utils.persistence import PersistenceManager
+
+    rng = np.random.default_rng(0)
+    pm25 = rng.uniform(0, 50, (20, 22))
+    pm25[rng.random(pm25.shape) < 0.2] = np.nan
+    store = str(tmp_path / 'data.zarr')
+    xr.Dataset(
+        {'GWRPM25': (['lat', 'lon'], pm25)},
+        coords={'lat': np.linspace(50, 10, 20), 'lon': np.linspace(-20, 20, 22)}
+    ).chunk({'lat': 4, 'lon': 4}).to_zarr(store)
+    assert write_overviews(xr.open_zarr(store), store, min_size=2) == [2, 4, 8]
+
+    ds = load_dataset(store)
+    app = Flask(__name__)
+    init_routes(app, ds, Lock(), Mock())
+    client = app.test_client()
+
+    window = client.get('/data/window?width=4&height=4').get_json()
+    assert (window['level'], window['factor']) == (4, 8)
+    expected = coarsen_fields(block_fields(pm25), 8)['mean']
+    assert np.allclose(np.array(window['pm25'], dtype=float), expected, equal_nan=True)
+    assert window['lat'][0] == pytest.approx(np.linspace(50, 10, 20)[:8].mean())
+
+    window = client.get('/data/window?width=22&height=20&agg=max').get_json()
+    assert window['level'] == 1
+    assert np.allclose(np.array(window['pm25'], dtype=float), pm25, equal_nan=True)
+
+    client.put('/data/0', json={'pm25': 999.0})
+    assert client.get('/data/window?width=4&height=4&agg=max').get_json()['pm25'][0][0] == 999.0
+
+    manager = PersistenceManager(ds, store, str(tmp_path / 'wal'), Lock())
+    manager.on_write(ds, np.array([0]), np.array([0]), np.array([999.0]))
+    manager.flush()
+    manager.close()
+    assert zarr.open(store)['overviews/8/GWRPM25_max'][0, 0] == 999.0
+
+# Test windows are coarsened on the fly without overviews, and validated
+def test_window_without_overviews(client, mock_dataset):
+    window = client.get('/data/window?width=2&height=2&lat_min=10&lat_max=40&lon_min=-110&lon_max=-80').get_json()
+    assert (window['level'], window['factor']) == (1, 2)
+    assert window['pm25'][0][0] == pytest.approx(np.nanmean(mock_dataset['GWRPM25'].values[:2, :2]))
+    assert (window['lat'], window['lon']) == ([15.0, 35.0], [-85.0, -105.0])
+
+    assert client.get('/data/window?width=0').status_code == 400
+    assert client.get('/data/window?agg=median').status_code == 400
+    assert client.get('/data/window?lat_min=10').status_code == 400
+
+# Test the conversion tool writes the requested layout, band by band, and benchmarks candidate layouts
+def test_convert_to_zarr(tmp_path, mock_dataset):
+    import zarr
+    from data_transformation.convert_to_zarr import main, benchmark
+
+    source, store = str(tmp_path / 'source.zarr'), str(tmp_path / 'data.zarr')
+    mock_dataset.to_zarr(source)
+    main(['--input', source, '--output', store, '--chunks', '2x3', '--compressor', 'blosc-zstd',
+          '--clevel', '3', '--shard-rows', '1', '--no-overviews'])
+
+    array = zarr.open_consolidated(store)['GWRPM25']
+    assert array.chunks == (2, 3)
+    assert array.compressor.cname == 'zstd'
+    assert np.array_equal(array[:], mock_dataset['GWRPM25'].values, equal_nan=True)
+
+    results = benchmark(source, [
+        {'chunks': (2, 2), 'compressor': 'none', 'clevel': 5, 'shuffle': 'shuffle'},
+        {'chunks': (5, 5), 'compressor': 'lz4', 'clevel': 5, 'shuffle': 'shuffle'}
+    ], points=10)
+    assert [result['chunks'] for result in results] == ['2x2', '5x5']
+    assert all(result['size_bytes'] > 0 and result['full_scan_seconds'] > 0 for result in results)
+
+    with pytest.raises(SystemExit):
+        main(['--chunks', '2x2', '4x4'])
+
+# Test the benchmark suite runs scenarios against a generated grid and flags regressions
+def test_benchmark_suite(tmp_path):
+    from benchmarks.generate_dataset import generate_dataset
+    from benchmarks.run import run, compare
+
+    store = str(tmp_path / 'benchmark.zarr')
+    generated = generate_dataset(store, lat_size=40, lon_size=60, nan_fraction=0.5, chunks=(16, 16), overview_min_size=8)
+    assert 0.3 < float(generated['GWRPM25'].isnull().mean()) < 0.7
+
+    report = run(store, scenarios=['get_by_id', 'filter_batch', 'window', 'update_batch'], requests=5)
+    assert list(report['scenarios']) == ['get_by_id', 'filter_batch', 'window', 'update_batch']
+    assert all(summary['errors'] == 0 and summary['p50_ms'] <= summary['p99_ms'] for summary in report['scenarios'].values())
+
+    assert {'open_store', 'coordinate_index', 'chunk_statistics', 'valid_index', 'routes'} <= set(report['startup']['phases'])
+
+    slower = {
+        'startup': {**report['startup'], 'ready_seconds': report['startup']['ready_seconds'] * 2},
+        'scenarios': {name: {**summary, 'p95_ms': summary['p95_ms'] * 2} for name, summary in report['scenarios'].items()}
+    }
+    assert compare(report, report) == []
+    assert {regression['scenario'] for regression in compare(slower, report)} == {'startup', *report['scenarios']}
+
+# Test the metrics endpoint exposes request latency, lock waits, dask computations and store reads
+def test_metrics(tmp_path, mock_dataset):
+    from app.utils.data_loader import load_dataset
+    from app.utils.chunk_cache import get_chunk_cache
+    from app.utils.metrics import REQUEST_DURATION, LOCK_WAIT, DASK_TASKS, STORE_BYTES_READ
+
+    store = str(tmp_path / 'data.zarr')
+    mock_dataset.chunk({'lat': 2, 'lon': 2}).to_zarr(store)
+    bytes_read, dask_tasks = STORE_BYTES_READ.value(), DASK_TASKS.value(endpoint='background')
+    ds = load_dataset(store)
+    assert STORE_BYTES_READ.value() > bytes_read
+    assert DASK_TASKS.value(endpoint='background') > dask_tasks
+
+    app = Flask(__name__)
+    init_routes(app, ds, Lock(), Mock())
+    client = app.test_client()
+
+    requests_seen = REQUEST_DURATION.count(endpoint='/data/<int:id>', method='PUT', status=200)
+    lock_waits = LOCK_WAIT.count()
+    dask_tasks = DASK_TASKS.value(endpoint='/data/filter')
+    client.put('/data/1', json={'pm25': 18.0})
+    get_chunk_cache(ds).on_stale(ds, np.array([2]), np.array([2]))  # Read the chunk of the point from the store
+    client.get('/data/filter?lat=30&long=-100')
+    assert REQUEST_DURATION.count(endpoint='/data/<int:id>', method='PUT', status=200) == requests_seen + 1
+    assert LOCK_WAIT.count() == lock_waits + 1
+    assert DASK_TASKS.value(endpoint='/data/filter') > dask_tasks
+
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE http_request_duration_seconds histogram' in text
+    assert 'http_request_duration_seconds_bucket{endpoint="/data/filter",method="GET",status="200",le="+Inf"}' in text
+    assert 'store_bytes_read_total ' in text
+    assert 'chunk_cache_misses_total ' in text
+    assert 'startup_phase_seconds{phase="open_store"} ' in text
+
+# Test workers forked once the dataset is loaded compute with dask and tag responses with an epoch of their own
+def test_preloaded_workers(tmp_path, mock_dataset):
+    import gc
+    import json
+    import signal
+    from app.utils.data_loader import load_dataset
+    from app.utils.prefork import freeze_for_fork
+
+    store = str(tmp_path / 'data.zarr')
+    mock_dataset.chunk({'lat': 2, 'lon': 2}).to_zarr(store, consolidated=True)
+    ds = load_dataset(store)
+    app = Flask(__name__)
+    init_routes(app, ds, Lock(), Mock())
+    etag = app.test_client().get('/data/stats').headers['ETag']
+
+    freeze_for_fork()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        signal.alarm(30)
+        try:
+            response = app.test_client().get('/data/stats')
+            result = {'etag': response.headers['ETag'], 'total': float(ds['GWRPM25'].sum().compute())}
+            os.write(write_fd, json.dumps(result).encode())
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    result = json.loads(os.read(read_fd, 4096) or 'null')
+    os.waitpid(pid, 0)
+    gc.unfreeze()
+
+    assert result is not None
+    assert result['total'] == pytest.approx(float(np.nansum(mock_dataset['GWRPM25'].values)))
+    assert result['etag'] != etag and result['etag'].split('-')[1] == etag.split('-')[1]
+
+# Test the mean merged from chunk partials stays within rounding of a reduction over the grid, float32 included
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_chunk_statistics_precision(dtype):
+    rng = np.random.default_rng(0)
+    pm25 = rng.gamma(2.0, 6.0, (357, 713)).astype(dtype)
+    pm25[rng.random(pm25.shape) < 0.3] = np.nan
+    ds = xr.Dataset(
+        {'GWRPM25': (['lat', 'lon'], pm25)}, coords={'lat': np.arange(357.0), 'lon': np.arange(713.0)}
+    ).chunk({'lat': 50, 'lon': 60})
+
+    summary = ChunkStatistics(ds, (50, 60)).summary()
+    assert summary['count'] == int(ds['GWRPM25'].count())
+    assert summary['mean_pm25'] == pytest.approx(float(ds['GWRPM25'].mean()), rel=2 * np.finfo(dtype).eps)
+    assert summary['min_pm25'] == float(ds['GWRPM25'].min())
+    assert summary['max_pm25'] == float(ds['GWRPM25'].max())
+
+# Test the sampling profiler reports the stacks of slow requests only
+def test_slow_request_profiler(tmp_path):
+    from app.utils.metrics import SlowRequestProfiler
+
+    profiler = SlowRequestProfiler(0.05, interval=0.001, directory=str(tmp_path))
+
+    def busy_wait(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    profiler.start_request()
+    busy_wait(0.1)
+    hottest = profiler.finish_request('GET /slow', 0.1)
+    assert any('busy_wait' in stack for stack, _ in hottest)
+    assert len(os.listdir(tmp_path)) == 1
+
+    profiler.start_request()
+    assert profiler.finish_request('GET /fast', 0.001) is None
+
+# Test requests are logged by the background writer with their status, duration and body
+def test_request_logging(mock_dataset, mocker):
+    import logging
+    from app.utils.request_logging import RequestLog
+
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    request_log = RequestLog(handlers=[handler], max_body_bytes=32)
+    mocker.patch('app.routes.main.get_request_log', return_value=request_log)
+
+    app = Flask(__name__)
+    init_routes(app, mock_dataset, Lock(), Mock())
+    with app.test_client() as client:
+        client.get('/data/1')
+        client.put('/data/1', json={'pm25': 20.0})
+        client.post('/data', json={'lat': 10.0, 'lon': -80.0, 'pm25': 1.0, 'note': 'x' * 100})
+        client.post('/data', data='not json')
+    request_log.flush()
+    request_log.stop()
+
+    messages = [record.getMessage() for record in records]
+    assert messages[0].startswith('127.0.0.1 - GET http://localhost/data/1 - 200 in ')
+    assert messages[1].endswith(' - Body: {"pm25":20.0}')
+    assert '... (truncated, ' in messages[2]
+    assert messages[3].endswith(' - No JSON body in the request.')
+    assert records[1].request.fields()['status'] == 200
+
+# Test workers attached to the shared grid see each other's writes, statistics included
+def test_shared_grid_across_workers(tmp_path, mock_dataset):
+    from app.utils.shared_grid import load_shared_dataset
+
+    store, shared = str(tmp_path / 'data.zarr'), str(tmp_path / 'shm')
+    mock_dataset.chunk({'lat': 2, 'lon': 2}).to_zarr(store)
+
+    clients = []
+    for _ in range(2):
+        ds, data_lock = load_shared_dataset(store, shared)
+        app = Flask(__name__)
+        init_routes(app, ds, data_lock, Mock())
+        clients.append(app.test_client())
+    first, second = clients
+
+    assert first.put('/data/1', json={'pm25': 42.0}).status_code == 200
+    second.delete('/data/24')
+
+    assert second.get('/data/1').get_json()['pm25'] == 42.0
+    assert first.get('/data/24').get_json()['pm25'] is None
+    for client in clients:
+        stats = client.get('/data/stats').get_json()
+        assert stats['count'] == 21
+        assert stats['max_pm25'] == 42.0
+        assert client.get('/data/stats?lat_min=45&lat_max=55&lon_min=-125&lon_max=-115').get_json()['count'] == 0
+
+# Test reads are served from the chunk cache, which follows writes and evicts within its budget
+def test_chunk_cache(chunked_dataset):
+    from app.utils.chunk_cache import build_chunk_cache
+
+    # Room for two 2x2 float64 chunks
+    cache = build_chunk_cache(chunked_dataset, 64)
+    app = Flask(__name__)
+    init_routes(app, chunked_dataset, Lock(), Mock())
+    client = app.test_client()
+
+    assert client.get('/data/0').get_json()['pm25'] == 12.5
+    assert client.get('/data/1').get_json()['pm25'] == 13.0
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['hits'] == 1
+
+    client.put('/data/6', json={'pm25': 42.0})
+    assert client.get('/data/6').get_json()['pm25'] == 42.0
+    assert client.get('/data/stats').get_json()['max_pm25'] == 42.0
+
+    client.get('/data/2')
+    client.get('/data/4')
+    stats = client.get('/data/cache-stats').get_json()
+    assert stats['evictions'] >= 1
+    assert stats['chunks'] == 2
+    assert stats['bytes'] <= stats['max_bytes']
+    assert client.get('/data?page=1&per_page=25').get_json() == [get_data_entry(idx, chunked_dataset) for idx in range(25)]
+    assert client.get('/data/6').get_json()['pm25'] == 42.0
+
+# Test reads carry the version of their chunks as ETag, answer 304 and are cached until written
+def test_conditional_reads(chunked_client, chunked_dataset):
+    from app.utils.dataset_registry import get_derived
+
+    response = chunked_client.get('/data/1')
+    etag = response.headers['ETag']
+    response = chunked_client.get('/data/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+    # A write to another chunk keeps the ETag, a write to the chunk of the entry changes it
+    stats_etag = chunked_client.get('/data/stats').headers['ETag']
+    chunked_client.put('/data/24', json={'pm25': 30.0})
+    assert chunked_client.get('/data/1', headers={'If-None-Match': etag}).status_code == 304
+    assert chunked_client.get('/data/stats', headers={'If-None-Match': stats_etag}).status_code == 200
+    chunked_client.put('/data/6', json={'pm25': 31.0})
+    response = chunked_client.get('/data/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json()['pm25'] == 13.0
+
+    cache = get_derived(chunked_dataset, 'response_cache')
+    first = chunked_client.get('/data?page=1&per_page=3').get_json()
+    hits = cache.stats()['hits']
+    assert chunked_client.get('/data?page=1&per_page=3').get_json() == first
+    assert cache.stats()['hits'] == hits + 1
+
+    chunked_client.put('/data/2', json={'pm25': 32.0})
+    assert cache.stats()['invalidations'] >= 1
+    assert chunked_client.get('/data?page=1&per_page=3').get_json()[2]['pm25'] == 32.0
+    assert chunked_client.get('/data/filter?lat=10&long=-100').get_json()['pm25'] == 32.0
+
+# Test a chunk written while it is loaded into the cache is not cached stale
+def test_chunk_cache_write_during_load(chunked_dataset):
+    from app.utils.chunk_cache import build_chunk_cache
+    from app.utils.grid_utils import write_pm25_blocks
+
+    cache = build_chunk_cache(chunked_dataset, 1024)
+    stale = chunked_dataset.copy(deep=True)
+
+    class RacingDataset:
+        # The point is written once the load has read the chunk
+        def __getitem__(self, name):
+            write_pm25_blocks(chunked_dataset, [(slice(0, 1), slice(0, 1), 99.0)])
+            cache.write_through(np.array([0]), np.array([0]), np.array([99.0]))
+            return stale[name]
+
+    assert cache.get_chunk(RacingDataset(), 0, 0)[0, 0] == 12.5
+    assert cache.stats()['chunks'] == 0
+    assert cache.get_chunk(chunked_dataset, 0, 0)[0, 0] == 99.0
+
+# Test pinned snapshots keep reading the grid and the statistics as of their version
+def test_snapshot_isolation(chunked_dataset):
+    from app.utils.data_set_utils import calculate_pm25_statistics, calculate_region_statistics, update_pm25_values
+    from app.utils.chunk_statistics import get_chunk_statistics
+    from app.utils.dataset_version import get_dataset_version, pin_snapshot
+    from app.utils.export_utils import iter_chunk_records
+
+    before = chunked_dataset['GWRPM25'].values.copy()
+    expected = expected_stats(chunked_dataset.copy(deep=True))
+    bbox = {'lat_min': 15, 'lat_max': 45, 'lon_min': -115, 'lon_max': -85}
+    expected_region = calculate_region_statistics(chunked_dataset, bbox)
+    records = iter_chunk_records(chunked_dataset, slice(None), slice(None))
+    next(records)
+
+    with pin_snapshot(chunked_dataset) as snapshot:
+        update_pm25_values(chunked_dataset, np.array([0, 2, 4]), np.array([0, 2, 4]), np.array([90.0, 91.0, np.nan]))
+        assert np.array_equal(snapshot.read_block(slice(0, 5), slice(0, 5)), before, equal_nan=True)
+        assert [entry['pm25'] for entry in paginate_data(chunked_dataset, 1, 25)] == [
+            value if value == value else None for value in before.ravel().tolist()
+        ]
+        assert calculate_pm25_statistics(chunked_dataset) == pytest.approx(expected, rel=1e-12)
+        assert calculate_region_statistics(chunked_dataset, bbox) == pytest.approx(expected_region, rel=1e-12)
+        assert get_chunk_statistics(chunked_dataset)._preimages
+
+    # The export started before the write still sees the grid as it was
+    exported = np.concatenate([pm25 for _, _, _, pm25 in records])
+    assert 90.0 not in exported and 91.0 not in exported
+    assert not get_chunk_statistics(chunked_dataset)._preimages
+
+    assert calculate_pm25_statistics(chunked_dataset)['max_pm25'] == 91.0
+    assert get_dataset_version(chunked_dataset).stats()['preimages'] == 0
+
+# Test a reader never sees half of a batch written concurrently
+def test_snapshot_isolation_concurrent_batches(chunked_dataset):
+    import threading
+    from app.utils.data_set_utils import update_pm25_values
+    from app.utils.dataset_version import pin_snapshot
+
+    lat_idx, lon_idx = (index.ravel() for index in np.indices((5, 5)))
+    done = threading.Event()
+
+    def write():
+        for value in range(1, 20):
+            update_pm25_values(chunked_dataset, lat_idx, lon_idx, np.full(25, float(value)))
+        done.set()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while not done.is_set():
+        with pin_snapshot(chunked_dataset):
+            values = {entry['pm25'] for entry in paginate_data(chunked_dataset, 1, 25)}
+        assert len(values) == 1 or values == {12.5, 13.0, 14.0, None, 16.5, 11.5, 12.0, 15.0, 16.0, 10.5, 11.0, 9.5, 13.0, 8.5, 9.0, 10.0}
+    writer.join(timeout=30)
+    assert not writer.is_alive()
+
+# Test concurrent identical computations run once, and results are reused until the version changes
+def test_versioned_result_cache_single_flight():
+    import threading
+    import time
+    from app.utils.result_cache import VersionedResultCache
+
+    cache = VersionedResultCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return len(calls)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('stats', 0, compute))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [1] * 10
+    assert cache.get_or_compute('stats', 0, compute) == 1
+    assert cache.get_or_compute('stats', 1, compute) == 2
+    assert cache.peek('stats', 0) == (False, None)
+
+# Test stats requests share one task and one computation while the data is unchanged
+def test_stats_async_reuses_task(mock_dataset, mocker):
+    jobs = Mock()
+    jobs.submit.side_effect = ['task-1', 'task-2']
+    jobs.status.return_value = {'state': 'PENDING'}
+    compute = mocker.patch('app.routes.main.calculate_pm25_statistics', return_value={'count': 22})
+
+    app = Flask(__name__)
+    init_routes(app, mock_dataset, Lock(), jobs)
+    client = app.test_client()
+
+    assert client.get('/data/stats-async').get_json() == {'task_id': 'task-1'}
+    assert client.get('/data/stats-async').get_json() == {'task_id': 'task-1'}
+    assert client.get('/data/stats/task-1').get_json()['state'] == 'PENDING'
+
+    assert client.get('/data/stats').get_json() == {'count': 22}
+    assert client.get('/data/stats').get_json() == {'count': 22}
+    assert compute.call_count == 1
+    assert client.get('/data/stats/task-1').get_json() == {'state': 'SUCCESS', 'result': {'count': 22}}
+
+    client.put('/data/1', json={'pm25': 18.0})
+    assert client.get('/data/stats-async').get_json() == {'task_id': 'task-2'}
+    client.get('/data/stats')
+    assert compute.call_count == 2
+
+# Test the local executor runs stats jobs in a process pool and records them in its job store
+def test_local_job_executor(mock_dataset, tmp_path):
+    jobs = LocalJobExecutor(str(tmp_path / 'jobs.sqlite3'), max_workers=1)
+    app = Flask(__name__)
+    init_routes(app, mock_dataset, Lock(), jobs)
+    client = app.test_client()
+
+    task_id = client.get('/data/stats-async').get_json()['task_id']
+    deadline = time.time() + 60
+    while (response := client.get(f'/data/stats/{task_id}').get_json())['state'] in ('PENDING', 'STARTED'):
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+    assert response['state'] == 'SUCCESS'
+    assert response['result'] == pytest.approx(expected_stats(mock_dataset))
+    assert response['runtime_seconds'] >= 0
+    # Reopening the store, as another worker would, sees the same job
+    assert LocalJobExecutor(str(tmp_path / 'jobs.sqlite3')).status(task_id)['state'] == 'SUCCESS'
+    assert client.delete(f'/data/stats/{task_id}').status_code == 404
+
+    failed = jobs.submit(summarize_snapshot, {}, None)
+    while jobs.status(failed)['state'] in ('PENDING', 'STARTED'):
+        time.sleep(0.05)
+    assert jobs.status(failed)['state'] == 'FAILURE'
+
+# Test the local executor closes every connection to its job store
+def test_local_job_executor_closes_connections(tmp_path, mocker):
+    import sqlite3
+    from app.utils import job_executor
+
+    connections = []
+
+    def connect(store_path):
+        connections.append(sqlite3.connect(store_path, isolation_level=None))
+        return connections[-1]
+
+    mocker.patch.object(job_executor, '_connect', side_effect=connect)
+    jobs = LocalJobExecutor(str(tmp_path / 'jobs.sqlite3'))
+    jobs.status('unknown')
+    jobs.cancel('unknown')
+    assert len(connections) == 3
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute('SELECT 1')
+
 # Test PUT /data/<id> (update existing data)
 def test_update_data(client, mock_dataset):
     updated_data = {